@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+比较每次创建 CBC 实例解密与 DataCrypt（复用 ECB 实例）解密小程序数据的耗时
+
+Usage:
+
+    python benchmarks/bench_decrypt.py [count]
+"""
+
+import base64
+import json
+import os
+import sys
+import time
+
+from Crypto.Cipher import AES
+
+from flask_wechat.api.enc import DataCrypt
+
+APPID = 'wx4f4bc4dec97d474b'
+
+
+def make_payload(key, i):
+    plaintext = json.dumps({
+        'phoneNumber': '138{:08d}'.format(i),
+        'purePhoneNumber': '138{:08d}'.format(i),
+        'countryCode': '86',
+        'watermark': {'appid': APPID, 'timestamp': 1477314187},
+    }).encode('utf-8')
+    padding_length = 16 - len(plaintext) % 16
+    plaintext += bytes([padding_length]) * padding_length
+    iv = os.urandom(16)
+    encrypted = AES.new(key, AES.MODE_CBC, iv).encrypt(plaintext)
+    return base64.b64encode(encrypted).decode(), base64.b64encode(iv).decode()
+
+
+def decrypt_cbc(session_key, payloads):
+    """
+    优化前的做法：每条数据重新解码 session_key 并创建 CBC 实例
+    """
+    results = []
+    for encrypted_data, iv in payloads:
+        key = base64.b64decode(session_key)
+        cipher = AES.new(key, AES.MODE_CBC, base64.b64decode(iv))
+        data = cipher.decrypt(base64.b64decode(encrypted_data))
+        data = data[:-data[-1]]
+        results.append(json.loads(data.decode('utf-8')))
+    return results
+
+
+def decrypt_each(session_key, payloads):
+    return [DataCrypt(APPID, session_key).decrypt(encrypted_data, iv) for encrypted_data, iv in payloads]
+
+
+def decrypt_many(session_key, payloads):
+    return DataCrypt(APPID, session_key).decrypt_many(payloads)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    key = os.urandom(16)
+    session_key = base64.b64encode(key).decode()
+    payloads = [make_payload(key, i) for i in range(count)]
+
+    expected = decrypt_cbc(session_key, payloads)
+    for name, func in [('cbc per call', decrypt_cbc), ('DataCrypt per call', decrypt_each), ('decrypt_many', decrypt_many)]:
+        started_at = time.perf_counter()
+        results = func(session_key, payloads)
+        elapsed = time.perf_counter() - started_at
+        assert results == expected
+        print('{:<20}{:>8} payloads {:>8.3f}s {:>10.0f} payloads/s'.format(name, count, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
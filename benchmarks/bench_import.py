@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+测量 flask_wechat 各入口的导入耗时（python -X importtime），并检查是否提前加载了重量级依赖
+
+任何入口加载了不应加载的模块时以非零状态退出，可以在 CI 中防止启动耗时回退
+
+Usage:
+
+    python benchmarks/bench_import.py [repeat]
+"""
+
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('flask', 'requests', 'Crypto', 'xml.etree.ElementTree', 'concurrent.futures')
+
+# (入口, 允许加载的重量级模块)
+ENTRIES = [
+    ('import flask_wechat', ()),
+    ('from flask_wechat import UserClient', ()),
+    ('from flask_wechat.api.merchant import OrdinaryMerchantApi', ()),
+    ('from flask_wechat.api import SecretAppApi', ()),
+    ('from flask_wechat import SecretAppClient', ('flask', 'concurrent.futures')),
+]
+
+IMPORTTIME_PATTERN = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def _importtime(code):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, check=True
+    )
+    modules = []
+    for line in process.stderr.decode().splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        # 只统计顶层导入，其累计耗时已包含子模块
+        if match and len(match.group(3)) == 1:
+            modules.append((match.group(4), int(match.group(2))))
+    return process.stdout.decode(), modules
+
+
+def measure(statement, startup_modules):
+    code = 'import sys\n{}\nprint(",".join(m for m in {!r} if m in sys.modules))'.format(statement, HEAVY_MODULES)
+    output, modules = _importtime(code)
+    loaded = [m for m in output.strip().split(',') if m]
+    # 扣除解释器启动时的导入
+    total = sum(elapsed for name, elapsed in modules if name not in startup_modules)
+    return total, loaded
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    failed = False
+    startup_modules = set(name for name, _ in _importtime('import sys')[1])
+    for statement, allowed in ENTRIES:
+        results = [measure(statement, startup_modules) for _ in range(repeat)]
+        best = min(total for total, _ in results)
+        loaded = results[0][1]
+        unexpected = [m for m in loaded if m not in allowed]
+        status = 'ok' if not unexpected else 'FAIL: loaded {}'.format(', '.join(unexpected))
+        failed = failed or bool(unexpected)
+        print('{:<60}{:>10.1f}ms  {}'.format(statement, best / 1000.0, status))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+比较逐个对象更新用户信息与 bulk_update_user_info 的耗时
+
+Usage:
+
+    python benchmarks/bench_sqla_bulk.py [count] [database_url]
+"""
+
+import sys
+import time
+
+from sqlalchemy import Column, Integer, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from flask_wechat.sqla import WeChatUserMixin
+
+Base = declarative_base()
+
+
+class User(WeChatUserMixin, Base):
+    __tablename__ = 'bench_wechat_user'
+
+    id = Column(Integer, primary_key=True)
+
+
+def make_user_info(i, generation):
+    return {
+        'subscribe': 1,
+        'openid': 'openid_{:08d}'.format(i),
+        'nickname': 'user {} gen {}'.format(i, generation),
+        'sex': i % 3,
+        'language': 'zh_CN',
+        'city': 'Shenzhen',
+        'province': 'Guangdong',
+        'country': 'China',
+        'headimgurl': 'http://example.com/{}.png'.format(i),
+        'unionid': 'unionid_{:08d}'.format(i),
+    }
+
+
+def per_object(session, appid, user_info_list):
+    for user_info in user_info_list:
+        user = session.query(User).filter_by(appid=appid, openid=user_info['openid']).first()
+        if user is None:
+            user = User(appid=appid, openid=user_info['openid'])
+            session.add(user)
+        user.update_user_info(user_info)
+        user.unionid = user_info['unionid']
+        session.flush()
+    session.commit()
+
+
+def bulk(session, appid, user_info_list):
+    User.bulk_update_user_info(session, appid, user_info_list)
+
+
+def run(name, func, session_factory, appid, count):
+    for generation, label in enumerate(['insert', 'update']):
+        user_info_list = [make_user_info(i, generation) for i in range(count)]
+        session = session_factory()
+        started_at = time.perf_counter()
+        func(session, appid, user_info_list)
+        elapsed = time.perf_counter() - started_at
+        session.close()
+        print('{:<12}{:<8}{:>8} rows {:>9.3f}s {:>10.0f} rows/s'.format(name, label, count, elapsed, count / elapsed))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    database_url = sys.argv[2] if len(sys.argv) > 2 else 'sqlite://'
+    engine = create_engine(database_url)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+
+    run('per-object', per_object, session_factory, 'wx_per_object', count)
+    run('bulk', bulk, session_factory, 'wx_bulk', count)
+    Base.metadata.drop_all(engine)
+
+
+if __name__ == '__main__':
+    main()
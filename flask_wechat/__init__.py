@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 
-from .app import SecretAppClient
-from .component import ComponentAppClient
-from .merchant import OrdinaryMerchantClient
-from .user import UserClient
-from .website import WebsiteAppClient
+import importlib
+
+# 公开的名称在第一次访问时才导入对应模块，import flask_wechat 不会加载 flask、requests 和 Crypto
+_LAZY_ATTRIBUTES = {
+    'ComponentAppClient': '.component',
+    'WebsiteAppClient': '.website',
+    'UserClient': '.user',
+    'SecretAppClient': '.app',
+    'OrdinaryMerchantClient': '.merchant',
+}
 
 __all__ = [
     'ComponentAppClient',
@@ -13,3 +18,16 @@ __all__ = [
     'SecretAppClient',
     'OrdinaryMerchantClient'
 ]
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
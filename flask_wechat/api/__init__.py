@@ -1,9 +1,15 @@
 #!/usr/bin/env python
 
-from .app import SecretAppApi, AuthorizedAppApi
-from .component import ComponentAppApi
-from .merchant import OrdinaryMerchantApi, MerchantMessage
-from .user import UserApi
+import importlib
+
+_LAZY_ATTRIBUTES = {
+    'ComponentAppApi': '.component',
+    'SecretAppApi': '.app',
+    'AuthorizedAppApi': '.app',
+    'UserApi': '.user',
+    'OrdinaryMerchantApi': '.merchant',
+    'MerchantMessage': '.merchant',
+}
 
 __all__ = [
     'ComponentAppApi',
@@ -13,3 +19,16 @@ __all__ = [
     'OrdinaryMerchantApi',
     'MerchantMessage'
 ]
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -1,21 +1,41 @@
 #!/usr/bin/env python
 
-import json
 from urllib import parse
 
 from .base import BaseApi
 from .common import WeChatApiError
+from .pagination import paginate
+
+
+def wxa_page_path(path, params=None):
+    """
+    小程序码的页面路径，params 按键排序后拼接为查询字符串，相同参数得到相同的路径
+
+    >> wxa_page_path('pages/index', {'id': 1})
+    'pages/index?id=1'
+    """
+    if params is not None:
+        path = '{}?{}'.format(path, parse.urlencode(sorted(params.items())))
+    return path
 
 
 class BaseAppApi(BaseApi):
     def decrypt_data(self, encrypt_data, key=None, iv=None):
-        result = self._aes_decrypt(encrypt_data, key=key, iv=iv)
-        result = json.loads(result)
-        watermark = result.pop('watermark')
-        if not watermark['appid'] == self.appid:
-            return WeChatApiError(400, 'appid does not match')
+        result = self.data_crypt(key).decrypt(encrypt_data, iv)
+        result.pop('watermark')
         return result
 
+    def decrypt_many(self, payloads, key):
+        """
+        用同一个 session_key 解密多条数据
+
+        :param payloads: (encrypt_data, iv) 的迭代器
+        """
+        results = self.data_crypt(key).decrypt_many(payloads)
+        for result in results:
+            result.pop('watermark')
+        return results
+
     def send_uniform_message(self, access_token, touser, weapp_template_msg=None, mp_template_msg=None):
         params = {
             'access_token': access_token
@@ -32,7 +52,46 @@ class BaseAppApi(BaseApi):
 
         return self.post('https://api.weixin.qq.com/cgi-bin/message/wxopen/template/uniform_send', params=params, data=data)
 
-    def get_wxa_code(self, access_token, path, width=None, auto_color=False, line_color=None, is_hyaline=False):
+    def get_followers(self, access_token, next_openid=None):
+        """
+        获取公众号的关注者列表，每次最多 10000 个
+        """
+        params = {
+            'access_token': access_token
+        }
+        if next_openid:
+            params['next_openid'] = next_openid
+        return self.get('https://api.weixin.qq.com/cgi-bin/user/get', params=params)
+
+    def batch_get_user_info(self, access_token, openids, lang='zh_CN'):
+        """
+        批量获取用户基本信息，每次最多 100 个
+        """
+        params = {
+            'access_token': access_token
+        }
+        data = {
+            'user_list': [{'openid': openid, 'lang': lang} for openid in openids]
+        }
+        return self.post('https://api.weixin.qq.com/cgi-bin/user/info/batchget', params=params, data=data)
+
+    def get_api_quota(self, access_token, cgi_path):
+        """
+        查询接口的每日调用额度
+        https://developers.weixin.qq.com/doc/offiaccount/openApi/get_api_quota.html
+        """
+        params = {
+            'access_token': access_token
+        }
+        data = {
+            'cgi_path': cgi_path
+        }
+        return self.post('https://api.weixin.qq.com/cgi-bin/openapi/quota/get', params=params, data=data)
+
+    def get_wxa_code(self, access_token, path, width=None, auto_color=False, line_color=None, is_hyaline=False, fileobj=None):
+        """
+        :param fileobj: 传入时把图片写入 fileobj 并返回 Content-Type，否则返回图片内容
+        """
         params = {
             'access_token': access_token
         }
@@ -43,12 +102,39 @@ class BaseAppApi(BaseApi):
         }
         if width is not None:
             data['width'] = width
-        if not auto_color:
+        if line_color is not None:
             data['line_color'] = line_color
 
-        return self.post('https://api.weixin.qq.com/wxa/getwxacode', params=params, data=data)
+        url = 'https://api.weixin.qq.com/wxa/getwxacode'
+        if fileobj is not None:
+            return self.post_to_file(url, fileobj, params=params, data=data)
+        return self.post_binary(url, params=params, data=data)
 
-    def create_wxa_qrcode(self, access_token, path, width=None):
+    def get_wxa_code_unlimit(self, access_token, scene, page=None, width=None, auto_color=False, line_color=None, is_hyaline=False, fileobj=None):
+        """
+        获取数量不限的小程序码，参数通过 scene 传递
+        """
+        params = {
+            'access_token': access_token
+        }
+        data = {
+            'scene': scene,
+            'auto_color': auto_color,
+            'is_hyaline': is_hyaline
+        }
+        if page is not None:
+            data['page'] = page
+        if width is not None:
+            data['width'] = width
+        if line_color is not None:
+            data['line_color'] = line_color
+
+        url = 'https://api.weixin.qq.com/wxa/getwxacodeunlimit'
+        if fileobj is not None:
+            return self.post_to_file(url, fileobj, params=params, data=data)
+        return self.post_binary(url, params=params, data=data)
+
+    def create_wxa_qrcode(self, access_token, path, width=None, fileobj=None):
         params = {
             'access_token': access_token
         }
@@ -58,7 +144,10 @@ class BaseAppApi(BaseApi):
         if width is not None:
             data['width'] = width
 
-        return self.post('https://api.weixin.qq.com/cgi-bin/wxaapp/createwxaqrcode', params=params, data=data)
+        url = 'https://api.weixin.qq.com/cgi-bin/wxaapp/createwxaqrcode'
+        if fileobj is not None:
+            return self.post_to_file(url, fileobj, params=params, data=data)
+        return self.post_binary(url, params=params, data=data)
 
 
 class SecretAppApi(BaseAppApi):
@@ -211,27 +300,24 @@ class AuthorizedAppApi(BaseAppApi):
         result = self.token_get(get_all_private_template_url)
         return result
 
-    def get_template_library_list(self):
+    def iter_template_library_list(self, prefetch=False):
         """
-        获取小程序模板库标题列表
+        逐条产出小程序模板库标题列表
         """
         get_template_library_list_url = 'https://api.weixin.qq.com/cgi-bin/wxopen/template/library/list'
-        offset = 0
-        count = 20
-        templates = []
-        while True:
+
+        def fetch_page(offset, count):
             data = {'offset': offset, 'count': count}
             result = self.token_post(get_template_library_list_url, data=data)
-            curr_list = result.get('list')
-            if curr_list:
-                templates.append(curr_list)
+            return result.get('list')
 
-            if len(curr_list) < count:
-                break
+        return paginate(fetch_page, count=20, prefetch=prefetch)
 
-            offset += count
-
-        return templates
+    def get_template_library_list(self):
+        """
+        获取小程序模板库标题列表
+        """
+        return list(self.iter_template_library_list())
 
     def get_template_library_keywords_by_id(self, template_library_id):
         """
@@ -265,24 +351,21 @@ class AuthorizedAppApi(BaseAppApi):
         result = self.token_post(del_template_url, data=data)
         return result
 
-    def get_template_list(self):
+    def iter_template_list(self, prefetch=False):
         """
-        获取小程序消息模板列表
+        逐条产出小程序消息模板列表
         """
         get_template_list_url = 'https://api.weixin.qq.com/cgi-bin/wxopen/template/list'
-        offset = 0
-        count = 20
-        templates = []
-        while True:
+
+        def fetch_page(offset, count):
             data = {'offset': offset, 'count': count}
             result = self.token_post(get_template_list_url, data=data)
-            curr_list = result.get('list')
-            if curr_list:
-                templates.extend(curr_list)
+            return result.get('list')
 
-            if len(curr_list) < count:
-                break
+        return paginate(fetch_page, count=20, prefetch=prefetch)
 
-            offset += count
-
-        return templates
+    def get_template_list(self):
+        """
+        获取小程序消息模板列表
+        """
+        return list(self.iter_template_list())
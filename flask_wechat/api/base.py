@@ -1,52 +1,226 @@
 #!/usr/bin/env python
 
-import base64
+import io
 import json
+import threading
+import time
 from abc import ABC
 
-import requests
-from Crypto.Cipher import AES
+from ..cache import LocalCache
+from .breaker import get_breakers
+from .common import WeChatApiError, WeChatCircuitOpenError
+from .metrics import endpoint_name, get_metrics
+from .ratelimit import get_limits
+from .tracing import get_tracer, span
 
-from .common import WeChatApiError
+_session = None
+_session_lock = threading.Lock()
+_pool_size = 20
+# (连接超时, 读取超时)，微信服务故障时请求不会无限期占用工作线程
+_timeout = (3.05, 10)
+
+_data_crypts = LocalCache(maxsize=1024, default_timeout=0)
+
+
+def configure_session(pool_size=None, timeout=None):
+    """
+    设置共享连接池的大小和请求的超时时间，需要在第一次请求之前调用
+
+    :param timeout: 秒，或 (连接超时, 读取超时)
+    """
+    global _pool_size, _session, _timeout
+    with _session_lock:
+        if pool_size is not None:
+            _pool_size = pool_size
+        if timeout is not None:
+            _timeout = timeout
+        _session = None
+
+
+def get_session():
+    """
+    所有 BaseApi 共用的 requests 会话，复用到微信服务器的 keep-alive 连接
+    """
+    global _session
+    if _session is None:
+        import requests
+        import requests.adapters
+
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=_pool_size)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+class ApiCall(object):
+    """
+    一次接口调用：记录指标（configure_metrics）并创建 span（configure_tracer），
+    两者都未启用时 enabled 为 False，调用方可以跳过
+
+    Usage:
+
+    >> with ApiCall('POST', url, bytes_out=len(body)) as call:
+    >>     response = session.post(url, data=body)
+    >>     call.bytes_in = len(response.content)
+    """
+    def __init__(self, method, url, bytes_out=0):
+        self.method = method
+        self.url = url
+        self.bytes_out = bytes_out
+        self.bytes_in = 0
+        self.metrics = get_metrics()
+        self.enabled = self.metrics is not None or get_tracer() is not None
+        self.endpoint = None
+        self.span = None
+        self._span_context = None
+        self.started_at = None
+
+    def __enter__(self):
+        if self.enabled:
+            self.endpoint = endpoint_name(self.url)
+            self._span_context = span('wechat.api', endpoint=self.endpoint, method=self.method)
+            self.span = self._span_context.__enter__()
+            self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if not self.enabled:
+            return False
+        elapsed = time.perf_counter() - self.started_at
+        if exc_value is None:
+            errcode = 0
+        elif isinstance(exc_value, WeChatApiError):
+            errcode = exc_value.code
+        else:
+            errcode = type(exc_value).__name__
+        if self.metrics is not None:
+            self.metrics.record(self.endpoint, elapsed, self.bytes_out, self.bytes_in, errcode)
+        self.span.set_attribute('errcode', errcode)
+        self.span.set_attribute('bytes_in', self.bytes_in)
+        self._span_context.__exit__(exc_type, exc_value, tb)
+        return False
 
 
 class BaseApi(ABC):
-    def post(self, url, params=None, data=None, content_type=None):
-        _ = self
-        headers = {
-            'Content-Type': 'application/json'
-        }
+    @property
+    def session(self):
+        return get_session()
+
+    def _limited(self, url, send):
+        """
+        配置了 ApiLimits 时，按 (appid, 接口) 取得令牌和配额后再调用 send
+        """
+        limits = get_limits()
+        if limits is None:
+            return send()
+        appid = getattr(self, 'appid', None)
+        endpoint = endpoint_name(url)
+        limits.acquire(appid, endpoint)
+        try:
+            return send()
+        except WeChatCircuitOpenError:
+            # 熔断器拒绝的调用没有发给微信，不占用每日配额
+            limits.refund(appid, endpoint)
+            raise
+        except WeChatApiError as e:
+            limits.record_error(appid, endpoint, e.code)
+            raise
+
+    def _guarded(self, url, send):
+        """
+        配置了 CircuitBreakers 时经过熔断器调用 send
+        """
+        breakers = get_breakers()
+        if breakers is None:
+            return send()
+        return breakers.call(url, send)
+
+    def _request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', _timeout)
+        return self._limited(url, lambda: self._guarded(url, lambda: self._send(method, url, **kwargs)))
 
-        response = requests.post(url, params=params, data=json.dumps(data), headers=headers)
-        # content_type = response.headers.get('Content-Type', 'application/json') if not content_type else content_type
-        # print(content_type)
-        # print('--> result:', response.text)
-        # if not content_type.startswith('application/json'):
-        #     return response
+    def _send(self, method, url, **kwargs):
+        """
+        发送请求并检查 errcode
+        """
+        data = kwargs.get('data')
+        call = ApiCall(method, url, bytes_out=len(data) if data is not None else 0)
+        if not call.enabled:
+            response = self.session.request(method, url, **kwargs)
+            return self._check_result(response)
 
+        with call:
+            response = self.session.request(method, url, **kwargs)
+            call.bytes_in = len(response.content)
+            return self._check_result(response)
+
+    def _check_result(self, response):
         result = json.loads(response.content.decode('utf-8'))
         errcode = result.get('errcode', 0)
         if errcode != 0:
             raise WeChatApiError(errcode, result.get('errmsg'))
         return result
 
+    def post(self, url, params=None, data=None, content_type=None):
+        headers = {
+            'Content-Type': 'application/json'
+        }
+        return self._request('POST', url, params=params, data=json.dumps(data), headers=headers)
+
     def get(self, url, params=None):
-        response = requests.get(url, params=params)
-        result = json.loads(response.content.decode('utf-8'))
-        errcode = result.get('errcode', 0)
-        if errcode != 0:
-            raise WeChatApiError(errcode, result.get('errmsg'))
-        return result
+        return self._request('GET', url, params=params)
+
+    def post_to_file(self, url, fileobj, params=None, data=None, chunk_size=65536):
+        """
+        调用返回二进制内容（如图片）的接口，把响应体分块写入 fileobj
+
+        微信在出错时返回 JSON，此时抛出 WeChatApiError
+        :return: 响应的 Content-Type
+        """
+        return self._limited(url, lambda: self._guarded(url, lambda: self._send_to_file(url, fileobj, params, data, chunk_size)))
+
+    def _send_to_file(self, url, fileobj, params, data, chunk_size):
+        headers = {
+            'Content-Type': 'application/json'
+        }
+        body = json.dumps(data)
+        with ApiCall('POST', url, bytes_out=len(body)) as call:
+            response = self.session.post(url, params=params, data=body, headers=headers, stream=True, timeout=_timeout)
+            try:
+                content_type = response.headers.get('Content-Type', '')
+                if content_type.startswith('application/json') or content_type.startswith('text/plain'):
+                    call.bytes_in = len(response.content)
+                    result = json.loads(response.content.decode('utf-8'))
+                    raise WeChatApiError(result.get('errcode', -1), result.get('errmsg'))
+                for chunk in response.iter_content(chunk_size):
+                    call.bytes_in += len(chunk)
+                    fileobj.write(chunk)
+            finally:
+                response.close()
+        return content_type
+
+    def post_binary(self, url, params=None, data=None):
+        buffer = io.BytesIO()
+        self.post_to_file(url, buffer, params=params, data=data)
+        return buffer.getvalue()
+
+    def data_crypt(self, key):
+        """
+        按 (appid, session_key) 复用解密实例
+        """
+        if not key:
+            raise ValueError('session_key is required')
+        appid = getattr(self, 'appid', None)
+        crypt = _data_crypts.get((appid, key))
+        if crypt is None:
+            from .enc.WXBizDataCrypt import DataCrypt
+
+            crypt = DataCrypt(appid, key)
+            _data_crypts.set((appid, key), crypt)
+        return crypt
 
     def _aes_decrypt(self, encdata, key=None, iv=None):
-        print('>>> encdata: %s' % encdata)
-        print('>>>     key: %s' % key)
-        print('>>>      iv: %s' % iv)
-        encdata = base64.decodestring(encdata.encode())
-        key = base64.decodestring(key.encode())
-        iv = base64.decodestring(iv.encode())
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        data = cipher.decrypt(encdata)
-        padding_length = data[-1]
-        data = data = data[:-padding_length]
-        return data.decode('utf-8')
+        return self.data_crypt(key).decrypt_bytes(encdata, iv).decode('utf-8')
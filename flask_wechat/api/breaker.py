@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+import threading
+import time
+from urllib import parse
+
+from .common import WeChatApiError, WeChatCircuitOpenError
+from .metrics import endpoint_name, get_metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# 视为服务端故障的错误码：-1 系统繁忙，SYSTEMERROR 商户平台系统错误
+FAILURE_ERRCODES = (-1, 'SYSTEMERROR')
+
+_breakers = None
+_hosts = {}
+
+
+def configure_breakers(breakers):
+    """
+    设置 BaseApi 和 BaseMerchantApi 使用的 CircuitBreakers，传入 None 关闭（默认）
+    """
+    global _breakers
+    _breakers = breakers
+
+
+def get_breakers():
+    return _breakers
+
+
+def host_name(url):
+    name = _hosts.get(url)
+    if name is None:
+        name = parse.urlsplit(url).netloc
+        if len(_hosts) < 1024:
+            _hosts[url] = name
+    return name
+
+
+class CircuitBreaker(object):
+    """
+    熔断器：在最近 window 秒内的调用数不少于 min_calls，且失败比例达到 failure_rate
+    或慢调用（超过 slow_call_duration 秒）比例达到 slow_call_rate 时打开；
+    打开期间直接拒绝调用，open_timeout 秒后进入半开状态，放行最多 half_open_calls 个探测调用，
+    探测全部成功则关闭，任一失败则重新打开
+    """
+    BUCKETS = 10
+
+    def __init__(self, name, failure_rate=0.5, slow_call_duration=5.0, slow_call_rate=0.8, min_calls=20,
+                 window=60, open_timeout=30, half_open_calls=1):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate = slow_call_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_timeout = open_timeout
+        self.half_open_calls = half_open_calls
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.opened_at = None
+        self.probes = 0
+        self.probe_successes = 0
+        self.rejected = 0
+        # 每个桶：[起始时间, 调用数, 失败数, 慢调用数]
+        self.buckets = [[0, 0, 0, 0] for _ in range(self.BUCKETS)]
+
+    def _bucket(self, now):
+        width = float(self.window) / self.BUCKETS
+        epoch = int(now // width)
+        bucket = self.buckets[epoch % self.BUCKETS]
+        if bucket[0] != epoch:
+            bucket[:] = [epoch, 0, 0, 0]
+        return bucket
+
+    def _totals(self, now):
+        width = float(self.window) / self.BUCKETS
+        oldest = int(now // width) - self.BUCKETS + 1
+        calls = failures = slow = 0
+        for epoch, bucket_calls, bucket_failures, bucket_slow in self.buckets:
+            if epoch >= oldest:
+                calls += bucket_calls
+                failures += bucket_failures
+                slow += bucket_slow
+        return calls, failures, slow
+
+    def _transition(self, state, now):
+        self.state = state
+        if state == OPEN:
+            self.opened_at = now
+        elif state == CLOSED:
+            self.buckets = [[0, 0, 0, 0] for _ in range(self.BUCKETS)]
+        self.probes = 0
+        self.probe_successes = 0
+        metrics = get_metrics()
+        if metrics is not None and hasattr(metrics, 'record_breaker_state'):
+            metrics.record_breaker_state(self.name, state)
+
+    def allow(self):
+        """
+        :return: 是否放行本次调用
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.state == OPEN and now - self.opened_at >= self.open_timeout:
+                self._transition(HALF_OPEN, now)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and self.probes < self.half_open_calls:
+                self.probes += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def release(self):
+        """
+        归还 allow 放行但没有实际执行的调用
+        """
+        with self.lock:
+            if self.state == HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+    def record(self, failed, elapsed):
+        with self.lock:
+            now = time.monotonic()
+            slow = elapsed >= self.slow_call_duration
+            if self.state == HALF_OPEN:
+                if failed or slow:
+                    self._transition(OPEN, now)
+                else:
+                    self.probe_successes += 1
+                    if self.probe_successes >= self.half_open_calls:
+                        self._transition(CLOSED, now)
+                return
+            if self.state == OPEN:
+                return
+
+            bucket = self._bucket(now)
+            bucket[1] += 1
+            bucket[2] += 1 if failed else 0
+            bucket[3] += 1 if slow else 0
+            calls, failures, slow_calls = self._totals(now)
+            if calls >= self.min_calls and (failures >= calls * self.failure_rate or slow_calls >= calls * self.slow_call_rate):
+                self._transition(OPEN, now)
+
+    def stats(self):
+        with self.lock:
+            calls, failures, slow = self._totals(time.monotonic())
+            return {'state': self.state, 'calls': calls, 'failures': failures, 'slow': slow, 'rejected': self.rejected}
+
+
+class CircuitBreakers(object):
+    """
+    按微信的主机（api.weixin.qq.com、api.mch.weixin.qq.com）和接口分别熔断：
+    主机的熔断器在整体故障时拒绝该主机的所有调用，接口的熔断器只拒绝单个出问题的接口
+
+    Usage:
+
+    >> configure_breakers(CircuitBreakers(failure_rate=0.5, open_timeout=30))
+    """
+    def __init__(self, **options):
+        """
+        :param options: 传给每个 CircuitBreaker 的参数
+        """
+        self.options = options
+        self.lock = threading.Lock()
+        self.breakers = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        WECHAT_CIRCUIT_BREAKER 为 CircuitBreaker 的参数字典
+        """
+        return cls(**config.get('WECHAT_CIRCUIT_BREAKER', {}))
+
+    def get(self, name):
+        with self.lock:
+            breaker = self.breakers.get(name)
+            if breaker is None:
+                breaker = self.breakers[name] = CircuitBreaker(name, **self.options)
+            return breaker
+
+    def call(self, url, send):
+        """
+        经过主机和接口的熔断器调用 send，熔断器打开时抛出 WeChatCircuitOpenError
+
+        网络异常、超时和 errcode -1（系统繁忙）计为失败，其他业务错误码计为成功
+        """
+        host = host_name(url)
+        breakers = [self.get(host), self.get('{}{}'.format(host, endpoint_name(url)))]
+        for index, breaker in enumerate(breakers):
+            if not breaker.allow():
+                # 已经放行的半开探测需要归还
+                for allowed in breakers[:index]:
+                    allowed.release()
+                raise WeChatCircuitOpenError(-1, 'circuit {} is open'.format(breaker.name))
+
+        failed = True
+        started_at = time.perf_counter()
+        try:
+            result = send()
+            failed = False
+            return result
+        except WeChatApiError as e:
+            failed = e.code in FAILURE_ERRCODES
+            raise
+        finally:
+            elapsed = time.perf_counter() - started_at
+            for breaker in breakers:
+                breaker.record(failed, elapsed)
+
+    def stats(self):
+        with self.lock:
+            breakers = list(self.breakers.values())
+        return {breaker.name: breaker.stats() for breaker in breakers}
@@ -1,7 +1,5 @@
 #!/usr/bin/env python
 
-from xml.etree import cElementTree as ET
-
 
 class WeChatEncryptError(Exception):
     def __init__(self, code):
@@ -16,6 +14,8 @@ class WeChatApiError(Exception):
 
 class WeChatMessage(object):
     def __init__(self, decrypted_xml):
+        from xml.etree import ElementTree as ET
+
         self.decrypted_xml = decrypted_xml
         document = ET.fromstring(decrypted_xml)
         self.document = document
@@ -25,3 +25,29 @@ class WeChatMessage(object):
         if node is None:
             raise AttributeError('Attribute {} does not exist'.format(key))
         return node.text
+
+
+class WeChatRateLimitError(WeChatApiError):
+    """
+    客户端限流拒绝的调用，code 与微信的错误码相同：45009 当日调用次数已用完，45011 调用频率超限
+    """
+    pass
+
+
+class WeChatCircuitOpenError(WeChatApiError):
+    """
+    熔断器打开，调用没有发出；code 为 -1（系统繁忙）
+    """
+    pass
+
+
+class WeChatSessionKeyError(WeChatApiError):
+    """
+    没有找到用户的 session_key，需要重新登录；
+    code 为 'session_key_not_found'，不会与微信的数字错误码（如 -41001 非法的 encodingAesKey）混淆
+    """
+    CODE = 'session_key_not_found'
+
+    def __init__(self, openid):
+        super(WeChatSessionKeyError, self).__init__(self.CODE, 'session_key of {} not found'.format(openid))
+        self.openid = openid
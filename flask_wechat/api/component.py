@@ -4,13 +4,14 @@ from urllib import parse
 
 from .base import BaseApi
 from .common import WeChatMessage, WeChatEncryptError
-from .enc import WXBizMsgCrypt
 
 
 class ComponentAppApi(BaseApi):
     def __init__(self, appid, secret, token, enc_key):
         self.appid = appid
         self.secret = secret
+        from .enc import WXBizMsgCrypt
+
         self.msg_crypt = WXBizMsgCrypt(token, enc_key, appid)
 
     def token_post(self, url, access_token, data=None, params=None):
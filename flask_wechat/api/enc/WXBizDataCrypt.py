@@ -1,26 +1,82 @@
-import base64
-import json
-from Crypto.Cipher import AES
-
-class WXBizDataCrypt:
-    def __init__(self, appId, sessionKey):
-        self.appId = appId
-        self.sessionKey = sessionKey
-
-    def decrypt(self, encryptedData, iv):
-        # base64 decode
-        sessionKey = base64.b64decode(self.sessionKey)
-        encryptedData = base64.b64decode(encryptedData)
-        iv = base64.b64decode(iv)
-
-        cipher = AES.new(sessionKey, AES.MODE_CBC, iv)
-
-        decrypted = json.loads(self._unpad(cipher.decrypt(encryptedData)))
-
-        if decrypted['watermark']['appid'] != self.appId:
-            raise Exception('Invalid Buffer')
-
-        return decrypted
-
-    def _unpad(self, s):
-        return s[:-ord(s[len(s)-1:])]
+#!/usr/bin/env python
+
+import base64
+import binascii
+import json
+
+from Crypto.Cipher import AES
+
+from ..common import WeChatApiError, WeChatEncryptError
+
+ILLEGAL_AES_KEY = -41001
+ILLEGAL_IV = -41002
+ILLEGAL_BUFFER = -41003
+DECODE_BASE64_ERROR = -41004
+
+BLOCK_SIZE = 16
+
+
+def _b64decode(data):
+    try:
+        return base64.b64decode(data)
+    except (binascii.Error, ValueError):
+        raise WeChatEncryptError(DECODE_BASE64_ERROR)
+
+
+class DataCrypt(object):
+    """
+    小程序开放数据（手机号、用户信息、运动步数等）解密
+
+    每个 session_key 只创建一次 AES 实例并重复使用：用 ECB 模式解密全部分组，
+    再与前一个密文分组（第一个分组与 iv）异或，结果与 CBC 解密相同，
+    因此不需要为每个 iv 重新创建 CBC 实例
+    """
+    def __init__(self, appid, session_key):
+        self.appid = appid
+        key = _b64decode(session_key)
+        if len(key) != BLOCK_SIZE:
+            raise WeChatEncryptError(ILLEGAL_AES_KEY)
+        self.cipher = AES.new(key, AES.MODE_ECB)
+
+    def decrypt_bytes(self, encrypted_data, iv):
+        encrypted = _b64decode(encrypted_data)
+        iv = _b64decode(iv)
+        if len(iv) != BLOCK_SIZE:
+            raise WeChatEncryptError(ILLEGAL_IV)
+        if not encrypted or len(encrypted) % BLOCK_SIZE:
+            raise WeChatEncryptError(ILLEGAL_BUFFER)
+
+        decrypted = self.cipher.decrypt(encrypted)
+        previous = iv + encrypted[:-BLOCK_SIZE]
+        length = len(decrypted)
+        data = (int.from_bytes(decrypted, 'big') ^ int.from_bytes(previous, 'big')).to_bytes(length, 'big')
+
+        # PKCS#7
+        padding_length = data[-1]
+        if not 1 <= padding_length <= BLOCK_SIZE or data[-padding_length:] != bytes([padding_length]) * padding_length:
+            raise WeChatEncryptError(ILLEGAL_BUFFER)
+        return data[:-padding_length]
+
+    def decrypt(self, encrypted_data, iv):
+        """
+        :return: 解密后的字典，包含 watermark；watermark 的 appid 不匹配时抛出 WeChatApiError
+        """
+        try:
+            result = json.loads(self.decrypt_bytes(encrypted_data, iv).decode('utf-8'))
+        except (UnicodeDecodeError, ValueError):
+            raise WeChatEncryptError(ILLEGAL_BUFFER)
+        watermark = result.get('watermark') if isinstance(result, dict) else None
+        if not watermark or watermark.get('appid') != self.appid:
+            raise WeChatApiError(400, 'appid does not match')
+        return result
+
+    def decrypt_many(self, payloads):
+        """
+        :param payloads: (encrypted_data, iv) 的迭代器
+        :return: 解密结果列表
+        """
+        return [self.decrypt(encrypted_data, iv) for encrypted_data, iv in payloads]
+
+
+# 兼容微信示例代码的类名
+WXBizDataCrypt = DataCrypt
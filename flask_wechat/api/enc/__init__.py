@@ -1,4 +1,20 @@
 #!/usr/bin/env python
 
-from .WXBizMsgCrypt import WXBizMsgCrypt
-from .WXBizDataCrypt import WXBizDataCrypt
+import importlib
+
+_LAZY_ATTRIBUTES = {
+    'WXBizMsgCrypt': '.WXBizMsgCrypt',
+    'DataCrypt': '.WXBizDataCrypt',
+    'WXBizDataCrypt': '.WXBizDataCrypt',
+}
+
+__all__ = ['WXBizMsgCrypt', 'DataCrypt', 'WXBizDataCrypt']
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
@@ -2,12 +2,14 @@
 
 import hashlib
 import hmac
+import logging
 import random
-import xml.etree.ElementTree as ET
-
-import requests
 
 from .common import WeChatApiError
+from .base import ApiCall
+from .breaker import get_breakers
+
+logger = logging.getLogger(__name__)
 
 
 class MerchantMessage(dict):
@@ -17,14 +19,18 @@ class MerchantMessage(dict):
 
     @classmethod
     def fromstring(cls, content):
+        import xml.etree.ElementTree as ET
+
         message = cls()
         xml = ET.fromstring(content)
-        for child in xml.getchildren():
+        for child in xml:
             message[child.tag] = child.text
         message.content = content
         return message
 
     def tostring(self):
+        import xml.etree.ElementTree as ET
+
         xml = ET.Element('xml')
         for k in self:
             node = ET.Element(k)
@@ -36,19 +42,74 @@ class MerchantMessage(dict):
 class BaseMerchantApi(object):
     RANDOM_ALT_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
 
-    def __init__(self, appid, merchant_id, key):
+    def __init__(self, appid, merchant_id, key, cert=None, pool_size=10, timeout=(3.05, 10)):
+        """
+        :param timeout: 秒，或 (连接超时, 读取超时)
+        """
         self.appid = appid
         self.merchant_id = merchant_id
         self.key = key
-
-    def request(self, url, params):
+        self.cert = cert
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+        self._cert_session = None
+
+    def _make_session(self, cert=None):
+        import requests
+        import requests.adapters
+
+        session = requests.Session()
+        session.cert = cert
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        return session
+
+    @property
+    def session(self):
+        """
+        复用 TCP/TLS 连接的会话，不携带商户证书
+        """
+        if self._session is None:
+            self._session = self._make_session()
+        return self._session
+
+    @property
+    def cert_session(self):
+        """
+        携带商户证书的会话，使用单独的连接池：不带证书建立的连接不会被退款等接口复用，
+        也避免每次退款都重新进行双向 TLS 握手
+        """
+        if self._cert_session is None:
+            assert self.cert is not None, 'merchant certificate is not configured'
+            self._cert_session = self._make_session(cert=self.cert)
+        return self._cert_session
+
+    def request(self, url, params, use_cert=False):
         params = self.fill_common_params(params)
         message = MerchantMessage(params)
-        data = message.tostring()
-        print('merchant call {}, data {}'.format(url, str(data)))
-        response = requests.post(url, data=data)
-        message = MerchantMessage.fromstring(response.content)
-        return self.check_message(message)
+        data = message.tostring().encode('utf-8')
+        if use_cert:
+            assert self.cert is not None, 'merchant certificate is required for {}'.format(url)
+            session = self.cert_session
+        else:
+            session = self.session
+
+        breakers = get_breakers()
+        if breakers is None:
+            return self._send(session, url, data)
+        return breakers.call(url, lambda: self._send(session, url, data))
+
+    def _send(self, session, url, data):
+        call = ApiCall('POST', url, bytes_out=len(data))
+        if not call.enabled:
+            response = session.post(url, data=data, timeout=self.timeout)
+            return self.check_message(MerchantMessage.fromstring(response.content))
+
+        with call:
+            response = session.post(url, data=data, timeout=self.timeout)
+            call.bytes_in = len(response.content)
+            return self.check_message(MerchantMessage.fromstring(response.content))
 
     def check_message(self, message):
         return_code = message['return_code']
@@ -57,7 +118,7 @@ class BaseMerchantApi(object):
         sign = self.sign(message)
         if not sign == message['sign']:
             # raise WeChatApiError('FAIL', '签名校验失败')
-            print('check signature of response message failed')
+            logger.warning('check signature of response message failed')
         if message['result_code'] == 'FAIL':
             raise WeChatApiError(message['err_code'], message['err_code_des'])
         for k in ['appid', 'mch_id', 'nonce_str', 'sign_type', 'sign', 'return_code', 'return_msg', 'result_code', 'result_msg', 'err_code', 'err_code_des']:
@@ -108,8 +169,8 @@ class OrdinaryMerchantApi(BaseMerchantApi):
     '''
     普通商户
     '''
-    def __init__(self, appid, merchant_id, key):
-        super(OrdinaryMerchantApi, self).__init__(appid, merchant_id, key)
+    def __init__(self, appid, merchant_id, key, cert=None, pool_size=10, timeout=(3.05, 10)):
+        super(OrdinaryMerchantApi, self).__init__(appid, merchant_id, key, cert=cert, pool_size=pool_size, timeout=timeout)
 
     def unifinedorder(self, body, out_trade_no, total_fee, spbill_create_ip, notify_url, trade_type, **kwargs):
         openid = kwargs.get('openid')
@@ -141,4 +202,45 @@ class OrdinaryMerchantApi(BaseMerchantApi):
             params['out_trade_no'] = out_trade_no
         else:
             assert False, 'both transaction_id and out_trade_no is not provided'
-        return self.request('https://api.mch.weixin.qq.com/pay/orderquery')
+        return self.request('https://api.mch.weixin.qq.com/pay/orderquery', params)
+
+    def refund(self, out_refund_no, total_fee, refund_fee, transaction_id=None, out_trade_no=None, **kwargs):
+        """
+        申请退款，需要商户证书
+        """
+        params = {
+            'out_refund_no': out_refund_no,
+            'total_fee': total_fee,
+            'refund_fee': refund_fee
+        }
+        if transaction_id is not None:
+            params['transaction_id'] = transaction_id
+        elif out_trade_no is not None:
+            params['out_trade_no'] = out_trade_no
+        else:
+            assert False, 'both transaction_id and out_trade_no is not provided'
+        for key in kwargs:
+            value = kwargs[key]
+            if value is None:
+                continue
+            params[key] = value
+        return self.request('https://api.mch.weixin.qq.com/secapi/pay/refund', params, use_cert=True)
+
+    def refundquery(self, refund_id=None, out_refund_no=None, transaction_id=None, out_trade_no=None, offset=None):
+        """
+        查询退款，四个单号任选其一，优先级 refund_id > out_refund_no > transaction_id > out_trade_no
+        """
+        params = {}
+        if refund_id is not None:
+            params['refund_id'] = refund_id
+        elif out_refund_no is not None:
+            params['out_refund_no'] = out_refund_no
+        elif transaction_id is not None:
+            params['transaction_id'] = transaction_id
+        elif out_trade_no is not None:
+            params['out_trade_no'] = out_trade_no
+        else:
+            assert False, 'one of refund_id, out_refund_no, transaction_id and out_trade_no should be provided'
+        if offset is not None:
+            params['offset'] = offset
+        return self.request('https://api.mch.weixin.qq.com/pay/refundquery', params)
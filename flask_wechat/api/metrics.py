@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+import bisect
+import threading
+from urllib import parse
+
+# 延迟直方图的桶上界（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = None
+_endpoints = {}
+
+
+def configure_metrics(metrics):
+    """
+    设置接收所有接口调用指标的对象，传入 None 关闭统计（默认）
+
+    Usage:
+
+    >> from flask_wechat.api.metrics import configure_metrics, InMemoryMetrics
+    >> metrics = InMemoryMetrics()
+    >> configure_metrics(metrics)
+    >>
+    >> @app.route('/metrics')
+    >> def metrics_view():
+    >>     return metrics.prometheus_text(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+    """
+    global _metrics
+    _metrics = metrics
+
+
+def get_metrics():
+    return _metrics
+
+
+def endpoint_name(url):
+    """
+    URL 的路径作为接口名，不包含 access_token 等查询参数
+    """
+    name = _endpoints.get(url)
+    if name is None:
+        name = parse.urlsplit(url).path or '/'
+        if len(_endpoints) < 1024:
+            _endpoints[url] = name
+    return name
+
+
+class _EndpointStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.errcodes = {}
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'latency_sum': self.latency_sum,
+            'buckets': list(zip(LATENCY_BUCKETS + (float('inf'),), self.buckets)),
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'errcodes': dict(self.errcodes),
+        }
+
+
+class InMemoryMetrics(object):
+    """
+    在进程内按接口汇总调用次数、延迟直方图、收发字节数和 errcode 分布，
+    可以直接读取（如测试中），也可以输出为 Prometheus 文本格式
+    """
+    def __init__(self, namespace='wechat_api'):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.breaker_transitions = {}
+
+    def record(self, endpoint, elapsed, bytes_out, bytes_in, errcode):
+        """
+        :param errcode: 成功为 0，接口错误为微信返回的错误码，网络等异常为异常类名
+        """
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = _EndpointStats()
+            stats.calls += 1
+            stats.latency_sum += elapsed
+            stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+            stats.bytes_out += bytes_out
+            stats.bytes_in += bytes_in
+            if errcode != 0:
+                errcode = str(errcode)
+                stats.errcodes[errcode] = stats.errcodes.get(errcode, 0) + 1
+
+    def record_breaker_state(self, name, state):
+        """
+        熔断器状态变化，按 (熔断器, 新状态) 计数
+        """
+        with self.lock:
+            key = (name, state)
+            self.breaker_transitions[key] = self.breaker_transitions.get(key, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {endpoint: stats.as_dict() for endpoint, stats in self.endpoints.items()}
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+            self.breaker_transitions = {}
+
+    def prometheus_text(self):
+        namespace = self.namespace
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name, kind, samples):
+            lines.append('# TYPE {}_{} {}'.format(namespace, name, kind))
+            lines.extend(samples)
+
+        family('calls_total', 'counter', [
+            '{}_calls_total{{endpoint="{}"}} {}'.format(namespace, endpoint, stats['calls'])
+            for endpoint, stats in sorted(snapshot.items())
+        ])
+        family('errors_total', 'counter', [
+            '{}_errors_total{{endpoint="{}",errcode="{}"}} {}'.format(namespace, endpoint, errcode, count)
+            for endpoint, stats in sorted(snapshot.items())
+            for errcode, count in sorted(stats['errcodes'].items())
+        ])
+        samples = []
+        for endpoint, stats in sorted(snapshot.items()):
+            cumulative = 0
+            for upper_bound, count in stats['buckets']:
+                cumulative += count
+                le = '+Inf' if upper_bound == float('inf') else repr(upper_bound)
+                samples.append('{}_latency_seconds_bucket{{endpoint="{}",le="{}"}} {}'.format(namespace, endpoint, le, cumulative))
+            samples.append('{}_latency_seconds_sum{{endpoint="{}"}} {}'.format(namespace, endpoint, stats['latency_sum']))
+            samples.append('{}_latency_seconds_count{{endpoint="{}"}} {}'.format(namespace, endpoint, stats['calls']))
+        family('latency_seconds', 'histogram', samples)
+        family('request_bytes_total', 'counter', [
+            '{}_request_bytes_total{{endpoint="{}"}} {}'.format(namespace, endpoint, stats['bytes_out'])
+            for endpoint, stats in sorted(snapshot.items())
+        ])
+        family('response_bytes_total', 'counter', [
+            '{}_response_bytes_total{{endpoint="{}"}} {}'.format(namespace, endpoint, stats['bytes_in'])
+            for endpoint, stats in sorted(snapshot.items())
+        ])
+        with self.lock:
+            transitions = sorted(self.breaker_transitions.items())
+        family('circuit_transitions_total', 'counter', [
+            '{}_circuit_transitions_total{{breaker="{}",state="{}"}} {}'.format(namespace, name, state, count)
+            for (name, state), count in transitions
+        ])
+
+        from .breaker import get_breakers
+
+        breakers = get_breakers()
+        if breakers is not None:
+            stats = sorted(breakers.stats().items())
+            family('circuit_state', 'gauge', [
+                '{}_circuit_state{{breaker="{}",state="{}"}} {}'.format(namespace, name, state, int(breaker['state'] == state))
+                for name, breaker in stats
+                for state in ('closed', 'open', 'half_open')
+            ])
+            family('circuit_rejected_total', 'counter', [
+                '{}_circuit_rejected_total{{breaker="{}"}} {}'.format(namespace, name, breaker['rejected'])
+                for name, breaker in stats
+            ])
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdMetrics(object):
+    """
+    每次调用通过 UDP 发送到 StatsD，接口名中的 / 替换为 .
+
+    prefix.endpoint.calls、prefix.endpoint.latency（毫秒）、prefix.endpoint.bytes_out、
+    prefix.endpoint.bytes_in、prefix.endpoint.errcode.<errcode>
+    """
+    def __init__(self, host='127.0.0.1', port=8125, prefix='wechat_api'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = None
+
+    @property
+    def socket(self):
+        if self._socket is None:
+            import socket
+
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        return self._socket
+
+    def record(self, endpoint, elapsed, bytes_out, bytes_in, errcode):
+        name = '{}.{}'.format(self.prefix, endpoint.strip('/').replace('/', '.'))
+        lines = [
+            '{}.calls:1|c'.format(name),
+            '{}.latency:{:.3f}|ms'.format(name, elapsed * 1000),
+            '{}.bytes_out:{}|c'.format(name, bytes_out),
+            '{}.bytes_in:{}|c'.format(name, bytes_in),
+        ]
+        if errcode != 0:
+            lines.append('{}.errcode.{}:1|c'.format(name, errcode))
+        self._send(lines)
+
+    def record_breaker_state(self, name, state):
+        name = name.replace('.', '_').replace('/', '.')
+        self._send(['{}.breaker.{}.{}:1|c'.format(self.prefix, name, state)])
+
+    def _send(self, lines):
+        try:
+            self.socket.sendto('\n'.join(lines).encode('utf-8'), self.address)
+        except OSError:
+            # 统计数据丢失不影响接口调用
+            pass
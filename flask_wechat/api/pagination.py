@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+
+def paginate(fetch_page, count=20, offset=0, prefetch=False):
+    """
+    按 offset/count 分页的接口的惰性迭代器
+
+    Usage:
+
+    >> def fetch_page(offset, count):
+    >>     return api.token_post(url, data={'offset': offset, 'count': count}).get('list')
+    >> for item in paginate(fetch_page, prefetch=True):
+    >>     pass
+
+    :param fetch_page: 接收 (offset, count)，返回当前页的列表
+    :param prefetch: 消费当前页时在后台线程中预取下一页
+    """
+    if not prefetch:
+        while True:
+            page = fetch_page(offset, count) or []
+            for item in page:
+                yield item
+            if len(page) < count:
+                return
+            offset += count
+
+    import contextvars
+    from concurrent.futures import ThreadPoolExecutor
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(contextvars.copy_context().run, fetch_page, offset, count)
+    try:
+        while True:
+            page = future.result() or []
+            future = None
+            if len(page) >= count:
+                offset += count
+                future = executor.submit(contextvars.copy_context().run, fetch_page, offset, count)
+            for item in page:
+                yield item
+            if future is None:
+                return
+    finally:
+        # 提前结束迭代时不再等待预取结果
+        if future is not None:
+            future.cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+import threading
+import time
+
+from ..cache import LocalCache
+from .common import WeChatRateLimitError
+
+
+class TokenBucket(object):
+    """
+    令牌桶，rate 为每秒补充的令牌数，capacity 为允许的突发量
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(rate if capacity is None else capacity)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def consume(self, tokens=1, block=True, timeout=None):
+        """
+        取出令牌，block 为 False 或等待超过 timeout 时返回 False
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return True
+                wait = (tokens - self.tokens) / self.rate
+            if not block:
+                return False
+            if deadline is not None:
+                if now + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+
+class RateLimiter(object):
+    """
+    按 key（通常是 appid）分别限速，同一进程内共享一个实例即可对所有调用方生效
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def bucket(self, key):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.capacity)
+                self.buckets[key] = bucket
+            return bucket
+
+    def acquire(self, key, block=True, timeout=None):
+        return self.bucket(key).consume(block=block, timeout=timeout)
+
+
+# 当日调用次数超限、调用频率超限
+QUOTA_EXCEEDED = 45009
+FREQUENCY_EXCEEDED = 45011
+
+_limits = None
+
+
+def configure_limits(limits):
+    """
+    设置所有 BaseApi 调用前检查的 ApiLimits，传入 None 关闭（默认）
+    """
+    global _limits
+    _limits = limits
+
+
+def get_limits():
+    return _limits
+
+
+def _quota_day(now=None):
+    """
+    微信的调用次数在北京时间 0 点清零
+    :return: (日期, 距离清零的秒数)
+    """
+    now = time.time() if now is None else now
+    local = now + 8 * 3600
+    return time.strftime('%Y%m%d', time.gmtime(local)), int(86400 - local % 86400)
+
+
+class QuotaCounter(object):
+    """
+    按 (appid, 接口, 日期) 计数的每日调用次数，保存在共享缓存中，多个进程和机器共同累计
+
+    cache 需要支持 add 和 inc（Flask-Caching 的 Redis/Memcached 后端，或 LocalCache）；
+    计数键在当天结束时过期
+    """
+    def __init__(self, cache=None, key_prefix='wechat_quota_'):
+        self.cache = LocalCache(default_timeout=86400) if cache is None else cache
+        self.key_prefix = key_prefix
+        self.lock = threading.Lock()
+        # 本进程已经创建过的计数键，避免每次调用都执行 add
+        self.created = set()
+
+    def _key(self, appid, endpoint, day):
+        return '{}{}_{}_{}'.format(self.key_prefix, appid, endpoint, day)
+
+    def incr(self, appid, endpoint):
+        day, ttl = _quota_day()
+        key = self._key(appid, endpoint, day)
+        if key not in self.created:
+            self.cache.add(key, 0, timeout=ttl + 60)
+            with self.lock:
+                if len(self.created) > 10000:
+                    self.created.clear()
+                self.created.add(key)
+        return self.cache.inc(key)
+
+    def decr(self, appid, endpoint):
+        """
+        归还一次没有发给微信的调用
+        """
+        day, _ = _quota_day()
+        key = self._key(appid, endpoint, day)
+        if self.cache.get(key):
+            self.cache.inc(key, delta=-1)
+
+    def get(self, appid, endpoint):
+        day, _ = _quota_day()
+        return self.cache.get(self._key(appid, endpoint, day)) or 0
+
+    def exhaust(self, appid, endpoint, limit):
+        """
+        微信返回 45009 时，当天剩余时间内直接按用完处理
+        """
+        day, ttl = _quota_day()
+        self.cache.set(self._key(appid, endpoint, day), limit, timeout=ttl + 60)
+
+
+class ApiLimits(object):
+    """
+    按 (appid, 接口) 的客户端限流和每日配额
+
+    - 频率：每个接口一个令牌桶，按 appid 分别计算，只在本进程内生效，多进程部署时按进程数分摊 rate
+    - 每日配额：计数保存在共享缓存中，用完后当天不再请求微信
+    - block 为 True 时等待令牌（最多 timeout 秒），False 时立即抛出 WeChatRateLimitError；
+      配额用完总是立即抛出
+
+    未配置的接口使用 default，default 为 None 时不限制。
+    配置后所有经过 BaseApi 的调用都会先取令牌，群发、批量生成小程序码等批量任务会自动按限额放慢
+
+    Usage:
+
+    >> limits = ApiLimits({
+    >>     '/cgi-bin/message/template/send': {'rate': 50, 'daily': 100000},
+    >>     '/wxa/getwxacodeunlimit': {'rate': 20, 'capacity': 40},
+    >> }, cache=cache)
+    >> configure_limits(limits)
+    >> limits.remaining(appid, '/cgi-bin/message/template/send')
+    """
+    def __init__(self, rules=None, default=None, cache=None, block=True, timeout=None, key_prefix='wechat_quota_'):
+        """
+        :param rules: {接口路径: {'rate': 每秒次数, 'capacity': 突发量, 'daily': 每日次数}}
+        """
+        self.rules = dict(rules or {})
+        self.default = default
+        self.block = block
+        self.timeout = timeout
+        self.quota = QuotaCounter(cache, key_prefix=key_prefix)
+        self.lock = threading.Lock()
+        self.limiters = {}
+
+    @classmethod
+    def from_config(cls, config, cache=None):
+        """
+        WECHAT_RATE_LIMITS、WECHAT_RATE_LIMIT_DEFAULT、WECHAT_RATE_LIMIT_BLOCK、WECHAT_RATE_LIMIT_TIMEOUT
+        """
+        return cls(
+            rules=config.get('WECHAT_RATE_LIMITS'),
+            default=config.get('WECHAT_RATE_LIMIT_DEFAULT'),
+            cache=cache,
+            block=config.get('WECHAT_RATE_LIMIT_BLOCK', True),
+            timeout=config.get('WECHAT_RATE_LIMIT_TIMEOUT')
+        )
+
+    def rule(self, endpoint):
+        return self.rules.get(endpoint, self.default)
+
+    def _limiter(self, endpoint, rule):
+        with self.lock:
+            limiter = self.limiters.get(endpoint)
+            if limiter is None:
+                limiter = RateLimiter(rule['rate'], rule.get('capacity'))
+                self.limiters[endpoint] = limiter
+            return limiter
+
+    def acquire(self, appid, endpoint):
+        """
+        调用接口前执行，超出限制时抛出 WeChatRateLimitError
+        """
+        rule = self.rule(endpoint)
+        if rule is None:
+            return
+        if rule.get('rate'):
+            limiter = self._limiter(endpoint, rule)
+            if not limiter.acquire(appid, block=self.block, timeout=self.timeout):
+                raise WeChatRateLimitError(FREQUENCY_EXCEEDED, 'rate limit of {} exceeded'.format(endpoint))
+        daily = rule.get('daily')
+        if daily:
+            if self.quota.incr(appid, endpoint) > daily:
+                raise WeChatRateLimitError(QUOTA_EXCEEDED, 'daily quota of {} exceeded'.format(endpoint))
+
+    def refund(self, appid, endpoint):
+        """
+        acquire 之后调用没有发出（如被熔断器拒绝）时归还每日配额
+        """
+        rule = self.rule(endpoint) or {}
+        if rule.get('daily'):
+            self.quota.decr(appid, endpoint)
+
+    def record_error(self, appid, endpoint, errcode):
+        """
+        微信返回配额用完时，当天剩余时间内不再请求该接口
+        """
+        if errcode != QUOTA_EXCEEDED:
+            return
+        rule = self.rule(endpoint) or {}
+        daily = rule.get('daily')
+        if daily:
+            self.quota.exhaust(appid, endpoint, daily)
+
+    def used(self, appid, endpoint):
+        return self.quota.get(appid, endpoint)
+
+    def remaining(self, appid, endpoint):
+        """
+        :return: 当天剩余的调用次数，未配置每日配额时返回 None
+        """
+        rule = self.rule(endpoint)
+        daily = rule.get('daily') if rule is not None else None
+        if not daily:
+            return None
+        return max(daily - self.used(appid, endpoint), 0)
+
+    def usage(self, appid):
+        """
+        :return: {接口: {'used': 已用次数, 'daily': 每日配额, 'remaining': 剩余次数}}，只包含配置了每日配额的接口
+        """
+        result = {}
+        for endpoint, rule in self.rules.items():
+            if rule.get('daily'):
+                used = self.used(appid, endpoint)
+                result[endpoint] = {'used': used, 'daily': rule['daily'], 'remaining': max(rule['daily'] - used, 0)}
+        return result
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import contextvars
+import time
+
+_tracer = None
+_current_span = contextvars.ContextVar('flask_wechat_span', default=None)
+
+
+def configure_tracer(tracer):
+    """
+    设置创建 span 的对象，传入 None 关闭追踪（默认）
+
+    tracer 需要实现 start_span(name, parent, attributes)，返回的 span 需要实现
+    set_attribute(key, value)、record_exception(error) 和 end()
+
+    Usage:
+
+    >> from opentelemetry import trace
+    >> from flask_wechat.api.tracing import configure_tracer, OpenTelemetryTracer
+    >> configure_tracer(OpenTelemetryTracer(trace.get_tracer('flask_wechat')))
+    """
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def current_span():
+    return _current_span.get()
+
+
+def copy_context():
+    """
+    在线程池中执行任务时用 copy_context().run(func, *args)，任务中的 span 以提交任务时的 span 为父节点
+    """
+    return contextvars.copy_context()
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class _ActiveSpan(object):
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span = None
+        self.token = None
+
+    def __enter__(self):
+        self.span = self.tracer.start_span(self.name, _current_span.get(), self.attributes)
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _current_span.reset(self.token)
+        if exc_value is not None:
+            self.span.record_exception(exc_value)
+        self.span.end()
+        return False
+
+
+def span(name, **attributes):
+    """
+    Usage:
+
+    >> with span('wechat.api', endpoint='/cgi-bin/token') as current:
+    >>     current.set_attribute('errcode', 0)
+
+    未配置 tracer 时返回不做任何事情的上下文
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _null_span
+    return _ActiveSpan(tracer, name, attributes)
+
+
+class RecordedSpan(object):
+    def __init__(self, tracer, name, parent, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.attributes = dict(attributes)
+        self.error = None
+        self.started_at = time.perf_counter()
+        self.ended_at = None
+
+    @property
+    def duration(self):
+        return None if self.ended_at is None else self.ended_at - self.started_at
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_exception(self, error):
+        self.error = error
+
+    def end(self):
+        self.ended_at = time.perf_counter()
+        self.tracer.spans.append(self)
+
+    def __repr__(self):
+        return '<RecordedSpan {} {}>'.format(self.name, self.attributes)
+
+
+class InMemoryTracer(object):
+    """
+    把结束的 span 保存在列表中，用于测试和调试
+    """
+    def __init__(self):
+        self.spans = []
+
+    def start_span(self, name, parent, attributes):
+        return RecordedSpan(self, name, parent, attributes)
+
+    def clear(self):
+        self.spans = []
+
+
+class OpenTelemetryTracer(object):
+    """
+    把 span 转发给 OpenTelemetry 的 tracer，父节点取自 flask_wechat 的当前 span，
+    没有时取自 OpenTelemetry 的当前上下文（如 Flask 的请求 span）
+    """
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def start_span(self, name, parent, attributes):
+        from opentelemetry import trace
+
+        context = trace.set_span_in_context(parent.span) if parent is not None else None
+        return _OpenTelemetrySpan(self.tracer.start_span(name, context=context, attributes=attributes))
+
+
+class _OpenTelemetrySpan(object):
+    def __init__(self, span):
+        self.span = span
+
+    def set_attribute(self, key, value):
+        self.span.set_attribute(key, value)
+
+    def record_exception(self, error):
+        from opentelemetry.trace import Status, StatusCode
+
+        self.span.record_exception(error)
+        self.span.set_status(Status(StatusCode.ERROR, str(error)))
+
+    def end(self):
+        self.span.end()
@@ -1,11 +1,24 @@
 #!/usr/bin/env python
 
+import base64
+import logging
 from abc import ABC, abstractmethod
-from urllib import parse
 
-from flask import request, redirect
+from flask import request, redirect, send_file
 
 from .api import SecretAppApi, AuthorizedAppApi
+from .api.app import wxa_page_path
+from .api.common import WeChatSessionKeyError
+from .api.ratelimit import RateLimiter, get_limits
+from .batch import chunked, run_bounded
+from .bulk import BulkMessageSender
+from .session import SessionKeyStore
+from .template import TemplateIndex
+from .token import TokenStore
+from .warmup import API_HOST, WarmupReport, log_report, warm_connections
+from .wxacode import WxaCodeBatch, WxaCodeCache, guess_mimetype
+
+logger = logging.getLogger(__name__)
 
 
 class BaseAppClient(ABC):
@@ -41,15 +54,141 @@ class BaseAppClient(ABC):
     def get_userinfo(self, openid, access_token):
         return self.app_api.get_user_info(openid, access_token)
 
-    def jscode2session(self, js_code):
-        return self.app_api.jscode2session(js_code)
+    @property
+    def session_key_store(self):
+        return None
 
-    def decrypt_data(self, encrypt_data, key=None, iv=None):
+    def jscode2session(self, js_code):
+        result = self.app_api.jscode2session(js_code)
+        if self.session_key_store is not None:
+            self.session_key_store.save_session(self.appid, result)
+        return result
+
+    def _get_session_key(self, key, openid):
+        if key is None:
+            if openid is None:
+                raise ValueError('key or openid is required')
+            if self.session_key_store is not None:
+                key = self.session_key_store.get(self.appid, openid)
+            if key is None:
+                raise WeChatSessionKeyError(openid)
+        return key
+
+    def decrypt_data(self, encrypt_data, key=None, iv=None, openid=None):
         """
         解密小程序消息
+
+        :param openid: 未传入 key 时，从 session_key_store 中取该用户最近一次登录的 session_key
         """
+        key = self._get_session_key(key, openid)
         return self.app_api.decrypt_data(encrypt_data, key=key, iv=iv)
 
+    def decrypt_many(self, payloads, key=None, openid=None):
+        """
+        用同一个 session_key 批量解密，如重放保存的运动步数、手机号数据
+
+        :param payloads: (encrypt_data, iv) 的迭代器
+        """
+        key = self._get_session_key(key, openid)
+        return self.app_api.decrypt_many(payloads, key)
+
+    def iter_followers(self, checkpoint=None, chunk_size=None):
+        """
+        逐页获取关注者，逐个产出 openid
+
+        :param checkpoint: 断点对象（如 FileCheckpoint），每页（或每块）消费完后保存位置，
+                           中断后再次调用从该位置继续，全部完成后清除
+        :param chunk_size: 指定时按块产出 openid 列表，可直接传给 iter_user_info 的分块；
+                           调用方取下一块时才保存上一块之后的位置，处理中断的块在恢复后重新产出
+        """
+        if chunk_size is not None:
+            return self._iter_follower_chunks(checkpoint, chunk_size)
+        return self._iter_followers(checkpoint)
+
+    def _iter_follower_pages(self, checkpoint):
+        """
+        产出 (获取本页的 next_openid, 本页起始序号, 本页 openid 列表, 下一页的 next_openid, total)
+        """
+        state = checkpoint.load() if checkpoint is not None else None
+        next_openid = state.get('next_openid') if state else None
+        start = state.get('skip', 0) if state else 0
+        while True:
+            result = self.app_api.get_followers(self.access_token, next_openid=next_openid)
+            openids = result.get('data', {}).get('openid', []) if result.get('count') else []
+            following = result.get('next_openid') if openids else None
+            yield next_openid, start, openids, following, result.get('total')
+            if not following:
+                return
+            next_openid, start = following, 0
+
+    def _iter_followers(self, checkpoint):
+        for _, start, openids, following, total in self._iter_follower_pages(checkpoint):
+            for openid in openids[start:]:
+                yield openid
+            if following and checkpoint is not None:
+                checkpoint.save({'next_openid': following, 'total': total})
+
+        if checkpoint is not None:
+            checkpoint.clear()
+
+    def _iter_follower_chunks(self, checkpoint, chunk_size):
+        chunk = []
+        for next_openid, start, openids, _, total in self._iter_follower_pages(checkpoint):
+            for index in range(start, len(openids)):
+                chunk.append(openids[index])
+                if len(chunk) < chunk_size:
+                    continue
+                yield chunk
+                chunk = []
+                # 调用方已处理完这一块，下一块从本页 index + 1 开始
+                if checkpoint is not None:
+                    checkpoint.save({'next_openid': next_openid, 'skip': index + 1, 'total': total})
+        if chunk:
+            yield chunk
+
+        if checkpoint is not None:
+            checkpoint.clear()
+
+    def batch_get_user_info(self, openids, lang='zh_CN'):
+        result = self.app_api.batch_get_user_info(self.access_token, openids, lang=lang)
+        return result.get('user_info_list', [])
+
+    def get_api_quota(self, cgi_path):
+        """
+        从微信查询接口的每日调用额度
+        :return: {'daily_limit': 每日额度, 'used': 已用次数, 'remain': 剩余次数}
+        """
+        return self.app_api.get_api_quota(self.access_token, cgi_path).get('quota')
+
+    def quota_remaining(self, endpoint):
+        """
+        客户端 ApiLimits 记录的当天剩余调用次数，不请求微信
+        :return: 未配置 ApiLimits 或该接口没有每日配额时返回 None
+        """
+        limits = get_limits()
+        return None if limits is None else limits.remaining(self.appid, endpoint)
+
+    def iter_user_info(self, openids, lang='zh_CN', chunk_size=100, max_workers=4, rate=10, limiter=None):
+        """
+        批量获取用户基本信息，openids 按 chunk_size 分块后并发请求，逐个产出用户信息
+
+        :param openids: openid 的迭代器，可以是 iter_followers 的结果
+        :param rate: 每秒请求次数，多个任务共享限额时应共用同一个 limiter
+        """
+        if limiter is None and rate is not None:
+            limiter = RateLimiter(rate)
+
+        def fetch(chunk):
+            if limiter is not None:
+                limiter.acquire(self.appid)
+            return self.batch_get_user_info(chunk, lang=lang)
+
+        for _, user_info_list, error in run_bounded(fetch, chunked(openids, chunk_size), max_workers=max_workers):
+            if error is not None:
+                raise error
+            for user_info in user_info_list:
+                yield user_info
+
     def send_weapp_message(self, touser, template_id, page, form_id, data, emphasis_keyword):
         """
         发送小程序模板消息
@@ -70,6 +209,7 @@ class BaseAppClient(ABC):
         发送公众号模板消息
         """
         mp_template_msg = {
+            'template_id': template_id,
             'appid': appid,
             'url': url,
             'miniprogram': miniprogram,
@@ -77,27 +217,116 @@ class BaseAppClient(ABC):
         }
         return self.app_api.send_uniform_message(self.access_token, touser, mp_template_msg=mp_template_msg)
 
+    def bulk_send_weapp_message(self, recipients, template_id, page=None, emphasis_keyword=None, **options):
+        """
+        群发小程序模板消息
+
+        :param recipients: (touser, data) 或 (touser, data, overrides) 的迭代器，
+                           overrides 中可以指定每个用户的 form_id、page 等参数
+        :param options: 传给 BulkMessageSender 的并发、限速和断点参数
+        :return: 按完成顺序产出 BulkSendResult
+        """
+        def send(touser, data, form_id=None, page=page, emphasis_keyword=emphasis_keyword):
+            return self.send_weapp_message(touser, template_id, page, form_id, data, emphasis_keyword)
+
+        sender = BulkMessageSender(send, key=self.appid, **options)
+        return sender.run(recipients)
+
+    def bulk_send_mp_message(self, recipients, template_id, appid=None, url=None, miniprogram=None, **options):
+        """
+        群发公众号模板消息，参数同 bulk_send_weapp_message
+        """
+        def send(touser, data, appid=appid, url=url, miniprogram=miniprogram):
+            return self.send_mp_message(touser, template_id, appid, url, miniprogram, data)
+
+        sender = BulkMessageSender(send, key=self.appid, **options)
+        return sender.run(recipients)
+
+    @property
+    def wxa_code_cache(self):
+        return None
+
     def get_wxa_code(self, path, params=None, width=None, auto_color=False, line_color=None, is_hyaline=False):
         """
         生成小程序码
         https://developers.weixin.qq.com/miniprogram/dev/api/getWXACode.html
         """
-        if not auto_color:
+        if auto_color:
             line_color = None
-        if params is not None:
-            path = '{}?{}'.format(path, parse.urlencode(params))
-        response = self.app_api.get_wxa_code(self.access_token, path, width=width, auto_color=auto_color, line_color=line_color, is_hyaline=is_hyaline)
-        return response.content
+        path = wxa_page_path(path, params)
+        return self.app_api.get_wxa_code(self.access_token, path, width=width, auto_color=auto_color, line_color=line_color, is_hyaline=is_hyaline)
+
+    def get_wxa_code_unlimit(self, scene, page=None, width=None, auto_color=False, line_color=None, is_hyaline=False, fileobj=None):
+        """
+        生成数量不限的小程序码
+        https://developers.weixin.qq.com/miniprogram/dev/api/getWXACodeUnlimit.html
+        """
+        if auto_color:
+            line_color = None
+        return self.app_api.get_wxa_code_unlimit(self.access_token, scene, page=page, width=width, auto_color=auto_color, line_color=line_color, is_hyaline=is_hyaline, fileobj=fileobj)
 
     def create_wxa_qrcode(self, path, params=None, width=None):
         """
         生成小程序二维码
         https://developers.weixin.qq.com/miniprogram/dev/api/createWXAQRCode.html
         """
-        if params is not None:
-            path = '{}?{}'.format(path, parse.urlencode(params))
-        response = self.app_api.create_wxa_qrcode(self.access_token, path, width=width)
-        return response.content
+        path = wxa_page_path(path, params)
+        return self.app_api.create_wxa_qrcode(self.access_token, path, width=width)
+
+    def _cached_wxa_code(self, kind, data, download):
+        cache = self.wxa_code_cache
+        assert cache is not None, 'WECHAT_WXA_CODE_CACHE_DIR is not configured'
+        key = cache.make_key(self.appid, kind, data)
+        return cache.get_or_fetch(key, download)
+
+    def get_wxa_code_file(self, path, params=None, width=None, auto_color=False, line_color=None, is_hyaline=False):
+        """
+        生成小程序码并缓存到本地磁盘，参数相同时直接返回缓存文件
+        :return: 图片文件路径
+        """
+        if auto_color:
+            line_color = None
+        path = wxa_page_path(path, params)
+        data = {'path': path, 'width': width, 'auto_color': auto_color, 'line_color': line_color, 'is_hyaline': is_hyaline}
+
+        def download(fileobj):
+            self.app_api.get_wxa_code(self.access_token, path, width=width, auto_color=auto_color, line_color=line_color, is_hyaline=is_hyaline, fileobj=fileobj)
+
+        return self._cached_wxa_code('wxacode', data, download)
+
+    def batch_wxa_codes(self, **options):
+        """
+        批量生成小程序码，参见 WxaCodeBatch
+        """
+        return WxaCodeBatch(self, **options)
+
+    def create_wxa_qrcode_file(self, path, params=None, width=None):
+        """
+        生成小程序二维码并缓存到本地磁盘
+        :return: 图片文件路径
+        """
+        path = wxa_page_path(path, params)
+        data = {'path': path, 'width': width}
+
+        def download(fileobj):
+            self.app_api.create_wxa_qrcode(self.access_token, path, width=width, fileobj=fileobj)
+
+        return self._cached_wxa_code('wxaqrcode', data, download)
+
+    def send_wxa_code(self, path, params=None, width=None, auto_color=False, line_color=None, is_hyaline=False):
+        """
+        Usage:
+
+        >> @app.route('/wxacode')
+        >> def wxacode_view():
+        >>     return wechat_app.send_wxa_code('pages/index', params={'id': 1})
+        """
+        file_path = self.get_wxa_code_file(path, params=params, width=width, auto_color=auto_color, line_color=line_color, is_hyaline=is_hyaline)
+        return send_file(file_path, mimetype=guess_mimetype(file_path))
+
+    def send_wxa_qrcode(self, path, params=None, width=None):
+        file_path = self.create_wxa_qrcode_file(path, params=params, width=width)
+        return send_file(file_path, mimetype=guess_mimetype(file_path))
 
 
 class SecretAppClient(BaseAppClient):
@@ -107,15 +336,33 @@ class SecretAppClient(BaseAppClient):
         self.cache = None
         self.flask_app = None
         self.cache_key_prefix = None
+        self.token_store = None
+        self._wxa_code_cache = None
+        self._session_key_store = None
+        self.warmup_connections = 2
+        self.warmup_report = None
         if app:
             self.init_app(app)
 
-    def init_app(self, app, appid=None, secret=None, cache=None):
+    def init_app(self, app, appid=None, secret=None, cache=None, token_snapshot=None):
+        """
+        :param token_snapshot: access_token 的持久化快照，如 SQLATokenSnapshot；
+                               未传入时可以用 WECHAT_TOKEN_SNAPSHOT_PATH 配置文件快照
+        """
         self.appid = appid
         self.cache = cache
         self.secret_app_api = SecretAppApi(appid, secret)
 
         self.cache_key_prefix = 'wechat_{}'.format(self.appid)
+        self.token_store = TokenStore.from_config(app.config, cache=cache, snapshot=token_snapshot)
+
+        wxa_code_cache_dir = app.config.get('WECHAT_WXA_CODE_CACHE_DIR')
+        if wxa_code_cache_dir is not None:
+            max_bytes = app.config.get('WECHAT_WXA_CODE_CACHE_SIZE', 1024 * 1024 * 1024)
+            self._wxa_code_cache = WxaCodeCache(wxa_code_cache_dir, max_bytes=max_bytes)
+
+        key_prefix = '{}_session_key_'.format(self.cache_key_prefix)
+        self._session_key_store = SessionKeyStore.from_config(app.config, cache=cache, key_prefix=key_prefix)
 
         if not hasattr(app, 'extensions'):
             app.extensions = {}
@@ -124,27 +371,67 @@ class SecretAppClient(BaseAppClient):
         app.extensions['wechat'] = wechat
         self.flask_app = app
 
+        self.warmup_connections = app.config.get('WECHAT_WARMUP_CONNECTIONS', 2)
+        if app.config.get('WECHAT_WARMUP', False):
+            self.warmup_report = self.warmup()
+            log_report(app, self.warmup_report)
+
+    def warmup(self, connections=None):
+        """
+        预热：建立到微信服务器的连接、获取 access_token 并初始化解密组件，
+        可以在 worker 接入流量之前调用；设置 WECHAT_WARMUP 时由 init_app 自动执行
+
+        :return: WarmupReport
+        """
+        connections = self.warmup_connections if connections is None else connections
+        report = WarmupReport('app {}'.format(self.appid))
+        report.step('connections', warm_connections, self.app_api.session, API_HOST, connections)
+        report.step('access_token', self._warmup_access_token)
+        report.step('crypto', self._warmup_crypto)
+        return report
+
+    def _warmup_access_token(self):
+        cache_key = '{}_access_token'.format(self.cache_key_prefix)
+        if self.token_store.get(cache_key) is not None:
+            return 'cached'
+        _ = self.access_token
+        return 'fetched'
+
+    def _warmup_crypto(self):
+        # 加载 AES 的 C 扩展，避免第一次 decrypt_data 时才加载
+        self.app_api.data_crypt(base64.b64encode(bytes(16)).decode())
+        return 'ready'
+
     @property
     def access_token(self):
         cache_key = '{}_access_token'.format(self.cache_key_prefix)
-        access_token = self.cache.get(cache_key)
-        if access_token is None:
+
+        def fetch():
             result = self.app_api.get_access_token()
-            access_token = result['access_token']
-            expires_in = result['expires_in']
-            self.cache.set(cache_key, access_token, timeout=expires_in)
-        return access_token
+            return result['access_token'], result['expires_in']
+
+        return self.token_store.get_or_fetch(cache_key, fetch)
 
     @property
     def app_api(self):
         return self.secret_app_api
 
+    @property
+    def wxa_code_cache(self):
+        return self._wxa_code_cache
+
+    @property
+    def session_key_store(self):
+        return self._session_key_store
+
 
 class AuthorizedAppClient(BaseAppClient):
     def __init__(self, appid, access_token, component_app_client):
         self.appid = appid
         self._access_token = access_token
+        self.component_app_client = component_app_client
         self.authorized_app_api = AuthorizedAppApi(appid, access_token, component_app_client)
+        self._template_indexes = {}
 
     @property
     def access_token(self):
@@ -181,27 +468,122 @@ class AuthorizedAppClient(BaseAppClient):
         response = self.app_api.get_all_private_template()
         return response
 
+    @property
+    def wxa_code_cache(self):
+        return getattr(self.component_app_client, 'wxa_code_cache', None)
+
+    @property
+    def session_key_store(self):
+        return getattr(self.component_app_client, 'session_key_store', None)
+
+    def jscode2session(self, js_code):
+        # ComponentAppClient.jscode2session 已保存 session_key
+        return self.app_api.jscode2session(js_code)
+
+    @property
+    def template_library_store(self):
+        return getattr(self.component_app_client, 'template_library_store', None)
+
     def get_template_library_list(self):
-        response = self.app_api.get_template_library_list()
-        return response
+        store = self.template_library_store
+        if store is None:
+            return self.app_api.get_template_library_list()
+        return store.get_library_list(lambda: list(self.app_api.iter_template_library_list(prefetch=True)))
+
+    def iter_template_library_list(self, prefetch=False):
+        return self.app_api.iter_template_library_list(prefetch=prefetch)
 
     def get_template_library_keywords_by_id(self, template_library_id):
-        response = self.app_api.get_template_library_keywords_by_id(template_library_id)
-        return response
+        store = self.template_library_store
+        if store is None:
+            return self.app_api.get_template_library_keywords_by_id(template_library_id)
+        return store.get_keywords(template_library_id, self.app_api.get_template_library_keywords_by_id)
 
     def add_template_with_keywords(self, template_library_id, keywords):
         """
         :param template_library_id:   模板库ID
-        :param keywords:    # 关键字ID列表
+        :param keywords:    # 关键字ID列表，也可以是关键词名称，名称从模板库缓存中查找对应ID
         :return: template_id
         """
+        if any(not isinstance(keyword, int) for keyword in keywords):
+            store = self.template_library_store
+            assert store is not None, 'keyword names require template library store of component client'
+            keywords = store.find_keyword_ids(template_library_id, keywords, self.app_api.get_template_library_keywords_by_id)
         response = self.app_api.add_template_with_keywords(template_library_id, keywords)
+        self.get_template_index('weapp').invalidate()
         return response.get('template_id')
 
     def del_template(self, template_id):
         response = self.app_api.del_template(template_id)
+        self.get_template_index('weapp').invalidate()
         return response
 
     def get_template_list(self):
         response = self.app_api.get_template_list()
         return response
+
+    def iter_template_list(self, prefetch=False):
+        return self.app_api.iter_template_list(prefetch=prefetch)
+
+    def get_template_index(self, kind='weapp'):
+        """
+        :param kind: weapp 小程序模板，mp 公众号模板
+        """
+        registry = getattr(self.component_app_client, 'template_indexes', None)
+        if registry is not None:
+            return registry.get(self.appid, kind)
+        if kind not in self._template_indexes:
+            self._template_indexes[kind] = TemplateIndex()
+        return self._template_indexes[kind]
+
+    def _fetch_templates(self, kind):
+        if kind == 'mp':
+            return self.get_all_private_template().get('template_list', [])
+        return self.get_template_list()
+
+    def resolve_template_id(self, title, keywords=None, kind='weapp'):
+        """
+        根据模板标题（和关键词）查找 template_id
+
+        索引过期时重建；找不到时重建一次，之后 miss_timeout 内同一标题不再重建。
+        模板列表接口失败时使用旧索引
+
+        :param title: 模板标题，也可以是索引中已有的 template_id
+        :return: template_id，找不到时抛出 KeyError
+        """
+        index = self.get_template_index(kind)
+        try:
+            rebuilt = False
+            if index.stale:
+                index.rebuild(self._fetch_templates(kind))
+                rebuilt = True
+            template_id = index.resolve(title, keywords=keywords)
+            if template_id is None and not rebuilt and not index.missed(title, keywords) and not index.backing_off:
+                index.rebuild(self._fetch_templates(kind))
+                template_id = index.resolve(title, keywords=keywords)
+        except Exception as e:
+            logger.warning('rebuild template index of %s failed: %s', self.appid, e)
+            index.rebuild_failed()
+            template_id = index.resolve(title, keywords=keywords)
+        if template_id is None:
+            index.record_miss(title, keywords)
+            raise KeyError('template {} does not exist in {} templates of {}'.format(title, kind, self.appid))
+        return template_id
+
+    def send_weapp_message_by_title(self, touser, title, page, form_id, data, emphasis_keyword, keywords=None):
+        """
+        按模板标题（和关键词）发送小程序模板消息，template_id 从模板索引中解析
+
+        Usage:
+
+        >> client.send_weapp_message_by_title(openid, '订单支付成功通知', 'pages/index', form_id, data, None)
+        """
+        template_id = self.resolve_template_id(title, keywords=keywords, kind='weapp')
+        return self.send_weapp_message(touser, template_id, page, form_id, data, emphasis_keyword)
+
+    def send_mp_message_by_title(self, touser, title, appid, url, miniprogram, data, keywords=None):
+        """
+        按模板标题（和关键词）发送公众号模板消息，template_id 从模板索引中解析
+        """
+        template_id = self.resolve_template_id(title, keywords=keywords, kind='mp')
+        return self.send_mp_message(touser, template_id, appid, url, miniprogram, data)
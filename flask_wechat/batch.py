@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+
+
+def chunked(items, size):
+    """
+    把迭代器按 size 分块，逐块产出列表
+    """
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run_bounded(func, items, max_workers=4, max_pending=None):
+    """
+    以有限并发对 items 逐个调用 func，按完成顺序产出 (item, result, error)
+
+    items 可以是任意迭代器，同一时间最多只有 max_pending 个任务在途，
+    因此不会把整批输入一次性读入内存；单个任务失败不会中断整批执行。
+    任务在提交时的 contextvars 上下文中执行，追踪的 span 等上下文会传递到工作线程
+    """
+    if max_pending is None:
+        max_pending = max_workers * 2
+    items = iter(items)
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < max_pending:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[executor.submit(contextvars.copy_context().run, func, item)] = item
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    error = future.exception()
+                    result = None if error is not None else future.result()
+                    yield item, result, error
+        finally:
+            # 调用方提前结束迭代时，放弃尚未开始的任务
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+import time
+from collections import namedtuple
+
+from .api.common import WeChatApiError
+from .api.ratelimit import RateLimiter
+from .batch import run_bounded
+
+
+class BulkSendResult(namedtuple('BulkSendResult', ['index', 'touser', 'result', 'error', 'attempts'])):
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class BulkMessageSender(object):
+    """
+    模板消息群发引擎
+
+    以有限并发发送，按 appid 限速；系统繁忙、频率超限和网络错误会退避重试，
+    用户拒收等单个用户的错误只记录在结果中，不会中断整批发送；
+    配额耗尽或 access_token 失效等错误会保存断点后抛出。
+
+    断点按接收人在输入中的序号记录，恢复时需要传入顺序相同的接收人序列。
+    只有发送成功和不可重试的失败记为完成；重试用尽后仍是临时错误的接收人记录在断点的
+    retry 列表中，恢复时重新发送。
+
+    Usage:
+
+    >> sender = BulkMessageSender(send, key=appid, checkpoint=FileCheckpoint('campaign.json'))
+    >> for result in sender.run(recipients):
+    >>     if not result.ok:
+    >>         pass
+    """
+    TRANSIENT_ERRCODES = (-1, 45011, 45047)
+    FATAL_ERRCODES = (40001, 42001, 45009, 48001)
+
+    def __init__(self, send, key=None, max_workers=8, rate=20, limiter=None, max_retries=3, backoff=0.5,
+                 checkpoint=None, checkpoint_every=100):
+        """
+        :param send: 接收 (touser, data, **overrides) 发送单条消息
+        :param key: 限速使用的 key，通常是 appid
+        :param rate: 每秒发送条数，传入 limiter 时忽略；多个任务共享限额时应共用同一个 limiter
+        """
+        self.send = send
+        self.key = key
+        self.max_workers = max_workers
+        self.limiter = limiter if limiter is not None or rate is None else RateLimiter(rate)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+
+    def is_transient(self, error):
+        """
+        系统繁忙、频率超限、熔断和网络错误可以稍后重试
+        """
+        if isinstance(error, WeChatApiError):
+            return error.code in self.TRANSIENT_ERRCODES
+        return error is not None
+
+    def _send_one(self, item):
+        _, recipient = item
+        touser, data = recipient[0], recipient[1]
+        overrides = recipient[2] if len(recipient) > 2 else {}
+        attempts = 0
+        while True:
+            attempts += 1
+            if self.limiter is not None:
+                self.limiter.acquire(self.key)
+            try:
+                return self.send(touser, data, **overrides), None, attempts
+            except WeChatApiError as e:
+                if e.code in self.FATAL_ERRCODES:
+                    raise
+                if not self.is_transient(e) or attempts > self.max_retries:
+                    return None, e, attempts
+            except Exception as e:
+                # 网络错误
+                if attempts > self.max_retries:
+                    return None, e, attempts
+            time.sleep(self.backoff * 2 ** (attempts - 1))
+
+    def run(self, recipients):
+        """
+        :param recipients: (touser, data) 或 (touser, data, overrides) 的迭代器
+        :return: 按完成顺序产出 BulkSendResult
+        """
+        state = self.checkpoint.load() if self.checkpoint is not None else None
+        state = state or {}
+        position = state.get('position', 0)
+        # position 之后已经处理过的序号，position 之前的序号都已处理
+        done = set(state.get('done', []))
+        # 重试用尽仍未发送成功的序号
+        retry = set(state.get('retry', []))
+
+        # 出现致命错误后不再提交新的发送，等待已提交的发送完成并记录结果后再抛出
+        fatal = []
+
+        def pending():
+            for index, recipient in enumerate(recipients):
+                if fatal:
+                    return
+                if index in retry or (index >= position and index not in done):
+                    yield index, recipient
+
+        def save():
+            if self.checkpoint is not None:
+                self.checkpoint.save({'position': position, 'done': sorted(done), 'retry': sorted(retry)})
+
+        completed = 0
+        try:
+            for (index, recipient), outcome, error in run_bounded(self._send_one, pending(), max_workers=self.max_workers):
+                if error is not None:
+                    if not fatal:
+                        fatal.append(error)
+                    continue
+                result, send_error, attempts = outcome
+
+                if self.is_transient(send_error):
+                    retry.add(index)
+                else:
+                    retry.discard(index)
+                if index >= position:
+                    done.add(index)
+                while position in done:
+                    done.remove(position)
+                    position += 1
+                completed += 1
+                if completed % self.checkpoint_every == 0:
+                    save()
+
+                yield BulkSendResult(index, recipient[0], result, send_error, attempts)
+        finally:
+            save()
+        if fatal:
+            raise fatal[0]
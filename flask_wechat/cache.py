@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    合并同一 key 的并发调用，只有第一个调用方真正执行，其余调用方等待并共享结果
+
+    Usage:
+
+    >> flight = SingleFlight()
+    >> result, shared = flight.do('key', lambda: expensive_call())
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call.event.set()
+        return call.result, False
+
+
+class LocalCache(object):
+    """
+    进程内的 LRU + TTL 缓存，接口与 Flask-Caching 的 cache 对象一致，
+    可以作为 cache 参数传给各个 Client
+
+    :param maxsize: 最多缓存的条目数，None 表示不限制
+    :param default_timeout: 默认过期时间（秒），0 表示永不过期
+    """
+    def __init__(self, maxsize=None, default_timeout=300):
+        self.maxsize = maxsize
+        self.default_timeout = default_timeout
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def _set_unlocked(self, key, value, timeout):
+        timeout = self.default_timeout if timeout is None else timeout
+        expires_at = time.time() + timeout if timeout else None
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def set(self, key, value, timeout=None):
+        with self.lock:
+            self._set_unlocked(key, value, timeout)
+        return True
+
+    def _get_unlocked(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None, None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self.entries[key]
+            return None, None
+        return value, expires_at
+
+    def add(self, key, value, timeout=None):
+        """
+        key 不存在时才写入
+        """
+        with self.lock:
+            if self._get_unlocked(key)[0] is not None:
+                return False
+            self._set_unlocked(key, value, timeout)
+        return True
+
+    def inc(self, key, delta=1):
+        """
+        原子地增加计数，保留原有的过期时间；key 不存在时按默认过期时间创建
+        """
+        with self.lock:
+            value, expires_at = self._get_unlocked(key)
+            if value is None:
+                self._set_unlocked(key, delta, None)
+                return delta
+            value += delta
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            return value
+
+    def delete(self, key):
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        return True
+
+    def __len__(self):
+        return len(self.entries)
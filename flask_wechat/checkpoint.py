@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+import json
+import os
+import tempfile
+
+
+class FileCheckpoint(object):
+    """
+    保存在本地 JSON 文件中的断点，写入时先写临时文件再原子替换，
+    进程在写入过程中退出也不会留下损坏的断点
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, state):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.checkpoint-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def clear(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
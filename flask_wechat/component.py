@@ -1,12 +1,22 @@
 #!/usr/bin/env python
 
+import base64
+import os
+import struct
 import traceback
 
 from flask import request, redirect, current_app
 
 from .api import ComponentAppApi
+from .api.common import WeChatEncryptError
+from .api.tracing import span
 from .app import AuthorizedAppClient
 from .exceptions import WechatException
+from .session import SessionKeyStore
+from .template import TemplateLibraryStore, TemplateIndexRegistry
+from .token import TokenStore, VERIFY_TICKET_EXPIRES_IN
+from .warmup import API_HOST, WarmupReport, log_report, warm_connections
+from .wxacode import WxaCodeCache
 
 
 class ComponentAppClient(object):
@@ -24,7 +34,14 @@ class ComponentAppClient(object):
         self.appid = None
         self.component_app_api = None
         self.cache = None
+        self.token_store = None
+        self.template_library_store = None
+        self.template_indexes = None
+        self.wxa_code_cache = None
+        self.session_key_store = None
         self.message_handlers = {}
+        self.warmup_connections = 2
+        self.warmup_report = None
         if app:
             self.init_app(app)
         self.flask_app = app
@@ -38,7 +55,7 @@ class ComponentAppClient(object):
         internal use only
         """
         cache_key = '{}_verify_ticket'.format(self.cache_key_prefix)
-        return self.cache.get(cache_key)
+        return self.token_store.get(cache_key)
 
     @verify_ticket.setter
     def verify_ticket(self, verify_ticket):
@@ -46,22 +63,23 @@ class ComponentAppClient(object):
         internal use only
         """
         cache_key = '{}_verify_ticket'.format(self.cache_key_prefix)
-        self.cache.set(cache_key, verify_ticket)
+        self.token_store.set(cache_key, verify_ticket, expires_in=VERIFY_TICKET_EXPIRES_IN)
 
     @property
     def access_token(self):
         cache_key = '{}_access_token'.format(self.cache_key_prefix)
-        access_token = self.cache.get(cache_key)
-        if access_token is None:
+
+        def fetch():
             result = self.component_app_api.get_access_token(self.verify_ticket)
-            access_token = result['component_access_token']
-            expires_in = result['expires_in']
-            self.cache.set(cache_key, access_token, timeout=expires_in)
+            return result['component_access_token'], result['expires_in']
 
-        # print('raw component_access_token: {}'.format(access_token))
-        return access_token
+        return self.token_store.get_or_fetch(cache_key, fetch)
 
-    def init_app(self, app, cache=None):
+    def init_app(self, app, cache=None, token_snapshot=None):
+        """
+        :param token_snapshot: component_access_token、verify_ticket 和授权方 access_token 的持久化快照，
+                               如 SQLATokenSnapshot；未传入时可以用 WECHAT_TOKEN_SNAPSHOT_PATH 配置文件快照
+        """
         self.appid = app.config['WECHAT_COMPONENT_APPID']
         secret = app.config['WECHAT_COMPONENT_SECRET']
         token = app.config['WECHAT_COMPONENT_TOKEN']
@@ -71,9 +89,28 @@ class ComponentAppClient(object):
 
         default_cache_key_prefix = 'wechat_component_{}_'.format(self.appid)
         self.cache_key_prefix = app.config.get('WECHAT_COMPONENT_CACHE_KEY_PREFIX', default_cache_key_prefix)
+        self.token_store = TokenStore.from_config(app.config, cache=cache, snapshot=token_snapshot)
 
         self.component_app_api = ComponentAppApi(self.appid, secret, token, encrypt_key)
 
+        self.template_library_store = TemplateLibraryStore(
+            cache,
+            timeout=app.config.get('WECHAT_TEMPLATE_LIBRARY_TIMEOUT', 86400),
+            refresh_after=app.config.get('WECHAT_TEMPLATE_LIBRARY_REFRESH_AFTER', 3600)
+        )
+        self.template_indexes = TemplateIndexRegistry(
+            timeout=app.config.get('WECHAT_TEMPLATE_INDEX_TIMEOUT', 3600),
+            miss_timeout=app.config.get('WECHAT_TEMPLATE_INDEX_MISS_TIMEOUT', 300)
+        )
+
+        wxa_code_cache_dir = app.config.get('WECHAT_WXA_CODE_CACHE_DIR')
+        if wxa_code_cache_dir is not None:
+            max_bytes = app.config.get('WECHAT_WXA_CODE_CACHE_SIZE', 1024 * 1024 * 1024)
+            self.wxa_code_cache = WxaCodeCache(wxa_code_cache_dir, max_bytes=max_bytes)
+
+        key_prefix = '{}session_key_'.format(self.cache_key_prefix)
+        self.session_key_store = SessionKeyStore.from_config(app.config, cache=cache, key_prefix=key_prefix)
+
         @self.message_handler('component_verify_ticket')
         def handle_component_verify_ticket(message):
             self.verify_ticket = message['ComponentVerifyTicket']
@@ -85,6 +122,51 @@ class ComponentAppClient(object):
         app.extensions['wechat'] = wechat
         self.flask_app = app
 
+        self.warmup_connections = app.config.get('WECHAT_WARMUP_CONNECTIONS', 2)
+        if app.config.get('WECHAT_WARMUP', False):
+            self.warmup_report = self.warmup()
+            log_report(app, self.warmup_report)
+
+    def warmup(self, connections=None):
+        """
+        预热：建立到微信服务器的连接、校验回调加解密并获取 component_access_token；
+        尚未收到 component_verify_ticket 时跳过获取 token
+
+        :return: WarmupReport
+        """
+        connections = self.warmup_connections if connections is None else connections
+        report = WarmupReport('component {}'.format(self.appid))
+        report.step('connections', warm_connections, self.component_app_api.session, API_HOST, connections)
+        report.step('callback_crypto', self._warmup_callback_crypto)
+        report.step('access_token', self._warmup_access_token)
+        return report
+
+    def _warmup_callback_crypto(self):
+        # 用回调的密钥加密一条消息再按回调流程解密，加载 AES 扩展并提前发现错误的 EncodingAESKey
+        # WXBizMsgCrypt.EncryptMsg 不兼容 Python 3，这里直接构造密文
+        from Crypto.Cipher import AES
+        from .api.enc.WXBizMsgCrypt import Prpcrypt
+
+        key = self.component_app_api.msg_crypt.key
+        content = b'<xml></xml>'
+        plaintext = os.urandom(16) + struct.pack('>I', len(content)) + content + self.appid.encode('utf-8')
+        padding_length = 32 - len(plaintext) % 32
+        plaintext += bytes([padding_length]) * padding_length
+        encrypted = AES.new(key, AES.MODE_CBC, key[:16]).encrypt(plaintext)
+        ret, _ = Prpcrypt(key).decrypt(base64.b64encode(encrypted), self.appid)
+        if ret != 0:
+            raise WeChatEncryptError(ret)
+        return 'ready'
+
+    def _warmup_access_token(self):
+        cache_key = '{}_access_token'.format(self.cache_key_prefix)
+        if self.token_store.get(cache_key) is not None:
+            return 'cached'
+        if self.verify_ticket is None:
+            return 'skipped: no verify_ticket'
+        _ = self.access_token
+        return 'fetched'
+
     def callback(self):
         """
         Usage:
@@ -96,24 +178,28 @@ class ComponentAppClient(object):
         >> def callback_view():
         >>     return wechat_component.callback()
         """
-        request_body = request.data.decode('utf-8')
-        current_app.logger.info('-'*100)
-        current_app.logger.info(request.url)
-        current_app.logger.info(request_body)
-        timestamp = request.args['timestamp']
-        nonce = request.args['nonce']
-        msg_signature = request.args['msg_signature']
-
-        message = self.component_app_api.callback(request_body, timestamp, nonce, msg_signature)
-        info_type = message['InfoType']
-
-        message_handlers = self.message_handlers.get(info_type, [])
-        for message_handler in message_handlers:
-            try:
-                message_handler(message)
-            except Exception as e:
-                current_app.logger.exception(e)
-                # traceback.print_exc()
+        with span('wechat.component.callback') as current:
+            request_body = request.data.decode('utf-8')
+            current_app.logger.info('-'*100)
+            current_app.logger.info(request.url)
+            current_app.logger.info(request_body)
+            timestamp = request.args['timestamp']
+            nonce = request.args['nonce']
+            msg_signature = request.args['msg_signature']
+
+            with span('wechat.component.decrypt'):
+                message = self.component_app_api.callback(request_body, timestamp, nonce, msg_signature)
+            info_type = message['InfoType']
+            current.set_attribute('info_type', info_type)
+
+            message_handlers = self.message_handlers.get(info_type, [])
+            for message_handler in message_handlers:
+                try:
+                    with span('wechat.handler', info_type=info_type, handler=getattr(message_handler, '__name__', repr(message_handler))):
+                        message_handler(message)
+                except Exception as e:
+                    current_app.logger.exception(e)
+                    # traceback.print_exc()
 
         return 'success'
 
@@ -161,13 +247,37 @@ class ComponentAppClient(object):
         return redirect(authorize_url)
 
     def authorized_response(self):
-        auth_code = request.args['auth_code']
-        result = self.component_app_api.query_auth(self.access_token, auth_code)
-        # print(json.dumps(result, indent=4, ensure_ascii=False))
-        return result.get('authorization_info')
+        with span('wechat.component.authorized_response'):
+            auth_code = request.args['auth_code']
+            result = self.component_app_api.query_auth(self.access_token, auth_code)
+            # print(json.dumps(result, indent=4, ensure_ascii=False))
+            authorization_info = result.get('authorization_info')
+            if authorization_info and authorization_info.get('authorizer_access_token'):
+                self._save_authorizer_token(authorization_info['authorizer_appid'], authorization_info)
+            return authorization_info
+
+    def _authorizer_token_key(self, authorizer_appid):
+        return '{}authorizer_{}_access_token'.format(self.cache_key_prefix, authorizer_appid)
+
+    def _save_authorizer_token(self, authorizer_appid, result):
+        self.token_store.set(self._authorizer_token_key(authorizer_appid), result['authorizer_access_token'], expires_in=result['expires_in'])
 
     def refresh_authorizer_token(self, authorizer_appid, authorizer_refresh_token):
-        return self.component_app_api.refresh_authorizer_token(self.access_token, authorizer_appid, authorizer_refresh_token)
+        result = self.component_app_api.refresh_authorizer_token(self.access_token, authorizer_appid, authorizer_refresh_token)
+        self._save_authorizer_token(authorizer_appid, result)
+        return result
+
+    def get_authorizer_access_token(self, authorizer_appid, authorizer_refresh_token):
+        """
+        从缓存或快照中取授权方的 access_token，都没有时用 refresh_token 刷新
+
+        刷新结果中的 authorizer_refresh_token 可能变化，需要自行保存时请直接调用 refresh_authorizer_token
+        """
+        def fetch():
+            result = self.component_app_api.refresh_authorizer_token(self.access_token, authorizer_appid, authorizer_refresh_token)
+            return result['authorizer_access_token'], result['expires_in']
+
+        return self.token_store.get_or_fetch(self._authorizer_token_key(authorizer_appid), fetch)
 
     def get_authorizer_info(self, authorizer_appid):
         result = self.component_app_api.get_authorizer_info(self.access_token, authorizer_appid)
@@ -208,7 +318,10 @@ class ComponentAppClient(object):
         return result
 
     def jscode2session(self, appid, js_code, grant_type='authorization_code'):
-        return self.component_app_api.jscode2session(self.access_token, appid, js_code, grant_type=grant_type)
+        result = self.component_app_api.jscode2session(self.access_token, appid, js_code, grant_type=grant_type)
+        if self.session_key_store is not None:
+            self.session_key_store.save_session(appid, result)
+        return result
 
     def user_authorize(self, appid, redirect_uri, scope, state, response_type='code'):
         authorize_url = self.component_app_api.get_user_authorize_url(appid, redirect_uri, scope, state, response_type=response_type)
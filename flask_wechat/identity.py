@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+from collections import namedtuple
+
+from .cache import LocalCache
+
+
+class Identity(namedtuple('Identity', ['unionid', 'accounts'])):
+    """
+    unionid 及其关联的所有 (appid, openid)
+    """
+    __slots__ = ()
+
+    def openid_for(self, appid):
+        for account_appid, openid in self.accounts:
+            if account_appid == appid:
+                return openid
+        return None
+
+
+class IdentityResolver(object):
+    """
+    跨应用的用户身份索引：(appid, openid) -> unionid，unionid -> 所有关联的 (appid, openid)
+
+    进程内 LRU 缓存在前，未命中时用一次数据库查询取回同一 unionid 下的全部记录；
+    用户模型的 update_token/update_user_info 写入 unionid 时会同步更新缓存。
+
+    Usage:
+
+    >> resolver = IdentityResolver(lambda: db.session, WeChatUser)
+    >> WeChatUser.identity_resolver = resolver
+    >> identity = resolver.resolve(appid, openid, unionid=session_result.get('unionid'))
+    """
+    def __init__(self, session_factory, model, maxsize=100000, timeout=3600):
+        """
+        :param session_factory: 返回 SQLAlchemy session 的函数
+        :param model: 继承 WeChatUserMixin 的用户模型
+        """
+        self.session_factory = session_factory
+        self.model = model
+        self.unionids = LocalCache(maxsize=maxsize, default_timeout=timeout)
+        self.identities = LocalCache(maxsize=maxsize, default_timeout=timeout)
+
+    def _load(self, appid=None, openid=None, unionid=None):
+        model = self.model
+        session = self.session_factory()
+        query = session.query(model.appid, model.openid, model.unionid)
+        if unionid is not None:
+            query = query.filter(model.unionid == unionid)
+        else:
+            # 先按 (appid, openid) 找到 unionid，再取同一 unionid 的所有记录，只有一次数据库往返
+            subquery = session.query(model.unionid).filter(model.appid == appid, model.openid == openid).scalar_subquery()
+            query = query.filter(model.unionid == subquery)
+        rows = query.all()
+        if not rows:
+            return None
+        identity = Identity(rows[0][2], tuple(sorted((row[0], row[1]) for row in rows)))
+        self._store(identity)
+        return identity
+
+    def _store(self, identity):
+        self.identities.set(identity.unionid, identity)
+        for account in identity.accounts:
+            self.unionids.set(account, identity.unionid)
+
+    def get_unionid(self, appid, openid):
+        unionid = self.unionids.get((appid, openid))
+        if unionid is not None:
+            return unionid
+        identity = self._load(appid=appid, openid=openid)
+        return identity.unionid if identity is not None else None
+
+    def resolve(self, appid, openid, unionid=None):
+        """
+        :param unionid: jscode2session、网页授权已返回 unionid 时传入，可以省去 unionid 查找
+        :return: Identity，用户没有 unionid 时返回 None
+        """
+        if unionid is None:
+            unionid = self.unionids.get((appid, openid))
+        if unionid is not None:
+            identity = self.identities.get(unionid)
+            if identity is not None and (appid, openid) in identity.accounts:
+                return identity
+            identity = self._load(unionid=unionid)
+            if identity is None or (appid, openid) not in identity.accounts:
+                # 新用户的记录尚未写入数据库
+                accounts = identity.accounts if identity is not None else ()
+                identity = Identity(unionid, tuple(sorted(accounts + ((appid, openid),))))
+                self._store(identity)
+            return identity
+        return self._load(appid=appid, openid=openid)
+
+    def record(self, appid, openid, unionid):
+        """
+        写入 (appid, openid) 与 unionid 的关联；unionid 的关联列表未缓存时留待下次 resolve 从数据库加载
+        """
+        previous = self.unionids.get((appid, openid))
+        if previous is not None and previous != unionid:
+            self.forget(appid, openid)
+        self.unionids.set((appid, openid), unionid)
+        identity = self.identities.get(unionid)
+        if identity is not None and (appid, openid) not in identity.accounts:
+            accounts = tuple(sorted(identity.accounts + ((appid, openid),)))
+            self.identities.set(unionid, Identity(unionid, accounts))
+
+    def forget(self, appid, openid):
+        unionid = self.unionids.get((appid, openid))
+        self.unionids.delete((appid, openid))
+        if unionid is None:
+            return
+        identity = self.identities.get(unionid)
+        if identity is not None:
+            accounts = tuple(account for account in identity.accounts if account != (appid, openid))
+            self.identities.set(unionid, Identity(unionid, accounts))
@@ -1,33 +1,165 @@
 #!/usr/bin/env python
 
+import heapq
+import itertools
+import logging
+import threading
 import time
+from collections import deque
 from urllib import parse
 
 from flask import request
 
 from .api import OrdinaryMerchantApi, MerchantMessage
+from .api.common import WeChatApiError
+from .api.tracing import span
+from .batch import run_bounded
+from .cache import SingleFlight
+from .warmup import MERCHANT_HOST, WarmupReport, log_report, warm_connections
+
+logger = logging.getLogger(__name__)
 
 
 class OrdinaryMerchantClient(object):
     def __init__(self, app=None):
+        self.payment_notify_handlers = []
+        self.cache = None
+        self.prepay_flight = SingleFlight()
+        self.prepay_cache_stats = {'hits': 0, 'misses': 0, 'shared': 0}
+        self._stats_lock = threading.Lock()
+        self.warmup_connections = 2
+        self.warmup_report = None
         if app:
             self.init_app(app)
-        self.payment_notify_handlers = []
 
-    def init_app(self, app, appid=None, trade_type='JSAPI'):
+    def init_app(self, app, appid=None, trade_type='JSAPI', cache=None):
         self.flask_app = app
         self.appid = appid
         self.trade_type = trade_type
         self.mch_id = app.config['WECHAT_MERCHANT_MCHID']
         key = app.config['WECHAT_MERCHANT_KEY']
-        self.merchant_api = OrdinaryMerchantApi(appid, self.mch_id, key)
+
+        cert = app.config.get('WECHAT_MERCHANT_CERT_PATH')
+        cert_key = app.config.get('WECHAT_MERCHANT_CERT_KEY_PATH')
+        if cert is not None and cert_key is not None:
+            cert = (cert, cert_key)
+        pool_size = app.config.get('WECHAT_MERCHANT_POOL_SIZE', 10)
+        timeout = app.config.get('WECHAT_MERCHANT_TIMEOUT', (3.05, 10))
+        self.batch_workers = app.config.get('WECHAT_MERCHANT_BATCH_WORKERS', 4)
+        self.merchant_api = OrdinaryMerchantApi(appid, self.mch_id, key, cert=cert, pool_size=pool_size, timeout=timeout)
+
+        self.cache = cache
+        default_cache_key_prefix = 'wechat_merchant_{}_'.format(self.mch_id)
+        self.cache_key_prefix = app.config.get('WECHAT_MERCHANT_CACHE_KEY_PREFIX', default_cache_key_prefix)
+        # prepay_id 有效期为 2 小时，预留 5 分钟余量；设置为 0 关闭缓存
+        self.prepay_cache_timeout = app.config.get('WECHAT_MERCHANT_PREPAY_CACHE_TIMEOUT', 6900)
+
+        self.warmup_connections = app.config.get('WECHAT_WARMUP_CONNECTIONS', 2)
+        if app.config.get('WECHAT_WARMUP', False):
+            self.warmup_report = self.warmup()
+            log_report(app, self.warmup_report)
+
+    def warmup(self, connections=None):
+        """
+        预热：建立到商户平台的连接（配置了证书时同时建立双向 TLS 连接），
+        并执行一次签名和 XML 编解码
+
+        :return: WarmupReport
+        """
+        connections = self.warmup_connections if connections is None else connections
+        report = WarmupReport('merchant {}'.format(self.mch_id))
+        report.step('connections', warm_connections, self.merchant_api.session, MERCHANT_HOST, connections)
+        if self.merchant_api.cert is not None:
+            report.step('cert_connections', warm_connections, self.merchant_api.cert_session, MERCHANT_HOST, connections)
+        report.step('sign', self._warmup_sign)
+        return report
+
+    def _warmup_sign(self):
+        message = MerchantMessage({'nonce_str': self.merchant_api.random_str()})
+        message['sign'] = self.merchant_api.sign(message)
+        MerchantMessage.fromstring(message.tostring())
+        return 'ready'
+
+    @property
+    def prepay_cache_enabled(self):
+        return self.cache is not None and self.prepay_cache_timeout > 0
+
+    def _prepay_cache_key(self, out_trade_no):
+        return '{}prepay_{}'.format(self.cache_key_prefix, out_trade_no)
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.prepay_cache_stats[name] += 1
+
+    def _load_prepay(self, out_trade_no, total_fee):
+        """
+        :return: 缓存的统一下单结果，不存在或金额不一致时返回 None
+        """
+        entry = self.cache.get(self._prepay_cache_key(out_trade_no))
+        if entry is None or (total_fee is not None and entry['total_fee'] != total_fee):
+            return None
+        return entry['result']
 
     def unifinedorder(self, body, out_trade_no, total_fee, spbill_create_ip, notify_url, **kwargs):
-        result = self.merchant_api.unifinedorder(body, out_trade_no, total_fee, spbill_create_ip, notify_url, self.trade_type, **kwargs)
+        result = self.unifinedorder_result(body, out_trade_no, total_fee, spbill_create_ip, notify_url, **kwargs)
         return result['prepay_id']
 
-    def get_payment_data(self, **kwargs):
-        # prepay_id = kwargs['prepay_id']
+    def unifinedorder_result(self, body, out_trade_no, total_fee, spbill_create_ip, notify_url, **kwargs):
+        """
+        统一下单，返回完整的预支付结果
+
+        启用缓存时按 (mch_id, out_trade_no) 缓存 prepay 结果和下单金额，金额相同时复用，
+        并发的重复下单只会向微信发起一次请求
+        """
+        def create_order():
+            result = self.merchant_api.unifinedorder(body, out_trade_no, total_fee, spbill_create_ip, notify_url, self.trade_type, **kwargs)
+            return dict(result)
+
+        if not self.prepay_cache_enabled:
+            return create_order()
+
+        result = self._load_prepay(out_trade_no, total_fee)
+        if result is not None:
+            self._count('hits')
+            return result
+
+        def create_and_cache_order():
+            # 等待期间可能已有其他进程写入缓存
+            cached = self._load_prepay(out_trade_no, total_fee)
+            if cached is not None:
+                return cached, True
+            created = create_order()
+            entry = {'total_fee': total_fee, 'result': created}
+            self.cache.set(self._prepay_cache_key(out_trade_no), entry, timeout=self.prepay_cache_timeout)
+            return created, False
+
+        (result, hit), shared = self.prepay_flight.do(
+            '{}_{}'.format(out_trade_no, total_fee), create_and_cache_order
+        )
+        self._count('shared' if shared else 'hits' if hit else 'misses')
+        return result
+
+    def get_cached_prepay(self, out_trade_no, total_fee=None):
+        """
+        :param total_fee: 传入时校验与下单金额一致，不一致时返回 None
+        """
+        if not self.prepay_cache_enabled:
+            return None
+        return self._load_prepay(out_trade_no, total_fee)
+
+    def get_payment_data(self, out_trade_no=None, total_fee=None, **kwargs):
+        """
+        生成小程序/JSAPI 调起支付的参数
+
+        未传入 prepay_id 时，根据 out_trade_no 从缓存中取出统一下单结果；
+        传入 total_fee 时校验与下单金额一致
+        """
+        if 'prepay_id' not in kwargs and out_trade_no is not None:
+            prepay = self.get_cached_prepay(out_trade_no, total_fee)
+            if prepay is None:
+                raise WeChatApiError('FAIL', 'prepay of order {} is not cached or total_fee does not match'.format(out_trade_no))
+            kwargs['prepay_id'] = prepay['prepay_id']
+
         result = {
             'appId': self.appid,
             'timeStamp': int(time.time()),
@@ -40,9 +172,11 @@ class OrdinaryMerchantClient(object):
         return result
 
     def payment_response(self):
-        message = self.merchant_api.payment_notify(request.data)
-        for handler in self.payment_notify_handlers:
-            handler(message['out_trade_no'], message)
+        with span('wechat.merchant.payment_notify'):
+            message = self.merchant_api.payment_notify(request.data)
+            for handler in self.payment_notify_handlers:
+                with span('wechat.handler', info_type='payment_notify', handler=getattr(handler, '__name__', repr(handler))):
+                    handler(message['out_trade_no'], message)
         result = MerchantMessage({'return_code': 'SUCCESS', 'return_msg': 'OK'})
         return result.tostring()
 
@@ -52,3 +186,234 @@ class OrdinaryMerchantClient(object):
 
     def orderquery(self, transaction_id=None, out_trade_no=None):
         return self.merchant_api.orderquery(transaction_id=transaction_id, out_trade_no=out_trade_no)
+
+    def batch_orderquery(self, out_trade_nos, max_workers=None):
+        """
+        批量查询订单，按完成顺序产出 (out_trade_no, result, error)
+        """
+        max_workers = self.batch_workers if max_workers is None else max_workers
+
+        def query(out_trade_no):
+            return self.orderquery(out_trade_no=out_trade_no)
+
+        return run_bounded(query, out_trade_nos, max_workers=max_workers)
+
+    def refund(self, out_refund_no, total_fee, refund_fee, transaction_id=None, out_trade_no=None, **kwargs):
+        return self.merchant_api.refund(
+            out_refund_no, total_fee, refund_fee,
+            transaction_id=transaction_id, out_trade_no=out_trade_no, **kwargs
+        )
+
+    def refundquery(self, refund_id=None, out_refund_no=None, transaction_id=None, out_trade_no=None, offset=None):
+        return self.merchant_api.refundquery(
+            refund_id=refund_id, out_refund_no=out_refund_no,
+            transaction_id=transaction_id, out_trade_no=out_trade_no, offset=offset
+        )
+
+    def batch_refund(self, refunds, max_workers=None):
+        """
+        批量退款，通过证书连接池以有限并发提交
+
+        Usage:
+
+        >> refunds = [{'out_refund_no': 'R1', 'out_trade_no': 'T1', 'total_fee': 100, 'refund_fee': 100}]
+        >> for refund, result, error in merchant_client.batch_refund(refunds):
+        >>     pass
+
+        :param refunds: 退款参数字典的迭代器，字段与 refund 的参数一致
+        :return: 按完成顺序产出 (refund, result, error)，error 为 None 表示成功
+        """
+        max_workers = self.batch_workers if max_workers is None else max_workers
+
+        def submit(refund):
+            return self.refund(**refund)
+
+        return run_bounded(submit, refunds, max_workers=max_workers)
+
+
+class OrderPollScheduler(object):
+    """
+    未支付订单的主动查询调度器
+
+    刚下单的订单查询间隔较短，随着查询次数增加逐渐拉长间隔；
+    收到支付通知或查询到终态后停止跟踪
+
+    Usage:
+
+    >> scheduler = OrderPollScheduler(merchant_client)
+    >> scheduler.track(out_trade_no)
+    >> @scheduler.final_state_handler
+    >> def handle_final_state(out_trade_no, result):
+    >>     pass
+    >> # 在定时任务或后台线程中
+    >> scheduler.poll_due()
+    """
+    FINAL_TRADE_STATES = ('SUCCESS', 'REFUND', 'CLOSED', 'REVOKED', 'PAYERROR')
+    DEFAULT_INTERVALS = (5, 10, 15, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self, merchant_client, intervals=None, max_age=86400, max_workers=None, batch_size=100):
+        self.merchant_client = merchant_client
+        self.intervals = self.DEFAULT_INTERVALS if intervals is None else tuple(intervals)
+        self.max_age = max_age
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.final_handlers = []
+
+        self.lock = threading.Lock()
+        self.heap = []
+        self.orders = {}
+        self.sequence = itertools.count()
+        self.stats = {'polls': 0, 'finished': 0, 'notified': 0, 'expired': 0, 'errors': 0}
+        self.started_at = time.time()
+        self.recent_polls = deque()
+
+        merchant_client.payment_notify_handler(self._handle_payment_notify)
+
+    def final_state_handler(self, func):
+        self.final_handlers.append(func)
+        return func
+
+    def _schedule(self, out_trade_no, due_at):
+        self.orders[out_trade_no]['due_at'] = due_at
+        heapq.heappush(self.heap, (due_at, next(self.sequence), out_trade_no))
+
+    def track(self, out_trade_no, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if out_trade_no in self.orders:
+                return
+            self.orders[out_trade_no] = {'created_at': now, 'attempts': 0, 'due_at': None}
+            self._schedule(out_trade_no, now + self.intervals[0])
+
+    def untrack(self, out_trade_no):
+        with self.lock:
+            return self.orders.pop(out_trade_no, None) is not None
+
+    def _handle_payment_notify(self, out_trade_no, message):
+        if self.untrack(out_trade_no):
+            with self.lock:
+                self.stats['notified'] += 1
+
+    def _discard_stale(self):
+        """
+        弹出堆顶已停止跟踪或已重新调度的堆项，调用方需持有 lock
+        """
+        while self.heap:
+            due_at, _, out_trade_no = self.heap[0]
+            order = self.orders.get(out_trade_no)
+            if order is not None and order['due_at'] == due_at:
+                return
+            heapq.heappop(self.heap)
+
+    def next_due_in(self, now=None):
+        """
+        :return: 距离下一个订单到期的秒数，没有跟踪中的订单时返回 None
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            self._discard_stale()
+            return max(0, self.heap[0][0] - now) if self.heap else None
+
+    def _pop_due(self, now):
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+                due_at, _, out_trade_no = heapq.heappop(self.heap)
+                order = self.orders.get(out_trade_no)
+                # 已停止跟踪或已重新调度的过期堆项
+                if order is None or order['due_at'] != due_at:
+                    continue
+                if now - order['created_at'] > self.max_age:
+                    self.orders.pop(out_trade_no)
+                    self.stats['expired'] += 1
+                    continue
+                order['due_at'] = None
+                due.append(out_trade_no)
+        return due
+
+    def _reschedule(self, out_trade_no, now):
+        with self.lock:
+            order = self.orders.get(out_trade_no)
+            if order is None or order['due_at'] is not None:
+                return
+            order['attempts'] += 1
+            interval = self.intervals[min(order['attempts'], len(self.intervals) - 1)]
+            self._schedule(out_trade_no, now + interval)
+
+    def _record_poll(self, now):
+        with self.lock:
+            self.stats['polls'] += 1
+            self.recent_polls.append(now)
+            while self.recent_polls and self.recent_polls[0] < now - 60:
+                self.recent_polls.popleft()
+
+    def poll_due(self, now=None):
+        """
+        批量查询所有到期订单，返回本次查询到终态的 {out_trade_no: result}
+
+        单个订单的查询或处理函数出错只记录日志；批量查询中途失败时，未处理的订单重新调度
+        """
+        now = time.time() if now is None else now
+        due = self._pop_due(now)
+        if not due:
+            return {}
+
+        finished = {}
+        remaining = set(due)
+        try:
+            results = self.merchant_client.batch_orderquery(due, max_workers=self.max_workers)
+            for out_trade_no, result, error in results:
+                remaining.discard(out_trade_no)
+                self._record_poll(now)
+                if error is not None:
+                    logger.warning('query order %s failed: %s', out_trade_no, error)
+                    with self.lock:
+                        self.stats['errors'] += 1
+                    self._reschedule(out_trade_no, now)
+                    continue
+
+                if result.get('trade_state') not in self.FINAL_TRADE_STATES:
+                    self._reschedule(out_trade_no, now)
+                    continue
+
+                if not self.untrack(out_trade_no):
+                    # 查询期间已收到支付通知
+                    continue
+                with self.lock:
+                    self.stats['finished'] += 1
+                finished[out_trade_no] = result
+                for handler in self.final_handlers:
+                    try:
+                        handler(out_trade_no, result)
+                    except Exception:
+                        logger.exception('final state handler of order %s failed', out_trade_no)
+                        with self.lock:
+                            self.stats['errors'] += 1
+        finally:
+            for out_trade_no in remaining:
+                self._reschedule(out_trade_no, now)
+        return finished
+
+    def run(self, stop_event, tick=1.0):
+        """
+        在后台线程中持续调度，直到 stop_event 被设置
+        """
+        while not stop_event.is_set():
+            try:
+                self.poll_due()
+            except Exception:
+                logger.exception('poll unpaid orders failed')
+            next_due_in = self.next_due_in()
+            stop_event.wait(tick if next_due_in is None else min(max(next_due_in, 0.01), tick))
+
+    def report(self):
+        now = time.time()
+        next_due_in = self.next_due_in(now)
+        with self.lock:
+            report = dict(self.stats)
+            report['queue_size'] = len(self.orders)
+            report['next_due_in'] = next_due_in
+            elapsed = max(now - self.started_at, 1e-6)
+            report['poll_rate'] = self.stats['polls'] / elapsed
+            report['recent_poll_rate'] = len([t for t in self.recent_polls if t >= now - 60]) / 60.0
+        return report
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+from .cache import LocalCache
+
+
+class SessionKeyStore(object):
+    """
+    小程序登录 session_key 的存储，按 (appid, openid) 保存最近一次登录的 session_key
+
+    后端可以是进程内的 LRU（默认）或配置的共享缓存；
+    条目在 timeout 后过期，同一用户再次登录时被新的 session_key 覆盖
+    """
+    def __init__(self, cache=None, timeout=86400, maxsize=100000, key_prefix='wechat_session_key_'):
+        self.cache = LocalCache(maxsize=maxsize, default_timeout=timeout) if cache is None else cache
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    @classmethod
+    def from_config(cls, config, cache=None, key_prefix='wechat_session_key_'):
+        """
+        WECHAT_SESSION_KEY_BACKEND 为 memory（默认）或 cache
+        """
+        backend = config.get('WECHAT_SESSION_KEY_BACKEND', 'memory')
+        assert backend in ('memory', 'cache'), 'unsupported session key backend {}'.format(backend)
+        assert backend == 'memory' or cache is not None, 'cache is required by session key backend cache'
+        return cls(
+            cache=cache if backend == 'cache' else None,
+            timeout=config.get('WECHAT_SESSION_KEY_TIMEOUT', 86400),
+            maxsize=config.get('WECHAT_SESSION_KEY_MAXSIZE', 100000),
+            key_prefix=key_prefix
+        )
+
+    def _key(self, appid, openid):
+        return '{}{}_{}'.format(self.key_prefix, appid, openid)
+
+    def set(self, appid, openid, session_key):
+        self.cache.set(self._key(appid, openid), session_key, timeout=self.timeout)
+
+    def get(self, appid, openid):
+        return self.cache.get(self._key(appid, openid))
+
+    def delete(self, appid, openid):
+        self.cache.delete(self._key(appid, openid))
+
+    def save_session(self, appid, result):
+        """
+        保存 jscode2session 的返回结果
+        """
+        if result.get('openid') and result.get('session_key'):
+            self.set(appid, result['openid'], result['session_key'])
+        return result
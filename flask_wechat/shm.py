@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+MAGIC = b'FWXSHM01'
+KEY_SIZE = 128
+MAX_PROBES = 16
+MAX_READ_RETRIES = 100
+
+# 文件头：magic, slots, value_size
+_HEADER = struct.Struct('<8sII')
+_SEQ = struct.Struct('<Q')
+# 槽位：seq, expires_at, key_len, value_len, key, value
+_SLOT = struct.Struct('<QdHH')
+_BODY = struct.Struct('<dHH')
+
+# expires_at 为 0 表示不过期，为 -1 表示已删除
+_NEVER = 0.0
+_DELETED = -1.0
+
+
+class SharedMemoryCache(object):
+    """
+    同一台机器上多个进程共享的 token 缓存，数据保存在 mmap 映射的文件中（可以放在 /dev/shm 下）
+
+    文件由固定数量、固定大小的槽位组成，按 key 的 crc32 开放寻址。
+    每个槽位带有序号（seqlock）：写入前后各加一，读取时序号为奇数或前后不一致则重读，
+    因此读取不加锁；写入很少（只在 token 刷新时），用文件锁在进程间互斥。
+
+    接口与 Flask-Caching 的 get/set/add/delete 相同，值只能是长度不超过 value_size 字节的字符串，
+    超出时 set 返回 False，调用方继续使用后面的缓存
+
+    Usage:
+
+    >> cache = SharedMemoryCache('/dev/shm/wechat_tokens')
+    >> cache.set('key', 'token', timeout=7200)
+    >> cache.get('key')
+    """
+    def __init__(self, path, slots=256, value_size=1024):
+        self.path = path
+        self.slots = slots
+        self.value_size = value_size
+        self.slot_size = (_SLOT.size + KEY_SIZE + value_size + 7) // 8 * 8
+        self.size = _HEADER.size + slots * self.slot_size
+        self.fd = None
+        self.mmap = None
+        self._open()
+
+    def _open(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._flock(True)
+        try:
+            if os.fstat(self.fd).st_size < self.size:
+                os.ftruncate(self.fd, self.size)
+            self.mmap = mmap.mmap(self.fd, self.size)
+            magic, stored_slots, stored_value_size = _HEADER.unpack_from(self.mmap, 0)
+            if magic != MAGIC:
+                _HEADER.pack_into(self.mmap, 0, MAGIC, self.slots, self.value_size)
+            elif (stored_slots, stored_value_size) != (self.slots, self.value_size):
+                raise ValueError('{} was created with slots={}, value_size={}'.format(self.path, stored_slots, stored_value_size))
+        finally:
+            self._flock(False)
+
+    def _check_fork(self):
+        """
+        fork 之后（如 gunicorn --preload）子进程与父进程共用同一个打开的文件，flock 无法互斥，
+        子进程第一次使用时重新打开文件和映射
+        """
+        if self.pid != os.getpid():
+            old_fd, old_mmap = self.fd, self.mmap
+            self._open()
+            old_mmap.close()
+            os.close(old_fd)
+
+    def _flock(self, locked):
+        import fcntl
+
+        fcntl.flock(self.fd, fcntl.LOCK_EX if locked else fcntl.LOCK_UN)
+
+    def _offset(self, index):
+        return _HEADER.size + index * self.slot_size
+
+    def _probe(self, key):
+        start = zlib.crc32(key)
+        for i in range(min(self.slots, MAX_PROBES)):
+            yield self._offset((start + i) % self.slots)
+
+    def _read(self, offset):
+        """
+        :return: (key, expires_at, value)，未使用过的槽位 key 为 b''
+        """
+        mm = self.mmap
+        for _ in range(MAX_READ_RETRIES):
+            seq, expires_at, key_len, value_len = _SLOT.unpack_from(mm, offset)
+            if seq & 1:
+                # 其他进程正在写入
+                time.sleep(0)
+                continue
+            start = offset + _SLOT.size
+            key = mm[start:start + key_len]
+            value = mm[start + KEY_SIZE:start + KEY_SIZE + value_len]
+            if _SEQ.unpack_from(mm, offset)[0] == seq:
+                return key, expires_at, value
+        return None
+
+    def _write(self, offset, key, expires_at, value):
+        mm = self.mmap
+        seq = _SEQ.unpack_from(mm, offset)[0]
+        # 写入进程中途退出时序号停留在奇数，从该序号继续
+        seq = seq if seq & 1 else seq + 1
+        _SEQ.pack_into(mm, offset, seq)
+        _BODY.pack_into(mm, offset + _SEQ.size, expires_at, len(key), len(value))
+        start = offset + _SLOT.size
+        mm[start:start + len(key)] = key
+        mm[start + KEY_SIZE:start + KEY_SIZE + len(value)] = value
+        _SEQ.pack_into(mm, offset, seq + 1)
+
+    def _encode_key(self, key):
+        key = key.encode('utf-8') if isinstance(key, str) else key
+        return key if len(key) <= KEY_SIZE else None
+
+    def get(self, key):
+        key = self._encode_key(key)
+        if key is None:
+            return None
+        self._check_fork()
+        now = time.time()
+        for offset in self._probe(key):
+            record = self._read(offset)
+            if record is None:
+                return None
+            stored_key, expires_at, value = record
+            if not stored_key:
+                return None
+            if stored_key == key:
+                if expires_at == _DELETED or (expires_at != _NEVER and expires_at <= now):
+                    return None
+                return value.decode('utf-8')
+        return None
+
+    def set(self, key, value, timeout=None):
+        """
+        :param timeout: 秒，0 或 None 表示不过期
+        """
+        return self._store(key, value, timeout, False)
+
+    def add(self, key, value, timeout=None):
+        """
+        key 不存在或已过期时写入，多个进程同时调用只有一个返回 True
+        """
+        return self._store(key, value, timeout, True)
+
+    def _store(self, key, value, timeout, only_absent):
+        key = self._encode_key(key)
+        if key is None or not isinstance(value, str):
+            return False
+        value = value.encode('utf-8')
+        if len(value) > self.value_size:
+            return False
+        self._check_fork()
+
+        with self.lock:
+            self._flock(True)
+            try:
+                now = time.time()
+                target = None
+                for offset in self._probe(key):
+                    stored_key, stored_expires_at, _ = self._read(offset) or (None, None, None)
+                    reusable = stored_expires_at == _DELETED or (stored_expires_at != _NEVER and stored_expires_at <= now)
+                    if stored_key == key:
+                        if only_absent and not reusable:
+                            return False
+                        target = offset
+                        break
+                    if not stored_key:
+                        target = offset if target is None else target
+                        break
+                    if target is None and reusable:
+                        target = offset
+                if target is None:
+                    return False
+                self._write(target, key, now + timeout if timeout else _NEVER, value)
+                return True
+            finally:
+                self._flock(False)
+
+    def delete(self, key):
+        key = self._encode_key(key)
+        if key is None:
+            return False
+        self._check_fork()
+        with self.lock:
+            self._flock(True)
+            try:
+                for offset in self._probe(key):
+                    stored_key, _, _ = self._read(offset) or (None, None, None)
+                    if not stored_key:
+                        return False
+                    if stored_key == key:
+                        # 保留 key 作为墓碑，不打断后续槽位的探测链
+                        self._write(offset, key, _DELETED, b'')
+                        return True
+                return False
+            finally:
+                self._flock(False)
+
+    def close(self):
+        self.mmap.close()
+        os.close(self.fd)
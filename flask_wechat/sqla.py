@@ -3,7 +3,84 @@
 import json
 import time
 
-from sqlalchemy import Column, String, Text, Integer
+from sqlalchemy import BigInteger, Column, Index, String, Text, Integer, and_, inspect, literal, or_, select, tuple_
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.ext.declarative import declared_attr
+
+from .batch import chunked
+
+
+def _upsert_statement(dialect_name, table, rows, keys):
+    columns = [column for column in rows[0] if column not in keys]
+    if dialect_name in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect_name == 'postgresql' else sqlite.insert
+        stmt = insert(table).values(rows)
+        if not columns:
+            return stmt.on_conflict_do_nothing(index_elements=list(keys))
+        return stmt.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={column: stmt.excluded[column] for column in columns}
+        )
+    if dialect_name == 'mysql':
+        stmt = mysql.insert(table).values(rows)
+        columns = columns or list(keys)
+        return stmt.on_duplicate_key_update({column: stmt.inserted[column] for column in columns})
+    return None
+
+
+def _merge_rows(session, model, rows, keys):
+    """
+    不支持 upsert 的数据库：一次查询已存在的行，再分别批量更新和批量插入
+    """
+    mapper = inspect(model)
+    primary_keys = [column.key for column in mapper.primary_key]
+    key_columns = [getattr(model, key) for key in keys]
+    key_values = [tuple(row[key] for key in keys) for row in rows]
+    existing = {}
+    query = session.query(*(key_columns + [getattr(model, key) for key in primary_keys]))
+    for record in query.filter(tuple_(*key_columns).in_(key_values)):
+        existing[tuple(record[:len(keys)])] = dict(zip(primary_keys, record[len(keys):]))
+
+    updates = []
+    inserts = []
+    for key_value, row in zip(key_values, rows):
+        if key_value in existing:
+            updates.append(dict(row, **existing[key_value]))
+        else:
+            inserts.append(row)
+    if updates:
+        session.bulk_update_mappings(mapper, updates)
+    if inserts:
+        session.bulk_insert_mappings(mapper, inserts)
+
+
+def bulk_upsert(session, model, rows, keys, chunk_size=500):
+    """
+    按 keys 批量插入或更新，每个分块在一个事务中提交
+
+    PostgreSQL、SQLite 和 MySQL 使用数据库的 upsert 语句，要求 keys 上有唯一索引；
+    其他数据库先查询已有的行，再批量更新和插入
+    :return: 写入的行数，同一分块内 keys 相同的行只计一次
+    """
+    dialect_name = session.get_bind().dialect.name
+    table = inspect(model).local_table
+    total = 0
+    for chunk in chunked(rows, chunk_size):
+        # 同一条语句中不能重复写入同一行，相同 keys 以最后一条为准
+        deduped = {tuple(row[key] for key in keys): row for row in chunk}
+        # 一条多行 INSERT 要求每行的列相同
+        groups = {}
+        for row in deduped.values():
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        for group in groups.values():
+            stmt = _upsert_statement(dialect_name, table, group, keys)
+            if stmt is None:
+                _merge_rows(session, model, group, keys)
+            else:
+                session.execute(stmt)
+        session.commit()
+        total += len(deduped)
+    return total
 
 
 class WeChatFuncInfo(object):
@@ -41,44 +118,113 @@ class WeChatAppMixin(object):
     business_info = Column(String(1024))
     qrcode_url = Column(String(1024))
     func_info = Column(String(128))
+    # 已授权权限集的位图，第 n 位表示权限 n（n < 63），由 func_info 同步维护；
+    # 按位与的条件用不上 B-tree 索引，因此不建索引
+    func_mask = Column(BigInteger)
     biz_info = Column(Text)
 
+    @classmethod
+    def wechat_table_args(cls):
+        """
+        授权方表的索引：appid 唯一，expires_at 用于扫描即将过期的 access_token
+
+        子类需要声明自己的 __table_args__ 时，可以与这些索引合并：
+
+        >> @declared_attr
+        >> def __table_args__(cls):
+        >>     return cls.wechat_table_args() + (Index('ix_wechat_app_name', 'name'),)
+        """
+        table_name = cls.__tablename__
+        return (
+            Index('uq_{}_appid'.format(table_name), 'appid', unique=True),
+            Index('ix_{}_expires_at'.format(table_name), 'expires_at'),
+        )
+
+    @declared_attr
+    def __table_args__(cls):
+        return cls.wechat_table_args()
+
+    REQUIRE_FUNCS = {
+        'gzh': [4, 2, 7, 8, 9, 24, 33],
+        'xcx': [17, 18, 25, 30],
+    }
+
     @property
     def require_func_list(self):
-        if self.biz_type == 'gzh':
-            funcs = [4, 2, 7, 8, 9, 24, 33]
-        elif self.biz_type == 'xcx':
-            funcs = [17, 18, 25, 30]
-        else:
-            funcs = []
+        return list(self.REQUIRE_FUNCS.get(self.biz_type, []))
+
+    # func_mask 能表示的权限集 ID 上限（不含），更大的 ID 只记录在 func_info 中
+    FUNC_MASK_BITS = 63
+
+    @classmethod
+    def _split_func_ids(cls, func_ids):
+        """
+        :return: (位图, 超出位图范围的 ID 列表)
+        """
+        mask = 0
+        extra_ids = []
+        for func_id in func_ids:
+            func_id = int(func_id)
+            if func_id < 0:
+                raise ValueError('invalid func id {}'.format(func_id))
+            if func_id < cls.FUNC_MASK_BITS:
+                mask |= 1 << func_id
+            else:
+                extra_ids.append(func_id)
+        return mask, extra_ids
+
+    @classmethod
+    def make_func_mask(cls, func_ids):
+        """
+        权限集 ID 列表转换为位图，ID 超出位图范围（>= 63）时抛出 ValueError
+        """
+        mask, extra_ids = cls._split_func_ids(func_ids)
+        if extra_ids:
+            raise ValueError('func ids {} do not fit in func_mask'.format(extra_ids))
+        return mask
+
+    @classmethod
+    def _stored_func_mask(cls, func_ids):
+        # 保存时超出范围的 ID 只记录在 func_info 中，查询时从 func_info 判断
+        return cls._split_func_ids(func_ids)[0]
 
-        return funcs
+    @classmethod
+    def _func_info_ids(cls, func_info):
+        return [item['funcscope_category']['id'] for item in func_info]
 
     def update_authorization_info(self, authorization_info):
         self.access_token = authorization_info['authorizer_access_token']
         self.expires_at = int(time.time()) + int(authorization_info['expires_in'])
         self.refresh_token = authorization_info['authorizer_refresh_token']
         if 'func_info' in authorization_info:
-            func_info = authorization_info['func_info']
-            self.func_info = ','.join([str(item['funcscope_category']['id']) for item in func_info])
+            func_ids = self._func_info_ids(authorization_info['func_info'])
+            self.func_info = ','.join([str(func_id) for func_id in func_ids])
+            self.func_mask = self._stored_func_mask(func_ids)
 
-    def update_authorizer_info(self, authorizer_info):
-        # print(json.dumps(authorizer_info, indent=4))
-        self.name = authorizer_info.get('nick_name')
-        self.avatar_url = authorizer_info.get('head_img')
-        self.service_type = authorizer_info['service_type_info']['id']
-        self.verify_type = authorizer_info['verify_type_info']['id']
-        self.user_name = authorizer_info['user_name']
-        self.principal_name = authorizer_info['principal_name']
-        self.business_info = authorizer_info['business_info']
-        self.qrcode_url = authorizer_info['qrcode_url']
+    @classmethod
+    def authorizer_info_columns(cls, authorizer_info):
+        """
+        把授权方信息转换为列名到值的字典
+        """
+        business_info = authorizer_info['business_info']
+        columns = {
+            'name': authorizer_info.get('nick_name'),
+            'avatar_url': authorizer_info.get('head_img'),
+            'service_type': authorizer_info['service_type_info']['id'],
+            'verify_type': authorizer_info['verify_type_info']['id'],
+            'user_name': authorizer_info['user_name'],
+            'principal_name': authorizer_info['principal_name'],
+            'business_info': business_info if isinstance(business_info, str) else json.dumps(business_info),
+            'qrcode_url': authorizer_info['qrcode_url'],
+        }
 
         if 'authorization_info' in authorizer_info:
             authorization_info = authorizer_info['authorization_info']
             # authorization_appid = authorization_info['authorization_appid'] # same as wechat_app.appid
-            func_info = authorization_info['func_info']
-            self.func_info = ','.join([str(item['funcscope_category']['id']) for item in func_info])
-            self.biz_type = 'xcx' if 'MiniProgramInfo' in authorizer_info else 'gzh'
+            func_ids = cls._func_info_ids(authorization_info['func_info'])
+            columns['func_info'] = ','.join([str(func_id) for func_id in func_ids])
+            columns['func_mask'] = cls._stored_func_mask(func_ids)
+            columns['biz_type'] = 'xcx' if 'MiniProgramInfo' in authorizer_info else 'gzh'
 
             biz_info = {}
             biz_info_keys = ['alias', 'signature']
@@ -86,10 +232,102 @@ class WeChatAppMixin(object):
                 if biz_info_key in authorizer_info:
                     biz_info[biz_info_key] = authorizer_info[biz_info_key]
             biz_info.update(authorizer_info.get('MiniProgramInfo', {}))
-            self.biz_info = json.dumps(biz_info)
+            columns['biz_info'] = json.dumps(biz_info)
+        return columns
+
+    def update_authorizer_info(self, authorizer_info):
+        # print(json.dumps(authorizer_info, indent=4))
+        for key, value in self.authorizer_info_columns(authorizer_info).items():
+            setattr(self, key, value)
+
+    @classmethod
+    def bulk_update_authorizer_info(cls, session, authorizer_infos, chunk_size=500):
+        """
+        批量写入授权方信息，按 appid 插入或更新，每 chunk_size 条提交一次
+
+        :param authorizer_infos: (appid, authorizer_info) 的迭代器
+        """
+        rows = (dict(cls.authorizer_info_columns(authorizer_info), appid=appid) for appid, authorizer_info in authorizer_infos)
+        return bulk_upsert(session, cls, rows, ('appid',), chunk_size=chunk_size)
 
     def get_func_info(self):
-        return [int(func_id) for func_id in self.func_info.split(',')]
+        # 解析结果按 func_info 的值缓存在实例上
+        cached = self.__dict__.get('_func_info_cache')
+        if cached is not None and cached[0] == self.func_info:
+            return list(cached[1])
+        func_ids = [int(func_id) for func_id in self.func_info.split(',')] if self.func_info else []
+        self._func_info_cache = (self.func_info, func_ids)
+        return list(func_ids)
+
+    def has_funcs(self, func_ids):
+        mask, extra_ids = self._split_func_ids(func_ids)
+        current = self.func_mask if self.func_mask is not None else self._stored_func_mask(self.get_func_info())
+        if current & mask != mask:
+            return False
+        if extra_ids:
+            granted = set(self.get_func_info())
+            return all(func_id in granted for func_id in extra_ids)
+        return True
+
+    @property
+    def missing_require_funcs(self):
+        granted = set(self.get_func_info())
+        return [func_id for func_id in self.require_func_list if func_id not in granted]
+
+    @classmethod
+    def get_by_appid(cls, session, appid):
+        return session.query(cls).filter(cls.appid == appid).first()
+
+    @classmethod
+    def query_expiring(cls, session, within=600, now=None):
+        """
+        access_token 将在 within 秒内过期的授权方，使用 expires_at 索引
+        """
+        now = int(time.time()) if now is None else now
+        return session.query(cls).filter(cls.expires_at < now + within).order_by(cls.expires_at)
+
+    @classmethod
+    def func_mask_filter(cls, func_ids):
+        """
+        SQL 条件：已授权 func_ids 中的所有权限，超出位图范围的 ID 按 func_info 匹配
+
+        >> session.query(WeChatApp).filter(WeChatApp.func_mask_filter([7]))
+        """
+        mask, extra_ids = cls._split_func_ids(func_ids)
+        conditions = [cls.func_mask.op('&')(mask) == mask]
+        padded = literal(',') + cls.func_info + literal(',')
+        for func_id in extra_ids:
+            conditions.append(padded.like('%,{},%'.format(func_id)))
+        return and_(*conditions)
+
+    @classmethod
+    def require_funcs_filter(cls):
+        """
+        SQL 条件：已授权所属类型（公众号/小程序）的全部必需权限
+        """
+        return or_(*[
+            and_(cls.biz_type == biz_type, cls.func_mask_filter(func_ids))
+            for biz_type, func_ids in cls.REQUIRE_FUNCS.items()
+        ])
+
+    @classmethod
+    def query_by_funcs(cls, session, func_ids):
+        return session.query(cls).filter(cls.func_mask_filter(func_ids))
+
+    @classmethod
+    def backfill_func_mask(cls, session, chunk_size=500):
+        """
+        为升级前保存的记录根据 func_info 计算 func_mask
+        """
+        total = 0
+        while True:
+            apps = session.query(cls).filter(cls.func_mask.is_(None), cls.func_info.isnot(None)).limit(chunk_size).all()
+            if not apps:
+                return total
+            for app in apps:
+                app.func_mask = app._stored_func_mask(app.get_func_info())
+            session.commit()
+            total += len(apps)
 
 
 class WeChatUserMixin(object):
@@ -110,28 +348,196 @@ class WeChatUserMixin(object):
     privilege = Column(String(64))
     unionid = Column(String(32))
 
+    @classmethod
+    def wechat_table_args(cls):
+        """
+        用户表的索引：
+
+        - (appid, openid) 唯一，用于登录查找，也是批量写入的冲突键
+        - (unionid, appid)，用于按 unionid 关联同一主体下的多个应用
+        - expires_at，用于扫描即将过期的网页授权 access_token
+
+        子类需要声明自己的 __table_args__ 时，可以与这些索引合并，参见 WeChatAppMixin.wechat_table_args
+        """
+        table_name = cls.__tablename__
+        return (
+            Index('uq_{}_appid_openid'.format(table_name), 'appid', 'openid', unique=True),
+            Index('ix_{}_unionid_appid'.format(table_name), 'unionid', 'appid'),
+            Index('ix_{}_expires_at'.format(table_name), 'expires_at'),
+        )
+
+    @declared_attr
+    def __table_args__(cls):
+        return cls.wechat_table_args()
+
+    @classmethod
+    def get_by_openid(cls, session, appid, openid):
+        return session.query(cls).filter(cls.appid == appid, cls.openid == openid).first()
+
+    @classmethod
+    def query_by_unionid(cls, session, unionid, appids=None):
+        query = session.query(cls).filter(cls.unionid == unionid)
+        if appids is not None:
+            query = query.filter(cls.appid.in_(appids))
+        return query
+
+    @classmethod
+    def query_expiring(cls, session, within=600, now=None):
+        """
+        access_token 将在 within 秒内过期的用户，使用 expires_at 索引
+        """
+        now = int(time.time()) if now is None else now
+        return session.query(cls).filter(cls.expires_at < now + within).order_by(cls.expires_at)
+
+    # 设置为 IdentityResolver 后，写入 unionid 时同步更新身份索引
+    identity_resolver = None
+
+    def _record_identity(self):
+        if self.identity_resolver is not None and self.unionid:
+            self.identity_resolver.record(self.appid, self.openid, self.unionid)
+
     def update_token(self, token):
         self.access_token = token.get('access_token')
         if isinstance(token.get('expires_in'), int):
             self.expires_at = int(time.time()) + int(token.get('expires_in'))
         self.refresh_token = token.get('refresh_token')
         self.scope = token.get('scope')
+        if token.get('unionid'):
+            self.unionid = token['unionid']
+            self._record_identity()
+
+    @classmethod
+    def user_info_columns(cls, user_info):
+        """
+        把用户信息转换为列名到值的字典，兼容小程序和网页授权
+        """
+        return {
+            'nickname': cls._get_value(user_info, ('nickname', 'nickName')),
+            'sex': cls._get_value(user_info, ('sex', 'gender')),
+            'province': user_info['province'],
+            'city': user_info['city'],
+            'country': user_info['country'],
+            'avatar_url': cls._get_value(user_info, ('headimgurl', 'avatarUrl')),
+            'privilege': ','.join(user_info.get('privilege', [])),
+            'language': user_info['language'],
+        }
 
     def update_user_info(self, user_info):
         """
         兼容小程序和网页授权
         """
-        self.nickname = self._get_value(user_info, ('nickname', 'nickName'))
-        self.sex = self._get_value(user_info, ('sex', 'gender'))
-        self.province = user_info['province']
-        self.city = user_info['city']
-        self.country = user_info['country']
-        self.avatar_url = self._get_value(user_info, ('headimgurl', 'avatarUrl'))
-        self.privilege = ','.join(user_info.get('privilege', []))
-        self.language = user_info['language']
+        for key, value in self.user_info_columns(user_info).items():
+            setattr(self, key, value)
+        unionid = self._get_value(user_info, ('unionid', 'unionId'))
+        if unionid:
+            self.unionid = unionid
+            self._record_identity()
+
+    @classmethod
+    def update_users_info(cls, users, user_info_list):
+        """
+        把批量获取的用户信息按 openid 更新到对应的用户对象上
+
+        未关注公众号的用户只返回 openid 和 unionid，只更新 unionid
+        :return: 被更新的用户对象列表
+        """
+        users_by_openid = {user.openid: user for user in users}
+        updated = []
+        for user_info in user_info_list:
+            user = users_by_openid.get(user_info.get('openid'))
+            if user is None:
+                continue
+            if user_info.get('subscribe', 1):
+                user.update_user_info(user_info)
+            if user_info.get('unionid'):
+                user.unionid = user_info['unionid']
+                user._record_identity()
+            updated.append(user)
+        return updated
+
+    @classmethod
+    def bulk_update_user_info(cls, session, appid, user_info_list, chunk_size=500):
+        """
+        批量写入用户信息，按 (appid, openid) 插入或更新，每 chunk_size 条提交一次
+
+        :param user_info_list: 用户信息的迭代器，如 iter_user_info 的结果
+        """
+        def rows():
+            for user_info in user_info_list:
+                row = {'appid': appid, 'openid': user_info['openid']}
+                if user_info.get('subscribe', 1):
+                    row.update(cls.user_info_columns(user_info))
+                if user_info.get('unionid'):
+                    row['unionid'] = user_info['unionid']
+                    if cls.identity_resolver is not None:
+                        cls.identity_resolver.record(appid, row['openid'], row['unionid'])
+                yield row
+
+        return bulk_upsert(session, cls, rows(), ('appid', 'openid'), chunk_size=chunk_size)
 
     @classmethod
     def _get_value(cls, user_info, keys):
         for k in keys:
             if k in user_info:
                 return user_info[k]
+
+
+class WeChatTokenMixin(object):
+    """
+    token 快照表，配合 SQLATokenSnapshot 使用，在重启后恢复 access_token 和 verify_ticket
+    """
+    key = Column(String(128), nullable=False)
+    value = Column(String(1024))
+    expires_at = Column(Integer)
+
+    @classmethod
+    def wechat_table_args(cls):
+        """
+        key 唯一，也是写入时的冲突键
+        """
+        table_name = cls.__tablename__
+        return (
+            Index('uq_{}_key'.format(table_name), 'key', unique=True),
+        )
+
+    @declared_attr
+    def __table_args__(cls):
+        return cls.wechat_table_args()
+
+    @classmethod
+    def _token_engine(cls, session):
+        # 快照在刷新 token 时读写，使用独立的连接和事务，不提交也不读取调用方 session 中未提交的修改
+        return session.get_bind().engine
+
+    @classmethod
+    def load_token(cls, session, key):
+        """
+        :return: (value, expires_at)，不存在时返回 None
+        """
+        table = inspect(cls).local_table
+        with cls._token_engine(session).connect() as connection:
+            row = connection.execute(
+                select(table.c['value'], table.c['expires_at']).where(table.c['key'] == key)
+            ).first()
+        return tuple(row) if row is not None else None
+
+    @classmethod
+    def save_token(cls, session, key, value, expires_at):
+        table = inspect(cls).local_table
+        row = {'key': key, 'value': value, 'expires_at': expires_at}
+        with cls._token_engine(session).begin() as connection:
+            stmt = _upsert_statement(connection.dialect.name, table, [row], ('key',))
+            if stmt is not None:
+                connection.execute(stmt)
+                return
+            updated = connection.execute(
+                table.update().where(table.c['key'] == key).values(value=value, expires_at=expires_at)
+            )
+            if updated.rowcount == 0:
+                connection.execute(table.insert().values(row))
+
+    @classmethod
+    def delete_token(cls, session, key):
+        table = inspect(cls).local_table
+        with cls._token_engine(session).begin() as connection:
+            connection.execute(table.delete().where(table.c['key'] == key))
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+import re
+import threading
+import time
+
+from .cache import LocalCache, SingleFlight
+
+
+class TemplateLibraryStore(object):
+    """
+    小程序模板库（标题列表和关键词库）的共享缓存
+
+    模板库是微信全局数据，与授权方无关，因此由第三方平台的所有授权方共用。
+    数据先读进程内缓存，再读配置的共享缓存，都没有时才调用接口；
+    超过 refresh_after 后由一个调用方刷新，刷新失败时在 timeout 内继续使用旧数据
+    """
+    def __init__(self, cache=None, timeout=86400, refresh_after=3600, key_prefix='wechat_template_library_'):
+        self.cache = cache
+        self.timeout = timeout
+        self.refresh_after = refresh_after
+        self.key_prefix = key_prefix
+        self.local = LocalCache(default_timeout=timeout)
+        self.flight = SingleFlight()
+
+    def _load(self, key):
+        entry = self.local.get(key)
+        if entry is None and self.cache is not None:
+            entry = self.cache.get(key)
+            if entry is not None:
+                remaining = self.timeout - (time.time() - entry['fetched_at'])
+                if remaining <= 0:
+                    return None
+                self.local.set(key, entry, timeout=remaining)
+        return entry
+
+    def _refresh(self, key, fetch):
+        entry = self._load(key)
+        if entry is not None and time.time() - entry['fetched_at'] < self.refresh_after:
+            # 等待期间已被其他调用方刷新
+            return entry
+        entry = {'value': fetch(), 'fetched_at': time.time()}
+        self.local.set(key, entry, timeout=self.timeout)
+        if self.cache is not None:
+            self.cache.set(key, entry, timeout=self.timeout)
+        return entry
+
+    def _get(self, name, fetch):
+        key = '{}{}'.format(self.key_prefix, name)
+        entry = self._load(key)
+        if entry is not None and time.time() - entry['fetched_at'] < self.refresh_after:
+            return entry['value']
+
+        try:
+            refreshed, _ = self.flight.do(key, lambda: self._refresh(key, fetch))
+        except Exception:
+            if entry is None:
+                raise
+            return entry['value']
+        return refreshed['value']
+
+    def get_library_list(self, fetch):
+        """
+        :param fetch: 无参数，返回完整模板库标题列表
+        """
+        return self._get('list', fetch)
+
+    def get_keywords(self, template_library_id, fetch):
+        """
+        :param fetch: 接收模板库ID，返回关键词库
+        """
+        return self._get('keywords_{}'.format(template_library_id), lambda: fetch(template_library_id))
+
+    def find_keyword_ids(self, template_library_id, keywords, fetch):
+        """
+        把关键词名称映射为关键词ID，已经是ID的保持不变
+        """
+        result = self.get_keywords(template_library_id, fetch)
+        keyword_ids = {item['name']: item['keyword_id'] for item in result.get('keyword_list', [])}
+        ids = []
+        for keyword in keywords:
+            if isinstance(keyword, int):
+                ids.append(keyword)
+            elif keyword in keyword_ids:
+                ids.append(keyword_ids[keyword])
+            else:
+                raise KeyError('keyword {} does not exist in template library {}'.format(keyword, template_library_id))
+        return ids
+
+    def invalidate(self, template_library_id=None):
+        names = ['list'] if template_library_id is None else ['keywords_{}'.format(template_library_id)]
+        for name in names:
+            key = '{}{}'.format(self.key_prefix, name)
+            self.local.delete(key)
+            if self.cache is not None:
+                self.cache.delete(key)
+
+
+class TemplateIndex(object):
+    """
+    单个授权方的消息模板索引，按标题或标题+关键词查找 template_id
+
+    索引由模板列表接口构建，超过 timeout 或被 invalidate 后在下次查找时重建；
+    找不到的标题在 miss_timeout 内不再触发重建，重建失败后 miss_timeout 内继续使用旧索引
+    """
+    KEYWORD_PATTERN = re.compile(r'([^\n{}]*?)[：:]?\s*\{\{\w+\.DATA\}\}')
+    MAX_MISSES = 1024
+
+    def __init__(self, timeout=3600, miss_timeout=300):
+        self.timeout = timeout
+        self.miss_timeout = miss_timeout
+        self.lock = threading.Lock()
+        self.by_title = {}
+        self.by_keywords = {}
+        self.template_ids = set()
+        self.misses = {}
+        self.built_at = None
+        self.retry_at = None
+
+    @classmethod
+    def parse_keywords(cls, content):
+        keywords = []
+        for name in cls.KEYWORD_PATTERN.findall(content or ''):
+            name = name.strip()
+            if name:
+                keywords.append(name)
+        return tuple(keywords)
+
+    @property
+    def backing_off(self):
+        """
+        上次重建失败后的 miss_timeout 内
+        """
+        return self.retry_at is not None and time.time() < self.retry_at
+
+    @property
+    def stale(self):
+        if self.backing_off:
+            return False
+        if self.built_at is None:
+            return True
+        return bool(self.timeout) and time.time() - self.built_at > self.timeout
+
+    def rebuild(self, templates):
+        by_title = {}
+        by_keywords = {}
+        template_ids = set()
+        for template in templates:
+            template_id = template['template_id']
+            title = template.get('title')
+            template_ids.add(template_id)
+            by_title.setdefault(title, template_id)
+            by_keywords[(title, self.parse_keywords(template.get('content')))] = template_id
+        with self.lock:
+            self.by_title = by_title
+            self.by_keywords = by_keywords
+            self.template_ids = template_ids
+            self.misses = {}
+            self.built_at = time.time()
+            self.retry_at = None
+
+    def rebuild_failed(self):
+        """
+        重建失败，miss_timeout 内不再重建
+        """
+        with self.lock:
+            self.retry_at = time.time() + self.miss_timeout
+
+    def invalidate(self):
+        with self.lock:
+            self.misses = {}
+            self.built_at = None
+            self.retry_at = None
+
+    @staticmethod
+    def _miss_key(title, keywords):
+        return title, tuple(keywords) if keywords is not None else None
+
+    def record_miss(self, title, keywords=None):
+        with self.lock:
+            if len(self.misses) >= self.MAX_MISSES:
+                self.misses = {}
+            self.misses[self._miss_key(title, keywords)] = time.time() + self.miss_timeout
+
+    def missed(self, title, keywords=None):
+        """
+        :return: title 最近是否查找失败过
+        """
+        expires_at = self.misses.get(self._miss_key(title, keywords))
+        return expires_at is not None and expires_at > time.time()
+
+    def resolve(self, title, keywords=None):
+        """
+        :param title: 模板标题，也可以直接传入 template_id
+        :param keywords: 关键词名称列表，用于区分同一标题下的多个模板
+        :return: template_id，找不到时返回 None
+        """
+        if title in self.template_ids:
+            return title
+        if keywords is not None:
+            return self.by_keywords.get((title, tuple(keywords)))
+        return self.by_title.get(title)
+
+
+class TemplateIndexRegistry(object):
+    """
+    按 (appid, kind) 保存授权方的模板索引，kind 为 weapp（小程序）或 mp（公众号）
+    """
+    def __init__(self, timeout=3600, miss_timeout=300):
+        self.timeout = timeout
+        self.miss_timeout = miss_timeout
+        self.lock = threading.Lock()
+        self.indexes = {}
+
+    def get(self, appid, kind):
+        with self.lock:
+            index = self.indexes.get((appid, kind))
+            if index is None:
+                index = TemplateIndex(timeout=self.timeout, miss_timeout=self.miss_timeout)
+                self.indexes[(appid, kind)] = index
+            return index
+
+    def invalidate(self, appid, kind=None):
+        kinds = ['weapp', 'mp'] if kind is None else [kind]
+        for kind in kinds:
+            self.get(appid, kind).invalidate()
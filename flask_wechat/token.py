@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import threading
+import time
+
+from .api.tracing import span
+from .cache import SingleFlight
+from .checkpoint import FileCheckpoint
+
+# component_verify_ticket 每 10 分钟推送一次，有效期 12 小时
+VERIFY_TICKET_EXPIRES_IN = 43200
+
+
+class FileTokenSnapshot(object):
+    """
+    保存在本地 JSON 文件中的 token 快照，{key: [value, expires_at]}
+
+    文件被其他进程替换后，下次读取时重新读入；写入时在锁文件（path + '.lock'）上加 flock，
+    重新读取文件合并本次修改，再写临时文件原子替换，多个进程的写入不会互相覆盖。
+    文件由 tempfile 创建，权限为 0600
+    """
+    def __init__(self, path):
+        self.checkpoint = FileCheckpoint(path)
+        self.lock_path = path + '.lock'
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.version = None
+
+    def _version(self):
+        try:
+            stat = os.stat(self.checkpoint.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        version = self._version()
+        if version != self.version:
+            self.tokens = self.checkpoint.load() or {}
+            self.version = version
+        return self.tokens
+
+    def _modify(self, change):
+        """
+        :param change: 接收 token 字典并就地修改，返回是否需要写入
+        """
+        import fcntl
+
+        with self.lock:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                tokens = self._load()
+                if change(tokens):
+                    self.checkpoint.save(tokens)
+                    self.version = self._version()
+            finally:
+                # 关闭文件即释放锁
+                os.close(fd)
+
+    def get(self, key):
+        """
+        :return: (value, expires_at)，不存在时返回 None
+        """
+        with self.lock:
+            token = self._load().get(key)
+        return tuple(token) if token is not None else None
+
+    def set(self, key, value, expires_at):
+        def change(tokens):
+            tokens[key] = [value, expires_at]
+            now = time.time()
+            # 顺便清理已过期的条目，快照文件不会无限增长
+            for expired_key in [k for k, (_, t) in tokens.items() if t is not None and t <= now]:
+                tokens.pop(expired_key)
+            return True
+
+        self._modify(change)
+
+    def delete(self, key):
+        self._modify(lambda tokens: tokens.pop(key, None) is not None)
+
+
+class SQLATokenSnapshot(object):
+    """
+    保存在数据库中的 token 快照，多台机器共用
+
+    Usage:
+
+    >> class WeChatToken(WeChatTokenMixin, db.Model):
+    >>     __tablename__ = 'wechat_token'
+    >>     id = db.Column(db.Integer, primary_key=True)
+    >>
+    >> wechat_app.init_app(app, appid, secret, cache=cache, token_snapshot=SQLATokenSnapshot(lambda: db.session, WeChatToken))
+    """
+    def __init__(self, session_factory, model):
+        """
+        :param session_factory: 返回 SQLAlchemy session 的函数
+        :param model: 继承 WeChatTokenMixin 的模型
+        """
+        self.session_factory = session_factory
+        self.model = model
+
+    def get(self, key):
+        return self.model.load_token(self.session_factory(), key)
+
+    def set(self, key, value, expires_at):
+        self.model.save_token(self.session_factory(), key, value, expires_at)
+
+    def delete(self, key):
+        self.model.delete_token(self.session_factory(), key)
+
+
+class TokenStore(object):
+    """
+    token 的查找顺序：本机共享缓存（可选）-> 缓存 -> 快照 -> 微信接口
+
+    集群整体重启、共享缓存为空时，从快照中恢复尚未过期的 token，
+    不需要重新获取（重新获取会消耗每日调用次数，并使其他服务持有的旧 token 失效）；
+    同一进程内对同一个 key 的并发获取只会请求一次。
+
+    配置了 local（如 SharedMemoryCache）时，在缓存之前先查本机共享的 local，
+    同一台机器上的多个 worker 不必每次都访问共享缓存。local 中的条目过期后，
+    只有在 local 中抢到刷新标记的 worker 读取缓存、获取 token 并写入 local，
+    其他 worker 直接读缓存（不写 local），或等待它获取完成
+    """
+    def __init__(self, cache=None, snapshot=None, margin=60, local=None, local_timeout=60, refresh_lease=10):
+        """
+        :param snapshot: FileTokenSnapshot、SQLATokenSnapshot 或实现了 get/set/delete 的对象
+        :param margin: 快照中的 token 剩余有效期不足 margin 秒时视为过期
+        :param local_timeout: local 中条目的最长有效期；其他机器刷新 token 后旧 token 只再有效 5 分钟，
+                              因此不应超过 300 秒
+        :param refresh_lease: 刷新标记的有效期，持有标记的 worker 退出后其他 worker 最多等待这么久
+        """
+        self.cache = cache
+        self.snapshot = snapshot
+        self.margin = margin
+        self.local = local
+        self.local_timeout = local_timeout
+        self.refresh_lease = refresh_lease
+        self.flight = SingleFlight()
+
+    @classmethod
+    def from_config(cls, config, cache=None, snapshot=None):
+        """
+        未传入 snapshot 时，配置了 WECHAT_TOKEN_SNAPSHOT_PATH 则使用文件快照；
+        配置了 WECHAT_TOKEN_SHM_PATH 时使用本机共享内存缓存
+        """
+        if snapshot is None and config.get('WECHAT_TOKEN_SNAPSHOT_PATH'):
+            snapshot = FileTokenSnapshot(config['WECHAT_TOKEN_SNAPSHOT_PATH'])
+        local = None
+        if config.get('WECHAT_TOKEN_SHM_PATH'):
+            from .shm import SharedMemoryCache
+
+            local = SharedMemoryCache(config['WECHAT_TOKEN_SHM_PATH'], slots=config.get('WECHAT_TOKEN_SHM_SLOTS', 256))
+        return cls(
+            cache=cache,
+            snapshot=snapshot,
+            margin=config.get('WECHAT_TOKEN_SNAPSHOT_MARGIN', 60),
+            local=local,
+            local_timeout=config.get('WECHAT_TOKEN_SHM_TIMEOUT', 60),
+            refresh_lease=config.get('WECHAT_TOKEN_SHM_REFRESH_LEASE', 10)
+        )
+
+    def _set_local(self, key, value, timeout=None):
+        if self.local is not None:
+            timeout = self.local_timeout if timeout is None else min(timeout, self.local_timeout)
+            self.local.set(key, value, timeout=timeout)
+
+    @staticmethod
+    def _refresh_marker(key):
+        return 'refreshing_{}'.format(hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def _begin_refresh(self, key):
+        """
+        :return: 本机只有一个 worker 能拿到 key 的刷新标记，没有 local 时总是 True
+        """
+        if self.local is None:
+            return True
+        return self.local.add(self._refresh_marker(key), str(os.getpid()), timeout=self.refresh_lease)
+
+    def _end_refresh(self, key):
+        if self.local is not None:
+            self.local.delete(self._refresh_marker(key))
+
+    def _load_snapshot(self, key, write_local=True):
+        token = self.snapshot.get(key) if self.snapshot is not None else None
+        if token is None:
+            return None
+        value, expires_at = token
+        if expires_at is None:
+            if self.cache is not None:
+                self.cache.set(key, value)
+            if write_local:
+                self._set_local(key, value)
+            return value
+        timeout = int(expires_at - time.time()) - self.margin
+        if timeout <= 0:
+            return None
+        if self.cache is not None:
+            self.cache.set(key, value, timeout=timeout)
+        if write_local:
+            self._set_local(key, value, timeout=timeout)
+        return value
+
+    def _get_shared(self, key, write_local):
+        value = self.cache.get(key) if self.cache is not None else None
+        if value is None:
+            return self._load_snapshot(key, write_local=write_local)
+        if write_local:
+            self._set_local(key, value)
+        return value
+
+    def get(self, key):
+        if self.local is None:
+            return self._get_shared(key, False)
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        if not self._begin_refresh(key):
+            # 其他 worker 正在刷新 local
+            return self._get_shared(key, False)
+        try:
+            return self._get_shared(key, True)
+        finally:
+            self._end_refresh(key)
+
+    def set(self, key, value, expires_in=None):
+        self._set_local(key, value, timeout=expires_in)
+        if self.cache is not None:
+            if expires_in is None:
+                self.cache.set(key, value)
+            else:
+                self.cache.set(key, value, timeout=expires_in)
+        if self.snapshot is not None:
+            expires_at = int(time.time()) + int(expires_in) if expires_in is not None else None
+            self.snapshot.set(key, value, expires_at)
+
+    def delete(self, key):
+        if self.local is not None:
+            self.local.delete(key)
+        if self.cache is not None:
+            self.cache.delete(key)
+        if self.snapshot is not None:
+            self.snapshot.delete(key)
+
+    def _wait_for_refresh(self, key):
+        deadline = time.monotonic() + self.refresh_lease
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            value = self.local.get(key)
+            if value is None:
+                value = self.cache.get(key) if self.cache is not None else None
+            if value is not None:
+                return value
+        return None
+
+    def get_or_fetch(self, key, fetch):
+        """
+        :param fetch: 缓存和快照中都没有时调用，返回 (value, expires_in)
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        def fetch_and_store():
+            # 等待期间可能已有其他调用方写入
+            stored = self.get(key)
+            if stored is not None:
+                return stored
+            if not self._begin_refresh(key):
+                # 本机其他 worker 正在获取，等待其写入；超时后自己获取
+                stored = self._wait_for_refresh(key)
+                if stored is not None:
+                    return stored
+                return self._fetch(key, fetch)
+            try:
+                return self._fetch(key, fetch)
+            finally:
+                self._end_refresh(key)
+
+        value, _ = self.flight.do(key, fetch_and_store)
+        return value
+
+    def _fetch(self, key, fetch):
+        with span('wechat.token.fetch', key=key):
+            fetched, expires_in = fetch()
+        self.set(key, fetched, expires_in=expires_in)
+        return fetched
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import time
+
+from .batch import run_bounded
+
+API_HOST = 'https://api.weixin.qq.com/'
+MERCHANT_HOST = 'https://api.mch.weixin.qq.com/'
+
+
+class WarmupReport(object):
+    """
+    预热结果，按执行顺序记录每一步的名称、耗时和结果
+
+    某一步失败不会中断后续步骤，失败原因记录在 error 中
+    """
+    def __init__(self, name):
+        self.name = name
+        self.steps = []
+
+    def step(self, name, func, *args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            detail = func(*args, **kwargs)
+            error = None
+        except Exception as e:
+            detail = None
+            error = e
+        elapsed = time.perf_counter() - started_at
+        self.steps.append({'name': name, 'elapsed': elapsed, 'detail': detail, 'error': error})
+        return detail
+
+    @property
+    def ok(self):
+        return all(step['error'] is None for step in self.steps)
+
+    @property
+    def elapsed(self):
+        return sum(step['elapsed'] for step in self.steps)
+
+    def __str__(self):
+        lines = ['{} warmup {} in {:.3f}s'.format(self.name, 'ok' if self.ok else 'failed', self.elapsed)]
+        for step in self.steps:
+            result = 'error: {!r}'.format(step['error']) if step['error'] is not None else step['detail']
+            lines.append('  {:<20}{:>8.3f}s  {}'.format(step['name'], step['elapsed'], result))
+        return '\n'.join(lines)
+
+
+def warm_connections(session, url, connections=1, timeout=5, **kwargs):
+    """
+    并发向 url 发起 connections 个 HEAD 请求，在连接池中预先建立 TCP/TLS 连接
+
+    只关心连接是否建立，不检查响应状态
+    :return: 成功建立的连接数
+    """
+    def connect(_):
+        session.head(url, timeout=timeout, **kwargs).close()
+
+    opened = 0
+    for _, _, error in run_bounded(connect, range(connections), max_workers=connections):
+        if error is not None:
+            raise error
+        opened += 1
+    return opened
+
+
+def log_report(app, report):
+    if report.ok:
+        app.logger.info(str(report))
+    else:
+        app.logger.warning(str(report))
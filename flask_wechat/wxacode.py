@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import zipfile
+
+from .api.app import wxa_page_path
+from .api.ratelimit import RateLimiter
+from .batch import run_bounded
+from .cache import SingleFlight
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def guess_mimetype(path):
+    with open(path, 'rb') as f:
+        header = f.read(len(PNG_SIGNATURE))
+    return 'image/png' if header == PNG_SIGNATURE else 'image/jpeg'
+
+
+class WxaCodeCache(object):
+    """
+    小程序码/二维码的本地磁盘缓存
+
+    以规范化后的请求参数的 SHA-256 作为文件名，相同参数只向微信请求一次；
+    文件的修改时间记录最近一次命中，总大小超过 max_bytes 时按修改时间淘汰最久未使用的文件
+    """
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.flight = SingleFlight()
+        self.size = None
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(appid, kind, data):
+        normalized = json.dumps([appid, kind, data], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        path = self.path_for(key)
+        try:
+            os.utime(path, None)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get_or_fetch(self, key, download):
+        """
+        :param download: 接收一个二进制文件对象，把图片写入其中
+        :return: 缓存文件的路径
+        """
+        path = self.get(key)
+        if path is not None:
+            return path
+        path, _ = self.flight.do(key, lambda: self._fetch(key, download))
+        return path
+
+    def _fetch(self, key, download):
+        path = self.get(key)
+        if path is not None:
+            return path
+
+        path = self.path_for(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.download-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                download(f)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+        self._add_size(os.path.getsize(path))
+        return path
+
+    def _scan(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _add_size(self, size):
+        with self.lock:
+            if self.size is None:
+                self.size = sum(item[1] for item in self._scan())
+            else:
+                self.size += size
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        files = sorted(self._scan())
+        total = sum(item[1] for item in files)
+        # 一次淘汰到上限的 90%，避免每次写入都扫描目录
+        target = self.max_bytes * 0.9
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size = total
+
+
+def check_member_name(name):
+    """
+    检查输出文件名，只允许以 / 分隔的相对路径，拒绝绝对路径、盘符、反斜杠和 . 或 .. 路径段
+    :raise ValueError: 文件名会写到目标目录之外
+    """
+    if not isinstance(name, str) or not name or '\\' in name or '\0' in name or ':' in name:
+        raise ValueError('invalid file name: {!r}'.format(name))
+    parts = name.split('/')
+    if any(part in ('', '.', '..') for part in parts):
+        raise ValueError('invalid file name: {!r}'.format(name))
+    return name
+
+
+class WxaCodeBatch(object):
+    """
+    批量生成小程序码，写入目录或 zip 文件
+
+    每个 spec 是一个字典：
+    - name: 输出文件名（目录或 zip 内以 / 分隔的相对路径），不合法的文件名产出 ValueError
+    - scene 和可选的 page：调用 getwxacodeunlimit
+    - 或 path 和可选的 params：调用 getwxacode
+    - 可选的 width、auto_color、line_color、is_hyaline
+
+    图片由工作线程直接流式写入临时文件，不在内存中保存；
+    目标中已存在的文件会被跳过，因此中断后重新运行即可从断点继续。
+
+    Usage:
+
+    >> batch = wechat_app.batch_wxa_codes(max_workers=8)
+    >> for spec, error in batch.to_zip(specs, 'codes.zip'):
+    >>     pass
+    >> batch.report
+    """
+    OPTION_KEYS = ('width', 'auto_color', 'line_color', 'is_hyaline')
+
+    def __init__(self, app_client, max_workers=4, rate=50, limiter=None, progress=None, progress_every=100):
+        """
+        :param rate: 每秒请求数，getwxacodeunlimit 的频率限制为每分钟 5000 次
+        :param progress: 每完成 progress_every 个调用一次 progress(report)
+        """
+        self.app_client = app_client
+        self.max_workers = max_workers
+        self.limiter = limiter if limiter is not None or rate is None else RateLimiter(rate)
+        self.progress = progress
+        self.progress_every = progress_every
+        self.report = {'skipped': 0, 'done': 0, 'failed': 0, 'bytes': 0}
+
+    def _download(self, spec, fileobj):
+        if self.limiter is not None:
+            self.limiter.acquire(self.app_client.appid)
+        options = {k: spec[k] for k in self.OPTION_KEYS if k in spec}
+        if 'scene' in spec:
+            self.app_client.get_wxa_code_unlimit(spec['scene'], page=spec.get('page'), fileobj=fileobj, **options)
+        else:
+            path = wxa_page_path(spec['path'], spec.get('params'))
+            if options.get('auto_color'):
+                options.pop('line_color', None)
+            self.app_client.app_api.get_wxa_code(self.app_client.access_token, path, fileobj=fileobj, **options)
+
+    def _download_to_temp(self, spec, directory):
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.wxacode-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self._download(spec, f)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        return tmp_path
+
+    def _finish(self, spec, error, size=0):
+        if error is None:
+            self.report['done'] += 1
+            self.report['bytes'] += size
+        else:
+            self.report['failed'] += 1
+        finished = self.report['done'] + self.report['failed']
+        if self.progress is not None and finished % self.progress_every == 0:
+            self.progress(dict(self.report))
+        return spec, error
+
+    def _is_done(self, spec, exists):
+        try:
+            name = check_member_name(spec['name'])
+        except ValueError:
+            return False
+        if exists(name):
+            self.report['skipped'] += 1
+            return True
+        return False
+
+    def to_directory(self, specs, directory):
+        """
+        :return: 按完成顺序产出 (spec, error)
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        def pending():
+            for spec in specs:
+                if not self._is_done(spec, lambda name: os.path.exists(os.path.join(directory, name))):
+                    yield spec
+
+        def fetch(spec):
+            path = os.path.join(directory, check_member_name(spec['name']))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = self._download_to_temp(spec, os.path.dirname(path))
+            os.replace(tmp_path, path)
+            return os.path.getsize(path)
+
+        for spec, size, error in run_bounded(fetch, pending(), max_workers=self.max_workers):
+            yield self._finish(spec, error, size or 0)
+
+    def to_zip(self, specs, zip_path, compression=zipfile.ZIP_STORED):
+        """
+        逐个追加到 zip 文件中，zip 已存在时以追加模式打开并跳过已有的文件
+
+        zip 的目录在正常结束或抛出异常时写入；进程被强制杀死时 zip 文件会损坏
+        :return: 按完成顺序产出 (spec, error)
+        """
+        mode = 'a' if os.path.exists(zip_path) else 'w'
+        directory = os.path.dirname(os.path.abspath(zip_path))
+        with zipfile.ZipFile(zip_path, mode, compression=compression) as archive:
+            existing = set(archive.namelist())
+
+            def pending():
+                for spec in specs:
+                    if not self._is_done(spec, existing.__contains__):
+                        yield spec
+
+            def fetch(spec):
+                check_member_name(spec['name'])
+                return self._download_to_temp(spec, directory)
+
+            for spec, tmp_path, error in run_bounded(fetch, pending(), max_workers=self.max_workers):
+                if error is not None:
+                    yield self._finish(spec, error)
+                    continue
+                try:
+                    size = os.path.getsize(tmp_path)
+                    archive.write(tmp_path, spec['name'])
+                    existing.add(spec['name'])
+                finally:
+                    os.unlink(tmp_path)
+                yield self._finish(spec, None, size)
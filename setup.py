@@ -19,7 +19,7 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     include_package_data=True,
-    python_requires='>=3.5',
+    python_requires='>=3.7',
     install_requires=[
         "pycrypto"
     ]
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+import time
+
+import pytest
+
+from flask_wechat.api.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers, configure_breakers
+from flask_wechat.api.common import WeChatApiError, WeChatCircuitOpenError
+from flask_wechat.api.metrics import InMemoryMetrics, configure_metrics
+
+URL = 'https://api.weixin.qq.com/cgi-bin/message/custom/send'
+OTHER_URL = 'https://api.weixin.qq.com/cgi-bin/user/info'
+
+
+@pytest.fixture(autouse=True)
+def reset_globals():
+    yield
+    configure_breakers(None)
+    configure_metrics(None)
+
+
+def fail(code=-1):
+    def send():
+        raise WeChatApiError(code, 'error')
+    return send
+
+
+def call(breakers, url, send):
+    try:
+        return breakers.call(url, send)
+    except WeChatApiError as e:
+        return e
+
+
+def test_opens_after_failure_rate_and_rejects():
+    breakers = CircuitBreakers(min_calls=4, failure_rate=0.5, open_timeout=60)
+    for _ in range(2):
+        call(breakers, URL, lambda: 'ok')
+    for _ in range(2):
+        call(breakers, URL, fail())
+    assert breakers.get('api.weixin.qq.com').state == OPEN
+
+    sent = []
+    with pytest.raises(WeChatCircuitOpenError) as info:
+        breakers.call(URL, lambda: sent.append(1))
+    assert info.value.code == -1
+    assert sent == []
+    assert breakers.stats()['api.weixin.qq.com']['rejected'] == 1
+
+
+def test_business_errors_and_min_calls_do_not_open():
+    breakers = CircuitBreakers(min_calls=4, failure_rate=0.5)
+    for _ in range(10):
+        call(breakers, URL, fail(43101))
+    for _ in range(3):
+        call(breakers, OTHER_URL, fail())
+    assert breakers.get('api.weixin.qq.com').state == CLOSED
+
+
+@pytest.mark.parametrize('error', [ConnectionError('reset'), TimeoutError('timed out')])
+def test_network_errors_count_as_failures(error):
+    breakers = CircuitBreakers(min_calls=2, failure_rate=0.5)
+
+    def send():
+        raise error
+
+    for _ in range(2):
+        with pytest.raises(type(error)):
+            breakers.call(URL, send)
+    assert breakers.get('api.weixin.qq.com').state == OPEN
+
+
+def test_slow_calls_open_breaker():
+    breaker = CircuitBreaker('test', min_calls=2, slow_call_duration=0.5, slow_call_rate=1.0)
+    breaker.record(False, 1.0)
+    breaker.record(False, 1.0)
+    assert breaker.state == OPEN
+
+
+def test_half_open_probe_closes_or_reopens():
+    breaker = CircuitBreaker('test', min_calls=1, open_timeout=0.05, half_open_calls=1)
+    breaker.record(True, 0)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # 同时只放行 half_open_calls 个探测
+    assert not breaker.allow()
+    breaker.record(True, 0)
+    assert breaker.state == OPEN
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record(False, 0)
+    assert breaker.state == CLOSED
+    assert breaker.stats()['calls'] == 0
+
+
+def test_endpoint_breaker_only_rejects_its_endpoint():
+    breakers = CircuitBreakers(min_calls=2, failure_rate=0.5, open_timeout=60)
+    for _ in range(4):
+        call(breakers, URL, lambda: 'ok')
+    for _ in range(2):
+        call(breakers, OTHER_URL, fail())
+    assert breakers.get('api.weixin.qq.com/cgi-bin/user/info').state == OPEN
+    assert breakers.get('api.weixin.qq.com').state == CLOSED
+    assert breakers.call(URL, lambda: 'ok') == 'ok'
+    with pytest.raises(WeChatCircuitOpenError):
+        breakers.call(OTHER_URL, lambda: 'ok')
+
+
+def test_endpoint_rejection_releases_host_probe():
+    breakers = CircuitBreakers(min_calls=1, open_timeout=0.05)
+    host = breakers.get('api.weixin.qq.com')
+    endpoint = breakers.get('api.weixin.qq.com/cgi-bin/user/info')
+    host.record(True, 0)
+    endpoint.record(True, 0)
+    endpoint.opened_at = time.monotonic() + 60
+
+    time.sleep(0.06)
+    with pytest.raises(WeChatCircuitOpenError):
+        breakers.call(OTHER_URL, lambda: 'ok')
+    assert host.state == HALF_OPEN
+    assert host.probes == 0
+    assert breakers.call(URL, lambda: 'ok') == 'ok'
+    assert host.state == CLOSED
+
+
+def test_state_transitions_are_exported():
+    metrics = InMemoryMetrics()
+    configure_metrics(metrics)
+    breakers = CircuitBreakers(min_calls=1)
+    configure_breakers(breakers)
+    call(breakers, URL, fail())
+    assert metrics.breaker_transitions[('api.weixin.qq.com', OPEN)] == 1
+    text = metrics.prometheus_text()
+    assert 'wechat_api_circuit_state{breaker="api.weixin.qq.com",state="open"} 1' in text
+
+
+def test_requests_have_default_timeout():
+    from flask_wechat.api.base import BaseApi
+
+    captured = {}
+
+    class Session(object):
+        def request(self, method, url, **kwargs):
+            captured.update(kwargs)
+            raise ConnectionError('offline')
+
+    class Api(BaseApi):
+        session = Session()
+
+    with pytest.raises(ConnectionError):
+        Api().get(URL)
+    assert captured['timeout'] == (3.05, 10)
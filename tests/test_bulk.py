@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import threading
+
+import pytest
+
+from flask_wechat.api.common import WeChatApiError, WeChatCircuitOpenError
+from flask_wechat.bulk import BulkMessageSender
+
+
+class MemoryCheckpoint(object):
+    def __init__(self):
+        self.state = None
+
+    def load(self):
+        return self.state
+
+    def save(self, state):
+        self.state = state
+
+
+class FakeSend(object):
+    def __init__(self, errors=None):
+        # touser -> 抛出的异常，None 表示成功
+        self.errors = dict(errors or {})
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, touser, data):
+        with self.lock:
+            self.calls.append(touser)
+        error = self.errors.get(touser)
+        if error is not None:
+            raise error
+        return {'errcode': 0}
+
+
+RECIPIENTS = [('user{}'.format(i), {}) for i in range(5)]
+
+
+def make_sender(send, checkpoint, **options):
+    options.setdefault('max_workers', 2)
+    return BulkMessageSender(send, rate=None, max_retries=1, backoff=0, checkpoint=checkpoint, **options)
+
+
+@pytest.mark.parametrize('error', [
+    WeChatApiError(-1, 'system busy'),
+    WeChatCircuitOpenError(-1, 'circuit is open'),
+    ConnectionError('reset'),
+])
+def test_transient_failures_are_retried_on_resume(error):
+    checkpoint = MemoryCheckpoint()
+    send = FakeSend({'user2': error})
+    results = {result.touser: result for result in make_sender(send, checkpoint).run(RECIPIENTS)}
+    assert not results['user2'].ok
+    assert results['user2'].attempts == 2
+    assert checkpoint.state == {'position': 5, 'done': [], 'retry': [2]}
+
+    send.errors = {}
+    send.calls = []
+    results = list(make_sender(send, checkpoint).run(RECIPIENTS))
+    assert send.calls == ['user2']
+    assert [result.ok for result in results] == [True]
+    assert checkpoint.state == {'position': 5, 'done': [], 'retry': []}
+
+
+def test_permanent_failures_are_not_retried():
+    checkpoint = MemoryCheckpoint()
+    send = FakeSend({'user1': WeChatApiError(43101, 'user refuse to accept the msg')})
+    results = {result.touser: result for result in make_sender(send, checkpoint).run(RECIPIENTS)}
+    assert results['user1'].attempts == 1
+    assert checkpoint.state == {'position': 5, 'done': [], 'retry': []}
+
+    send.calls = []
+    assert list(make_sender(send, checkpoint).run(RECIPIENTS)) == []
+    assert send.calls == []
+
+
+@pytest.mark.parametrize('max_workers', [1, 2, 4])
+def test_fatal_error_records_in_flight_sends(max_workers):
+    from collections import Counter
+
+    checkpoint = MemoryCheckpoint()
+    recipients = [('user{}'.format(i), {}) for i in range(20)]
+    send = FakeSend({'user3': WeChatApiError(45009, 'reach max api daily quota limit')})
+    with pytest.raises(WeChatApiError):
+        list(make_sender(send, checkpoint, max_workers=max_workers).run(recipients))
+    # 出错后不再提交新的发送
+    assert len(send.calls) <= 4 + max_workers * 2
+    first_run = list(send.calls)
+
+    send.errors = {}
+    send.calls = []
+    results = list(make_sender(send, checkpoint, max_workers=max_workers).run(recipients))
+    assert all(result.ok for result in results)
+    assert checkpoint.state == {'position': 20, 'done': [], 'retry': []}
+
+    counts = Counter(first_run + send.calls)
+    assert counts['user3'] == 2
+    del counts['user3']
+    assert counts == Counter('user{}'.format(i) for i in range(20) if i != 3)
+
+
+def test_retry_above_position_is_resumed():
+    checkpoint = MemoryCheckpoint()
+    checkpoint.state = {'position': 1, 'done': [3], 'retry': [3]}
+    send = FakeSend()
+    list(make_sender(send, checkpoint, max_workers=1).run(RECIPIENTS))
+    assert send.calls == ['user1', 'user2', 'user3', 'user4']
+    assert checkpoint.state == {'position': 5, 'done': [], 'retry': []}
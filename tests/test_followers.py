@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import pytest
+
+from flask_wechat.app import AuthorizedAppClient
+
+
+class MemoryCheckpoint(object):
+    def __init__(self):
+        self.state = None
+
+    def load(self):
+        return self.state
+
+    def save(self, state):
+        self.state = state
+
+    def clear(self):
+        self.state = None
+
+
+class FakeAppApi(object):
+    def __init__(self, pages):
+        # next_openid -> (openids, 下一页的 next_openid)
+        self.pages = pages
+        self.requests = []
+
+    def get_followers(self, access_token, next_openid=None):
+        self.requests.append(next_openid)
+        openids, following = self.pages[next_openid]
+        return {
+            'total': 6,
+            'count': len(openids),
+            'data': {'openid': openids} if openids else {},
+            'next_openid': following,
+        }
+
+
+PAGES = {
+    None: (['a', 'b', 'c'], 'c'),
+    'c': (['d', 'e', 'f'], 'f'),
+    'f': ([], ''),
+}
+
+
+def make_client():
+    client = AuthorizedAppClient('wx-app', 'token', None)
+    client.authorized_app_api = FakeAppApi(PAGES)
+    return client
+
+
+def test_iter_followers():
+    assert list(make_client().iter_followers()) == list('abcdef')
+
+
+def test_iter_follower_chunks():
+    assert list(make_client().iter_followers(chunk_size=4)) == [list('abcd'), list('ef')]
+
+
+class Crash(Exception):
+    pass
+
+
+def consume(chunks, crash_on):
+    received = []
+    for chunk in chunks:
+        if chunk == crash_on:
+            raise Crash()
+        received.extend(chunk)
+    return received
+
+
+def test_chunk_crash_resumes_from_chunk_start():
+    checkpoint = MemoryCheckpoint()
+    with pytest.raises(Crash):
+        consume(make_client().iter_followers(checkpoint=checkpoint, chunk_size=4), list('abcd'))
+    assert checkpoint.state is None
+    assert consume(make_client().iter_followers(checkpoint=checkpoint, chunk_size=4), None) == list('abcdef')
+    assert checkpoint.state is None
+
+
+def test_chunk_crash_after_page_boundary():
+    checkpoint = MemoryCheckpoint()
+    with pytest.raises(Crash):
+        consume(make_client().iter_followers(checkpoint=checkpoint, chunk_size=2), list('cd'))
+    assert checkpoint.state == {'next_openid': None, 'skip': 2, 'total': 6}
+
+    client = make_client()
+    assert consume(client.iter_followers(checkpoint=checkpoint, chunk_size=2), None) == list('cdef')
+    assert client.authorized_app_api.requests == [None, 'c', 'f']
+
+
+def test_chunk_crash_mid_second_page():
+    checkpoint = MemoryCheckpoint()
+    with pytest.raises(Crash):
+        consume(make_client().iter_followers(checkpoint=checkpoint, chunk_size=4), list('ef'))
+    assert checkpoint.state == {'next_openid': 'c', 'skip': 1, 'total': 6}
+
+    client = make_client()
+    assert consume(client.iter_followers(checkpoint=checkpoint, chunk_size=4), None) == list('ef')
+    assert client.authorized_app_api.requests == ['c', 'f']
+
+
+def test_page_checkpoint_resume():
+    checkpoint = MemoryCheckpoint()
+    followers = make_client().iter_followers(checkpoint=checkpoint)
+    assert [next(followers) for _ in range(4)] == list('abcd')
+    assert checkpoint.state == {'next_openid': 'c', 'total': 6}
+    assert list(make_client().iter_followers(checkpoint=checkpoint)) == list('def')
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import pytest
+
+from flask_wechat.api.common import WeChatApiError
+from flask_wechat.cache import LocalCache
+from flask_wechat.merchant import OrdinaryMerchantClient
+
+
+class FakeMerchantApi(object):
+    def __init__(self):
+        self.orders = []
+
+    def unifinedorder(self, body, out_trade_no, total_fee, spbill_create_ip, notify_url, trade_type, **kwargs):
+        self.orders.append((out_trade_no, total_fee))
+        return {'prepay_id': 'prepay-{}-{}'.format(out_trade_no, len(self.orders))}
+
+    def random_str(self):
+        return 'nonce'
+
+    def sign(self, message):
+        return 'sign'
+
+
+def make_client(cache=None):
+    client = OrdinaryMerchantClient()
+    client.appid = 'wx-app'
+    client.trade_type = 'JSAPI'
+    client.merchant_api = FakeMerchantApi()
+    client.cache = LocalCache() if cache is None else cache
+    client.cache_key_prefix = 'merchant_'
+    client.prepay_cache_timeout = 6900
+    return client
+
+
+def unifinedorder(client, out_trade_no='order-1', total_fee=100):
+    return client.unifinedorder(None, out_trade_no, total_fee, '127.0.0.1', 'https://example.com/notify')
+
+
+def test_prepay_is_reused_for_same_amount():
+    client = make_client()
+    assert unifinedorder(client) == unifinedorder(client)
+    assert client.merchant_api.orders == [('order-1', 100)]
+    assert client.prepay_cache_stats == {'hits': 1, 'misses': 1, 'shared': 0}
+
+
+def test_payment_data_by_out_trade_no():
+    client = make_client()
+    prepay_id = unifinedorder(client)
+    assert client.get_payment_data(out_trade_no='order-1')['package'] == 'prepay_id={}'.format(prepay_id)
+    assert client.get_payment_data(out_trade_no='order-1', total_fee=100)['package'] == 'prepay_id={}'.format(prepay_id)
+    with pytest.raises(WeChatApiError):
+        client.get_payment_data(out_trade_no='order-1', total_fee=200)
+    with pytest.raises(WeChatApiError):
+        client.get_payment_data(out_trade_no='order-2')
+
+
+def test_changed_amount_creates_new_prepay():
+    client = make_client()
+    unifinedorder(client, total_fee=100)
+    unifinedorder(client, total_fee=200)
+    assert client.merchant_api.orders == [('order-1', 100), ('order-1', 200)]
+    assert client.get_cached_prepay('order-1', 100) is None
+    assert client.get_cached_prepay('order-1', 200) is not None
+
+
+class LateCache(LocalCache):
+    """
+    第一次读取之后才出现缓存条目，模拟其他进程在检查和下单之间写入
+    """
+    def __init__(self, entry_key, entry):
+        super(LateCache, self).__init__()
+        self.entry_key = entry_key
+        self.entry = entry
+        self.reads = 0
+
+    def get(self, key):
+        self.reads += 1
+        if self.reads == 2:
+            self.set(self.entry_key, self.entry)
+        return super(LateCache, self).get(key)
+
+
+def test_hit_inside_single_flight_is_counted_as_hit():
+    entry = {'total_fee': 100, 'result': {'prepay_id': 'from-other-process'}}
+    client = make_client(LateCache('merchant_prepay_order-1', entry))
+    assert unifinedorder(client) == 'from-other-process'
+    assert client.merchant_api.orders == []
+    assert client.prepay_cache_stats == {'hits': 1, 'misses': 0, 'shared': 0}
+
+
+def test_next_due_in_skips_untracked_orders():
+    from flask_wechat.merchant import OrderPollScheduler
+
+    scheduler = OrderPollScheduler(make_client(), intervals=(5, 60))
+    scheduler.track('order-1', now=1000)
+    scheduler.track('order-2', now=1010)
+    assert scheduler.next_due_in(now=1000) == 5
+
+    scheduler.untrack('order-1')
+    assert scheduler.next_due_in(now=1000) == 15
+    assert len(scheduler.heap) == 1
+
+    scheduler.untrack('order-2')
+    assert scheduler.next_due_in(now=1000) is None
+
+
+def make_scheduler(query):
+    from flask_wechat.merchant import OrderPollScheduler
+
+    client = make_client()
+
+    def batch_orderquery(out_trade_nos, max_workers=None):
+        for out_trade_no in out_trade_nos:
+            yield out_trade_no, query(out_trade_no), None
+
+    client.batch_orderquery = batch_orderquery
+    return OrderPollScheduler(client, intervals=(5, 60))
+
+
+def test_raising_handler_does_not_drop_orders():
+    scheduler = make_scheduler(lambda out_trade_no: {'trade_state': 'SUCCESS'})
+    handled = []
+
+    @scheduler.final_state_handler
+    def handle(out_trade_no, result):
+        handled.append(out_trade_no)
+        if out_trade_no == 'order-1':
+            raise ValueError('handler failed')
+
+    for out_trade_no in ('order-1', 'order-2', 'order-3'):
+        scheduler.track(out_trade_no, now=1000)
+    finished = scheduler.poll_due(now=1005)
+    assert sorted(finished) == ['order-1', 'order-2', 'order-3']
+    assert sorted(handled) == ['order-1', 'order-2', 'order-3']
+    assert scheduler.report()['queue_size'] == 0
+    assert scheduler.stats['errors'] == 1
+
+
+def test_failed_batch_query_reschedules_unprocessed_orders():
+    def query(out_trade_no):
+        if out_trade_no == 'order-2':
+            raise RuntimeError('connection pool closed')
+        return {'trade_state': 'NOTPAY'}
+
+    scheduler = make_scheduler(query)
+    for out_trade_no in ('order-1', 'order-2', 'order-3'):
+        scheduler.track(out_trade_no, now=1000)
+    with pytest.raises(RuntimeError):
+        scheduler.poll_due(now=1005)
+
+    assert all(order['due_at'] == 1065 for order in scheduler.orders.values())
+    assert scheduler.next_due_in(now=1005) == 60
+    assert len(scheduler.heap) == 3
+
+
+def test_run_survives_poll_errors():
+    import threading
+
+    scheduler = make_scheduler(lambda out_trade_no: {'trade_state': 'NOTPAY'})
+    stop_event = threading.Event()
+    calls = []
+
+    def poll_due():
+        calls.append(1)
+        if len(calls) >= 2:
+            stop_event.set()
+        raise RuntimeError('poll failed')
+
+    scheduler.poll_due = poll_due
+    scheduler.run(stop_event, tick=0.01)
+    assert len(calls) == 2
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import pytest
+
+from flask_wechat.api.common import WeChatApiError
+from flask_wechat.api.merchant import MerchantMessage, OrdinaryMerchantApi
+from flask_wechat.merchant import OrdinaryMerchantClient
+
+CERT = ('/path/to/apiclient_cert.pem', '/path/to/apiclient_key.pem')
+
+
+class FakeResponse(object):
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeSession(object):
+    def __init__(self, api, reply):
+        self.api = api
+        self.reply = reply
+        self.posts = []
+
+    def post(self, url, data=None, **kwargs):
+        request = MerchantMessage.fromstring(data)
+        self.posts.append((url, request, kwargs))
+        message = MerchantMessage(self.reply(request))
+        message['sign'] = self.api.sign(message)
+        return FakeResponse(message.tostring().encode('utf-8'))
+
+
+def success(fields):
+    def reply(request):
+        message = {'return_code': 'SUCCESS', 'result_code': 'SUCCESS', 'appid': 'wx-app', 'mch_id': '1230000109', 'nonce_str': 'nonce'}
+        message.update(fields(request) if callable(fields) else fields)
+        return message
+    return reply
+
+
+def make_api(cert=CERT):
+    return OrdinaryMerchantApi('wx-app', '1230000109', 'key', cert=cert)
+
+
+def test_cert_requests_use_separate_session():
+    api = make_api()
+    assert api.session is not api.cert_session
+    assert api.session.cert is None
+    assert api.cert_session.cert == CERT
+    assert api.session.get_adapter('https://api.mch.weixin.qq.com') is not api.cert_session.get_adapter('https://api.mch.weixin.qq.com')
+
+
+def test_cert_session_requires_cert():
+    with pytest.raises(AssertionError):
+        make_api(cert=None).cert_session
+
+
+def test_refund_goes_through_cert_session():
+    api = make_api()
+    plain = api._session = FakeSession(api, success({}))
+    cert = api._cert_session = FakeSession(api, success(lambda request: {
+        'out_refund_no': request['out_refund_no'], 'refund_id': '5000', 'refund_fee': request['refund_fee'],
+    }))
+
+    result = api.refund('R1', 100, 60, out_trade_no='T1', refund_desc=None)
+    assert dict(result) == {'out_refund_no': 'R1', 'refund_id': '5000', 'refund_fee': '60'}
+    assert plain.posts == []
+    url, request, kwargs = cert.posts[0]
+    assert url == 'https://api.mch.weixin.qq.com/secapi/pay/refund'
+    assert request['out_trade_no'] == 'T1'
+    assert 'refund_desc' not in request
+    assert 'cert' not in kwargs
+    assert kwargs['timeout'] == (3.05, 10)
+
+
+def test_refund_requires_cert():
+    api = make_api(cert=None)
+    with pytest.raises(AssertionError):
+        api.refund('R1', 100, 60, out_trade_no='T1')
+
+
+def test_refundquery_parses_response():
+    api = make_api()
+    api._session = FakeSession(api, success({
+        'out_trade_no': 'T1',
+        'refund_count': '2',
+        'out_refund_no_0': 'R1',
+        'refund_status_0': 'SUCCESS',
+        'out_refund_no_1': 'R2',
+        'refund_status_1': 'PROCESSING',
+    }))
+    result = api.refundquery(out_trade_no='T1', offset=0)
+    assert result['refund_count'] == '2'
+    assert result['refund_status_1'] == 'PROCESSING'
+    assert 'sign' not in result and 'return_code' not in result and 'appid' not in result
+    _, request, _ = api._session.posts[0]
+    assert request['out_trade_no'] == 'T1'
+    assert request['offset'] == '0'
+
+
+def test_refundquery_errors():
+    api = make_api()
+    api._session = FakeSession(api, lambda request: {
+        'return_code': 'SUCCESS', 'result_code': 'FAIL', 'err_code': 'REFUNDNOTEXIST', 'err_code_des': 'not exist',
+    })
+    with pytest.raises(WeChatApiError) as info:
+        api.refundquery(out_refund_no='R9')
+    assert info.value.code == 'REFUNDNOTEXIST'
+
+    api._session = FakeSession(api, lambda request: {'return_code': 'FAIL', 'return_msg': 'invalid sign'})
+    with pytest.raises(WeChatApiError):
+        api.refundquery(refund_id='5000')
+
+
+def test_batch_refund_reports_partial_failures():
+    client = OrdinaryMerchantClient()
+    client.batch_workers = 2
+    api = client.merchant_api = make_api()
+
+    def reply(request):
+        if request['out_refund_no'] == 'R2':
+            return {'return_code': 'SUCCESS', 'result_code': 'FAIL', 'err_code': 'NOTENOUGH', 'err_code_des': 'balance'}
+        return success({'out_refund_no': request['out_refund_no']})(request)
+
+    api._cert_session = FakeSession(api, reply)
+    refunds = [
+        {'out_refund_no': 'R{}'.format(i), 'out_trade_no': 'T{}'.format(i), 'total_fee': 100, 'refund_fee': 100}
+        for i in range(1, 4)
+    ]
+    results = {refund['out_refund_no']: (result, error) for refund, result, error in client.batch_refund(refunds)}
+    assert results['R1'][0]['out_refund_no'] == 'R1'
+    assert results['R3'][1] is None
+    assert results['R2'][0] is None
+    assert results['R2'][1].code == 'NOTENOUGH'
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+import inspect
+
+import pytest
+
+from flask_wechat.api.app import AuthorizedAppApi
+from flask_wechat.api.pagination import paginate
+from flask_wechat.app import AuthorizedAppClient
+
+
+def make_fetch(total, calls):
+    def fetch_page(offset, count):
+        calls.append(offset)
+        return list(range(offset, min(offset + count, total)))
+    return fetch_page
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+@pytest.mark.parametrize('total', [0, 5, 20, 45])
+def test_paginate_yields_all_items(prefetch, total):
+    calls = []
+    assert list(paginate(make_fetch(total, calls), count=10, prefetch=prefetch)) == list(range(total))
+    assert calls == list(range(0, total + 1, 10))
+
+
+def test_paginate_stops_early():
+    calls = []
+    items = paginate(make_fetch(100, calls), count=10)
+    assert [next(items) for _ in range(3)] == [0, 1, 2]
+    items.close()
+    assert calls == [0]
+
+
+@pytest.mark.parametrize('func', [
+    paginate,
+    AuthorizedAppApi.iter_template_library_list,
+    AuthorizedAppApi.iter_template_list,
+    AuthorizedAppClient.iter_template_library_list,
+    AuthorizedAppClient.iter_template_list,
+])
+def test_prefetch_defaults_match(func):
+    assert inspect.signature(func).parameters['prefetch'].default is False
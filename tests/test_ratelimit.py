@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import json
+
+import pytest
+
+from flask_wechat.api.base import BaseApi
+from flask_wechat.api.breaker import CircuitBreakers, configure_breakers
+from flask_wechat.api.common import WeChatCircuitOpenError, WeChatRateLimitError
+from flask_wechat.api.ratelimit import ApiLimits, configure_limits
+
+URL = 'https://api.weixin.qq.com/cgi-bin/message/custom/send'
+ENDPOINT = '/cgi-bin/message/custom/send'
+
+
+class FakeResponse(object):
+    def __init__(self, result):
+        self.content = json.dumps(result).encode('utf-8')
+
+
+class FakeSession(object):
+    def __init__(self, errcode=0):
+        self.errcode = errcode
+        self.requests = 0
+
+    def request(self, method, url, **kwargs):
+        self.requests += 1
+        return FakeResponse({'errcode': self.errcode})
+
+
+class Api(BaseApi):
+    appid = 'wx-app'
+
+    def __init__(self, session):
+        self.fake_session = session
+
+    @property
+    def session(self):
+        return self.fake_session
+
+
+@pytest.fixture(autouse=True)
+def reset_globals():
+    yield
+    configure_limits(None)
+    configure_breakers(None)
+
+
+def test_daily_quota():
+    limits = ApiLimits({ENDPOINT: {'daily': 2}})
+    configure_limits(limits)
+    api = Api(FakeSession())
+    api.post(URL)
+    api.post(URL)
+    with pytest.raises(WeChatRateLimitError):
+        api.post(URL)
+    assert api.session.requests == 2
+    assert limits.remaining('wx-app', ENDPOINT) == 0
+
+
+def test_breaker_rejections_do_not_use_quota():
+    limits = ApiLimits({ENDPOINT: {'daily': 10}})
+    configure_limits(limits)
+    configure_breakers(CircuitBreakers(min_calls=2, failure_rate=0.5, open_timeout=60))
+    api = Api(FakeSession(errcode=-1))
+    for _ in range(2):
+        with pytest.raises(Exception):
+            api.post(URL)
+    assert limits.remaining('wx-app', ENDPOINT) == 8
+
+    for _ in range(5):
+        with pytest.raises(WeChatCircuitOpenError):
+            api.post(URL)
+    assert api.session.requests == 2
+    assert limits.remaining('wx-app', ENDPOINT) == 8
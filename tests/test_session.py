@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import base64
+import json
+
+import pytest
+from Crypto.Cipher import AES
+
+from flask_wechat.api import SecretAppApi
+from flask_wechat.api.common import WeChatSessionKeyError
+from flask_wechat.app import BaseAppClient
+from flask_wechat.session import SessionKeyStore
+
+APPID = 'wx-app'
+SESSION_KEY = base64.b64encode(b'k' * 16).decode()
+IV = base64.b64encode(b'i' * 16).decode()
+
+
+def encrypt(data):
+    plain = json.dumps(dict(data, watermark={'appid': APPID})).encode('utf-8')
+    padding = 16 - len(plain) % 16
+    cipher = AES.new(base64.b64decode(SESSION_KEY), AES.MODE_CBC, base64.b64decode(IV))
+    return base64.b64encode(cipher.encrypt(plain + bytes([padding]) * padding)).decode()
+
+
+class AppClient(BaseAppClient):
+    def __init__(self):
+        self.appid = APPID
+        self._app_api = SecretAppApi(APPID, 'secret')
+        self._session_key_store = SessionKeyStore()
+
+    @property
+    def access_token(self):
+        return 'token'
+
+    @property
+    def app_api(self):
+        return self._app_api
+
+    @property
+    def session_key_store(self):
+        return self._session_key_store
+
+
+def test_decrypt_data_with_stored_session_key():
+    client = AppClient()
+    client.session_key_store.save_session(APPID, {'openid': 'o1', 'session_key': SESSION_KEY})
+
+    assert client.decrypt_data(encrypt({'phoneNumber': '123'}), iv=IV, openid='o1') == {'phoneNumber': '123'}
+
+
+def test_missing_session_key_has_its_own_error_code():
+    with pytest.raises(WeChatSessionKeyError) as excinfo:
+        AppClient().decrypt_data(encrypt({}), iv=IV, openid='o1')
+
+    assert excinfo.value.code == WeChatSessionKeyError.CODE
+    assert excinfo.value.code != -41001
+    assert excinfo.value.openid == 'o1'
+
+
+def test_decrypt_data_requires_key_or_openid():
+    with pytest.raises(ValueError):
+        AppClient().decrypt_data(encrypt({}), iv=IV)
+    with pytest.raises(ValueError):
+        AppClient().decrypt_many([(encrypt({}), IV)])
+
+
+@pytest.mark.parametrize('key', [None, ''])
+def test_api_decrypt_data_requires_session_key(key):
+    api = SecretAppApi(APPID, 'secret')
+
+    with pytest.raises(ValueError):
+        api.decrypt_data(encrypt({}), key=key, iv=IV)
+    with pytest.raises(ValueError):
+        api.decrypt_many([(encrypt({}), IV)], key)
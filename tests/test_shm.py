@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from flask_wechat.cache import LocalCache
+from flask_wechat.shm import SharedMemoryCache
+from flask_wechat.token import TokenStore
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'tokens.shm')
+
+
+def test_get_set_delete(path):
+    cache = SharedMemoryCache(path, slots=8, value_size=64)
+    assert cache.get('a') is None
+    assert cache.set('a', 'value')
+    assert cache.get('a') == 'value'
+    assert cache.delete('a')
+    assert cache.get('a') is None
+    assert not cache.set('a', 'x' * 65)
+
+
+def test_expiry(path):
+    cache = SharedMemoryCache(path, slots=8)
+    cache.set('a', 'value', timeout=0.05)
+    time.sleep(0.1)
+    assert cache.get('a') is None
+
+
+def test_add_only_when_absent(path):
+    cache = SharedMemoryCache(path, slots=8)
+    assert cache.add('a', 'first', timeout=0.05)
+    assert not cache.add('a', 'second')
+    assert cache.get('a') == 'first'
+    time.sleep(0.1)
+    assert cache.add('a', 'third')
+    cache.delete('a')
+    assert cache.add('a', 'fourth')
+
+
+def test_shared_between_instances(path):
+    SharedMemoryCache(path, slots=8).set('a', 'value')
+    assert SharedMemoryCache(path, slots=8).get('a') == 'value'
+    with pytest.raises(ValueError):
+        SharedMemoryCache(path, slots=16)
+
+
+def test_flock_excludes_forked_children(path):
+    cache = SharedMemoryCache(path, slots=8)
+    cache.set('a', 'parent')
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            cache._check_fork()
+            cache._flock(True)
+            os.write(write_fd, b'x')
+            time.sleep(0.5)
+            cache._flock(False)
+        finally:
+            os._exit(0)
+    os.read(read_fd, 1)
+    started_at = time.monotonic()
+    cache.set('a', 'after child')
+    waited = time.monotonic() - started_at
+    os.waitpid(pid, 0)
+    assert waited > 0.3
+    assert cache.get('a') == 'after child'
+
+
+def test_child_writes_are_visible_to_parent(path):
+    cache = SharedMemoryCache(path, slots=8)
+    context = multiprocessing.get_context('fork')
+    process = context.Process(target=lambda: cache.set('a', 'from child'))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert cache.get('a') == 'from child'
+
+
+def test_token_store_reader_does_not_write_local_while_refreshing(path):
+    local = SharedMemoryCache(path, slots=8)
+    cache = LocalCache()
+    cache.set('token', 'value')
+    store = TokenStore(cache=cache, local=local)
+
+    # 另一个 worker 持有刷新标记
+    assert local.add(store._refresh_marker('token'), 'other')
+    assert store.get('token') == 'value'
+    assert local.get('token') is None
+
+    local.delete(store._refresh_marker('token'))
+    assert store.get('token') == 'value'
+    assert local.get('token') == 'value'
+
+
+def _fetch_token(path, counter, results):
+    store = TokenStore(local=SharedMemoryCache(path, slots=8), refresh_lease=5)
+
+    def fetch():
+        with counter.get_lock():
+            counter.value += 1
+        time.sleep(0.3)
+        return 'fetched', 7200
+
+    results.put(store.get_or_fetch('token', fetch))
+
+
+def test_token_store_fetches_once_per_host(path):
+    SharedMemoryCache(path, slots=8)
+    context = multiprocessing.get_context('fork')
+    counter = context.Value('i', 0)
+    results = context.Queue()
+    processes = [context.Process(target=_fetch_token, args=(path, counter, results)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    values = [results.get(timeout=10) for _ in processes]
+    for process in processes:
+        process.join()
+    assert values == ['fetched'] * 4
+    assert counter.value == 1
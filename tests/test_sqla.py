@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import pytest
+from sqlalchemy import Column, Integer, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from flask_wechat.sqla import WeChatAppMixin, bulk_upsert
+
+Base = declarative_base()
+
+
+class App(WeChatAppMixin, Base):
+    __tablename__ = 'test_wechat_app'
+
+    id = Column(Integer, primary_key=True)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+def authorization_info(func_ids):
+    return {
+        'authorizer_access_token': 'token',
+        'expires_in': 7200,
+        'authorizer_refresh_token': 'refresh',
+        'func_info': [{'funcscope_category': {'id': func_id}} for func_id in func_ids],
+    }
+
+
+def add_app(session, appid, func_ids):
+    app = App(appid=appid)
+    app.update_authorization_info(authorization_info(func_ids))
+    session.add(app)
+    session.commit()
+    return app
+
+
+def test_make_func_mask():
+    assert App.make_func_mask([1, 2, 62]) == (1 << 1) | (1 << 2) | (1 << 62)
+
+
+@pytest.mark.parametrize('func_ids', [[63], [65], [1, 100], [-1]])
+def test_make_func_mask_rejects_ids_outside_mask(func_ids):
+    with pytest.raises(ValueError):
+        App.make_func_mask(func_ids)
+
+
+def test_func_mask_column_is_not_indexed():
+    assert not App.__table__.c.func_mask.index
+
+
+def test_large_func_ids_are_checked_against_func_info(session):
+    app = add_app(session, 'wx-small', [1, 2, 3])
+    other = add_app(session, 'wx-large', [1, 65])
+
+    assert not app.has_funcs([65])
+    assert other.has_funcs([65])
+    assert other.has_funcs([1, 65])
+    assert not other.has_funcs([2, 65])
+
+    assert [a.appid for a in App.query_by_funcs(session, [65])] == ['wx-large']
+    assert [a.appid for a in App.query_by_funcs(session, [1, 65])] == ['wx-large']
+    assert App.query_by_funcs(session, [2, 65]).count() == 0
+    assert App.query_by_funcs(session, [1]).count() == 2
+
+
+def test_func_info_match_does_not_accept_prefixes(session):
+    add_app(session, 'wx-app', [1, 650])
+    assert App.query_by_funcs(session, [65]).count() == 0
+
+
+def test_has_funcs_without_stored_mask(session):
+    app = add_app(session, 'wx-app', [1, 2, 70])
+    app.func_mask = None
+    assert app.has_funcs([1, 70])
+    assert not app.has_funcs([3])
+
+
+def test_backfill_func_mask(session):
+    app = add_app(session, 'wx-app', [4, 80])
+    app.func_mask = None
+    session.commit()
+    assert App.backfill_func_mask(session) == 1
+    assert app.func_mask == 1 << 4
+
+
+def test_bulk_upsert_counts_rows_after_dedup(session):
+    rows = [{'appid': 'wx1', 'name': 'a'}, {'appid': 'wx2', 'name': 'b'}, {'appid': 'wx1', 'name': 'c'}]
+
+    assert bulk_upsert(session, App, rows, ('appid',)) == 2
+    assert {app.appid: app.name for app in session.query(App)} == {'wx1': 'c', 'wx2': 'b'}
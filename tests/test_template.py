@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import pytest
+
+from flask_wechat.api.common import WeChatApiError
+from flask_wechat.app import AuthorizedAppClient
+from flask_wechat.template import TemplateIndexRegistry
+
+TEMPLATES = [
+    {'template_id': 'tpl-paid', 'title': '支付成功通知', 'content': '金额：{{keyword1.DATA}}\n时间：{{keyword2.DATA}}'},
+]
+
+
+class FakeAppApi(object):
+    def __init__(self, templates=TEMPLATES, error=None):
+        self.templates = templates
+        self.error = error
+        self.calls = []
+
+    def get_template_list(self):
+        self.calls.append('list')
+        if self.error is not None:
+            raise self.error
+        return self.templates
+
+    def send_uniform_message(self, access_token, touser, weapp_template_msg=None, mp_template_msg=None):
+        self.calls.append('uniform_send')
+        return (weapp_template_msg or mp_template_msg)['template_id']
+
+
+class FakeComponent(object):
+    def __init__(self, miss_timeout=300):
+        self.template_indexes = TemplateIndexRegistry(miss_timeout=miss_timeout)
+
+
+def make_client(api, miss_timeout=300):
+    client = AuthorizedAppClient('wx-app', 'token', FakeComponent(miss_timeout=miss_timeout))
+    client.authorized_app_api = api
+    return client
+
+
+def test_send_with_raw_template_id_skips_index():
+    api = FakeAppApi()
+    client = make_client(api)
+    for _ in range(3):
+        assert client.send_weapp_message('openid', 'raw-id', None, 'form', {}, None) == 'raw-id'
+    assert api.calls == ['uniform_send'] * 3
+
+
+def test_send_by_title_resolves_from_index_once():
+    api = FakeAppApi()
+    client = make_client(api)
+    for _ in range(3):
+        assert client.send_weapp_message_by_title('openid', '支付成功通知', None, 'form', {}, None) == 'tpl-paid'
+    assert api.calls == ['list'] + ['uniform_send'] * 3
+
+
+def test_send_by_title_with_keywords():
+    client = make_client(FakeAppApi())
+    template_id = client.send_weapp_message_by_title('openid', '支付成功通知', None, 'form', {}, None, keywords=['金额', '时间'])
+    assert template_id == 'tpl-paid'
+
+
+def test_unknown_title_raises_and_is_cached_as_miss():
+    api = FakeAppApi()
+    client = make_client(api)
+    for _ in range(3):
+        with pytest.raises(KeyError):
+            client.send_weapp_message_by_title('openid', '不存在的模板', None, 'form', {}, None)
+    assert api.calls == ['list']
+
+
+def test_indexed_template_id_passes_through():
+    client = make_client(FakeAppApi())
+    assert client.resolve_template_id('tpl-paid') == 'tpl-paid'
+
+
+def test_miss_expires_after_timeout():
+    api = FakeAppApi()
+    client = make_client(api, miss_timeout=0)
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            client.resolve_template_id('不存在的模板')
+    assert api.calls == ['list', 'list']
+
+
+def test_list_failure_backs_off_and_raises_for_unknown_titles():
+    api = FakeAppApi(error=WeChatApiError(48001, 'api unauthorized'))
+    client = make_client(api)
+    for _ in range(3):
+        with pytest.raises(KeyError):
+            client.send_weapp_message_by_title('openid', 'raw-id', None, 'form', {}, None)
+    assert api.calls == ['list']
+
+
+def test_list_failure_keeps_previous_index():
+    api = FakeAppApi()
+    client = make_client(api)
+    client.resolve_template_id('支付成功通知')
+    client.get_template_index('weapp').invalidate()
+    api.error = WeChatApiError(-1, 'system error')
+    assert client.resolve_template_id('支付成功通知') == 'tpl-paid'
+
+
+def test_invalidate_clears_misses():
+    api = FakeAppApi(templates=[])
+    client = make_client(api)
+    with pytest.raises(KeyError):
+        client.resolve_template_id('支付成功通知')
+    api.templates = TEMPLATES
+    client.get_template_index('weapp').invalidate()
+    assert client.resolve_template_id('支付成功通知') == 'tpl-paid'
+
+
+@pytest.mark.parametrize('content, keywords', [
+    ('金额：{{keyword1.DATA}}\n时间：{{keyword2.DATA}}', ('金额', '时间')),
+    ('{{first.DATA}}\n商品:{{keyword1.DATA}}', ('商品',)),
+])
+def test_parse_keywords(content, keywords):
+    from flask_wechat.template import TemplateIndex
+
+    assert TemplateIndex.parse_keywords(content) == keywords
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import time
+
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from flask_wechat.cache import LocalCache
+from flask_wechat.sqla import WeChatTokenMixin
+from flask_wechat.token import FileTokenSnapshot, SQLATokenSnapshot, TokenStore
+
+Base = declarative_base()
+
+
+class Token(WeChatTokenMixin, Base):
+    __tablename__ = 'test_wechat_token'
+
+    id = Column(Integer, primary_key=True)
+
+
+class Order(Base):
+    __tablename__ = 'test_order'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(32))
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'test.db'))
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    yield factory
+    engine.dispose()
+
+
+def test_sqla_snapshot_round_trip(session_factory):
+    session = session_factory()
+    snapshot = SQLATokenSnapshot(lambda: session, Token)
+    assert snapshot.get('token') is None
+    snapshot.set('token', 'v1', 100)
+    snapshot.set('token', 'v2', 200)
+    assert snapshot.get('token') == ('v2', 200)
+    snapshot.delete('token')
+    assert snapshot.get('token') is None
+
+
+def test_sqla_snapshot_does_not_commit_caller_session(session_factory):
+    session = session_factory()
+    session.add(Order(name='pending'))
+    snapshot = SQLATokenSnapshot(lambda: session, Token)
+
+    snapshot.set('token', 'value', 100)
+    snapshot.delete('other')
+    session.rollback()
+
+    other = session_factory()
+    assert other.query(Order).count() == 0
+    assert other.query(Token.value).scalar() == 'value'
+
+
+def test_file_snapshot_round_trip(tmp_path):
+    snapshot = FileTokenSnapshot(str(tmp_path / 'tokens.json'))
+    expires_at = int(time.time()) + 100
+    snapshot.set('a', 'value', expires_at)
+    assert snapshot.get('a') == ('value', expires_at)
+    snapshot.delete('a')
+    assert snapshot.get('a') is None
+
+
+def test_file_snapshot_drops_expired_tokens(tmp_path):
+    snapshot = FileTokenSnapshot(str(tmp_path / 'tokens.json'))
+    snapshot.set('old', 'value', int(time.time()) - 1)
+    snapshot.set('new', 'value', None)
+    assert snapshot.get('old') is None
+    assert snapshot.get('new') == ('value', None)
+
+
+def test_file_snapshots_merge_writes(tmp_path):
+    path = str(tmp_path / 'tokens.json')
+    first = FileTokenSnapshot(path)
+    second = FileTokenSnapshot(path)
+    first.get('a')
+    second.get('a')
+
+    first.set('a', 'from first', None)
+    second.set('b', 'from second', None)
+
+    assert FileTokenSnapshot(path).get('a') == ('from first', None)
+    assert first.get('b') == ('from second', None)
+
+
+def _write_tokens(path, prefix, count):
+    snapshot = FileTokenSnapshot(path)
+    for i in range(count):
+        snapshot.set('{}{}'.format(prefix, i), 'value', None)
+
+
+def test_file_snapshot_concurrent_processes(tmp_path):
+    path = str(tmp_path / 'tokens.json')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_write_tokens, args=(path, prefix, 20)) for prefix in 'abcd']
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    snapshot = FileTokenSnapshot(path)
+    for prefix in 'abcd':
+        for i in range(20):
+            assert snapshot.get('{}{}'.format(prefix, i)) == ('value', None)
+
+
+def test_token_store_restores_from_snapshot(tmp_path):
+    snapshot = FileTokenSnapshot(str(tmp_path / 'tokens.json'))
+    TokenStore(cache=LocalCache(), snapshot=snapshot).set('token', 'value', expires_in=7200)
+
+    fetches = []
+    store = TokenStore(cache=LocalCache(), snapshot=snapshot)
+    value = store.get_or_fetch('token', lambda: fetches.append(1) or ('fetched', 7200))
+    assert value == 'value'
+    assert fetches == []
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+import os
+import zipfile
+
+import pytest
+
+from flask_wechat.api.app import wxa_page_path
+from flask_wechat.wxacode import WxaCodeBatch, check_member_name
+
+BAD_NAMES = ['../x.png', 'a/../../x.png', '/tmp/x.png', 'C:x.png', 'a\\x.png', 'a//x.png', './x.png', '', 'x\0.png']
+
+
+class FakeAppApi(object):
+    def __init__(self):
+        self.paths = []
+
+    def get_wxa_code(self, access_token, path, fileobj=None, **options):
+        self.paths.append(path)
+        fileobj.write(path.encode('utf-8'))
+
+
+class FakeAppClient(object):
+    appid = 'wx-app'
+    access_token = 'token'
+
+    def __init__(self):
+        self.app_api = FakeAppApi()
+
+
+def make_batch():
+    return WxaCodeBatch(FakeAppClient(), max_workers=2, rate=None)
+
+
+def test_wxa_page_path_sorts_params():
+    assert wxa_page_path('pages/index') == 'pages/index'
+    assert wxa_page_path('pages/index', {'b': 2, 'a': 1}) == 'pages/index?a=1&b=2'
+
+
+@pytest.mark.parametrize('name', BAD_NAMES)
+def test_check_member_name_rejects_escaping_names(name):
+    with pytest.raises(ValueError):
+        check_member_name(name)
+
+
+def test_check_member_name_allows_subdirectories():
+    assert check_member_name('shop/1.png') == 'shop/1.png'
+
+
+def test_to_directory_reports_bad_names(tmpdir):
+    directory = str(tmpdir.join('out'))
+    specs = [{'name': name, 'path': 'pages/index'} for name in BAD_NAMES]
+    specs.append({'name': 'shop/1.png', 'path': 'pages/index', 'params': {'id': 1}})
+
+    results = list(make_batch().to_directory(specs, directory))
+
+    errors = {spec['name']: error for spec, error in results}
+    assert errors.pop('shop/1.png') is None
+    assert all(isinstance(error, ValueError) for error in errors.values())
+    assert len(errors) == len(BAD_NAMES)
+    with open(os.path.join(directory, 'shop', '1.png'), 'rb') as f:
+        assert f.read() == b'pages/index?id=1'
+    assert not os.path.exists(str(tmpdir.join('x.png')))
+    assert sorted(os.listdir(directory)) == ['shop']
+
+
+def test_to_zip_reports_bad_names(tmpdir):
+    zip_path = str(tmpdir.join('codes.zip'))
+    specs = [{'name': name, 'path': 'pages/index'} for name in BAD_NAMES]
+    specs.append({'name': 'shop/1.png', 'path': 'pages/index'})
+    batch = make_batch()
+
+    results = list(batch.to_zip(specs, zip_path))
+
+    failed = [spec['name'] for spec, error in results if isinstance(error, ValueError)]
+    assert sorted(failed) == sorted(BAD_NAMES)
+    assert batch.app_client.app_api.paths == ['pages/index']
+    with zipfile.ZipFile(zip_path) as archive:
+        assert archive.namelist() == ['shop/1.png']
+    assert batch.report['failed'] == len(BAD_NAMES)